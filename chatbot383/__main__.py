@@ -1,33 +1,60 @@
 import argparse
+import functools
 import json
 import logging
 import multiprocessing
 
-from chatbot383.app import App
+from chatbot383.logsetup import setup_logging
+from chatbot383.startup import REPORT
 
 
 def main():
     arg_parser = argparse.ArgumentParser()
     arg_parser.add_argument('config_file')
     arg_parser.add_argument('--debug', action='store_true')
+    arg_parser.add_argument('--workers', type=int, default=1,
+                            help='Split the channels over this many processes')
+    arg_parser.add_argument('--startup-report', action='store_true',
+                            help='Print the time spent in each startup phase '
+                            'and import once the bot is in chat')
     args = arg_parser.parse_args()
 
+    if args.startup_report:
+        REPORT.enable()
+
     if args.debug:
         level = logging.DEBUG
     else:
         level = logging.INFO
 
-    logging.basicConfig(
-        level=level, format='%(asctime)s - %(levelname)s - %(message)s')
-
-    with open(args.config_file, 'r') as file:
+    with REPORT.phase('config'), open(args.config_file, 'r') as file:
         config = json.load(file)
 
+    setup_logging(
+        level, json_format=config.get('log_json'),
+        sample_rates=config.get('log_sample_rates'),
+        rate_limits=config.get('log_rate_limits'))
+
     # Using 'spawn' to avoid safe forking multithreaded process issue
     multiprocessing.set_start_method('spawn')
 
-    app = App(config)
-    app.run()
+    # Imported here so the report covers them; the supervisor does not need
+    # the bot modules, which its workers import themselves
+    if args.workers > 1:
+        from chatbot383.supervisor import Supervisor
+
+        supervisor = Supervisor(config, args.workers, log_level=level,
+                                config_filename=args.config_file)
+        supervisor.run()
+    else:
+        with REPORT.phase('import'):
+            from chatbot383.app import App, load_config
+
+        with REPORT.phase('app_init'):
+            app = App(config, config_loader=functools.partial(
+                load_config, args.config_file))
+
+        app.run()
 
 
 if __name__ == '__main__':
@@ -1,27 +1,331 @@
-import queue
+import atexit
+import concurrent.futures
+import json
+import logging
+import signal
+import threading
 
+from chatbot383 import metrics
 from chatbot383.bot import Bot
+from chatbot383.capture import CaptureWriter
 from chatbot383.client import Client, ClientThread
+from chatbot383.control import ControlError, ControlServer
+from chatbot383.inboundqueue import FairInboundQueue
 from chatbot383.features import Features, Database
+from chatbot383.memaccount import MemoryAccountant, MemoryUsage
+from chatbot383.profiler import SamplingProfiler
+from chatbot383.snapshot import SnapshotWriter, read_snapshot
+from chatbot383.startup import REPORT
+from chatbot383.tracing import TRACER
+
+_logger = logging.getLogger(__name__)
+
+# Config keys that a reload applies to the running bot
+RELOADABLE_CONFIG_KEYS = ('channels', 'ignored_users', 'silent_channels',
+                          'alert_channels')
+CONTROL_TIMEOUT = 10
+
+
+def load_config(filename):
+    with open(filename, 'r') as file:
+        return json.load(file)
 
 
 class App(object):
-    def __init__(self, config):
+    '''Run the bot with the given config.
+
+    `config_loader` returns a fresh config for reloading with SIGHUP or the
+    control socket.
+    '''
+    def __init__(self, config, shard_bus=None, config_loader=None):
         self._config = config
-        inbound_queue = queue.Queue(100)
-        self._main_client = Client(inbound_queue=inbound_queue)
-        self._group_client = Client(inbound_queue=inbound_queue)
+        self._shard_bus = shard_bus
+        self._config_loader = config_loader
+        inbound_queue = FairInboundQueue(
+            shares=self._config.get('channel_shares'))
+        coalesce_window = self._config.get('coalesce_window')
+        send_share = 1 / shard_bus.worker_count if shard_bus else 1.0
+        self._main_client = Client(inbound_queue=inbound_queue, name='main',
+                                   coalesce_window=coalesce_window,
+                                   send_share=send_share)
+        self._group_client = Client(inbound_queue=inbound_queue, name='group',
+                                    coalesce_window=coalesce_window,
+                                    send_share=send_share)
         self._main_client_thread = ClientThread(self._main_client)
         self._group_client_thread = ClientThread(self._group_client)
         channels = self._config['channels']
         self._bot = Bot(channels, self._main_client, self._group_client,
                         inbound_queue,
                         ignored_users=self._config.get('ignored_users'),
-                        silent_channels=self._config.get('silent_channels'))
+                        silent_channels=self._config.get('silent_channels'),
+                        shard_bus=shard_bus,
+                        collapse_duplicates=self._config.get('flood_collapse'))
         database = Database(self._config['database'])
         self._features = Features(self._bot, self._config['help_text'],
                                   database, self._config,
                         alert_channels=self._config.get('alert_channels'))
+        self._metrics_server = None
+
+        if self._config.get('capture_filename'):
+            capture = CaptureWriter(self._config['capture_filename'])
+            self._main_client.capture = capture
+            self._group_client.capture = capture
+            atexit.register(capture.close)
+
+        TRACER.slow_threshold = self._config.get('slow_message_threshold', 2.0)
+
+        self._init_metrics(inbound_queue)
+
+        self._profiler = SamplingProfiler(
+            output_dir=self._config.get('profile_directory', '.'),
+            sample_rate=self._config.get('profile_sample_rate', 200),
+            duration=self._config.get('profile_duration', 30),
+            functions_getter=self._get_profiled_functions
+        )
+
+        if hasattr(signal, 'SIGUSR1'):
+            self._profiler.install_signal_handler(signal.SIGUSR1)
+
+        self._memory_accountant = MemoryAccountant(
+            warn_entries=self._config.get('memory_warn_entries', 100000))
+        self._init_memory_accounting(inbound_queue)
+
+        self._snapshot_writer = None
+
+        if self._config.get('snapshot_filename'):
+            self._init_snapshot()
+
+        self._control_server = None
+
+        if self._config.get('control_socket'):
+            self._control_server = ControlServer(
+                self._config['control_socket'], self._handle_control)
+
+        if self._config_loader and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._reload_signal)
+
+    def _init_snapshot(self):
+        filename = self._config['snapshot_filename']
+
+        with REPORT.phase('snapshot_load'):
+            state = read_snapshot(
+                filename, max_age=self._config.get('snapshot_max_age', 3600))
+
+        if state:
+            self._bot.set_state(state.get('bot') or {})
+            self._features.set_state(state.get('features') or {})
+
+        self._snapshot_writer = SnapshotWriter(filename)
+
+        # Collected on the dispatch thread, encoded and written off it
+        self._bot.scheduler.every(
+            self._config.get('snapshot_interval', 60),
+            lambda: self._snapshot_writer.submit(self._get_state()),
+            name='snapshot')
+        atexit.register(self._save_snapshot)
+
+    def _get_state(self):
+        return {
+            'bot': self._bot.get_state(),
+            'features': self._features.get_state(),
+        }
+
+    def _save_snapshot(self):
+        self._snapshot_writer.write(self._get_state())
+
+    def _init_memory_accounting(self, inbound_queue):
+        accountant = self._memory_accountant
+
+        self._bot.register_memory_probes(accountant)
+        self._features.register_memory_probes(accountant)
+        accountant.register(
+            'inbound_queue', lambda: MemoryUsage(inbound_queue.qsize(), 0))
+
+        for name, client in (('main', self._main_client),
+                             ('group', self._group_client)):
+            accountant.register(
+                '{}_outbound_queue'.format(name),
+                lambda client=client: MemoryUsage(
+                    client.outbound_queue.qsize() + client.pending_count, 0))
+            accountant.register(
+                '{}_irc_buffer'.format(name),
+                lambda client=client: self._get_irc_buffer_usage(client))
+
+        if self._config.get('memory_tracemalloc'):
+            accountant.tracemalloc_diff()
+
+        if hasattr(signal, 'SIGUSR2'):
+            signal.signal(signal.SIGUSR2,
+                          lambda signal_number, frame:
+                              accountant.tracemalloc_diff())
+
+        accountant.register('scheduler_timers',
+                            lambda: MemoryUsage(len(self._bot.scheduler), 0))
+
+        self._bot.scheduler.every(
+            self._config.get('memory_report_interval', 3600),
+            accountant.report, name='memory_report')
+
+    @classmethod
+    def _get_irc_buffer_usage(cls, client):
+        line_buffer = getattr(client.connection, 'buffer', None)
+        size = len(line_buffer) if line_buffer is not None else 0
+
+        return MemoryUsage(size, size)
+
+    def _get_profiled_functions(self):
+        for dummy, func in self._bot.commands + self._bot.message_handlers:
+            yield func
+
+    def _init_metrics(self, inbound_queue):
+        metrics.gauge(
+            'chatbot383_queue_depth', 'Items waiting in a queue', ('queue',)
+        ).set_function(lambda: {
+            ('inbound',): inbound_queue.qsize(),
+            ('outbound_main',): self._main_client.outbound_queue.qsize(),
+            ('outbound_group',): self._group_client.outbound_queue.qsize(),
+            ('pending_main',): self._main_client.pending_count,
+            ('pending_group',): self._group_client.pending_count,
+        })
+        metrics.counter(
+            'chatbot383_inbound_filtered_total',
+            'Chat lines dropped before the inbound queue', ('reason',)
+        ).set_function(lambda: dict(
+            ((reason,), count) for reason, count
+            in self._bot.inbound_filter.drop_counts.items()
+        ))
+
+        metrics.gauge(
+            'chatbot383_spam_ratio',
+            'Share of recent chat lines repeating an earlier line',
+            ('channel',)
+        ).set_function(lambda: dict(
+            ((channel,), ratio) for channel, ratio
+            in self._bot.flood_detector.get_spam_ratios().items()
+        ))
+
+        metrics.gauge(
+            'chatbot383_channel_members', 'Users known to be in a channel',
+            ('channel',)
+        ).set_function(lambda: dict(
+            ((channel,), count) for channel, count
+            in self._bot.membership_tracker.get_counts().items()
+        ))
+
+        metrics_address = self._config.get('metrics_address')
+
+        if metrics_address:
+            host, port = metrics_address.rsplit(':', 1)
+            self._metrics_server = metrics.MetricsServer(host, int(port))
+            self._metrics_server.start()
+            _logger.info('Serving metrics on %s', metrics_address)
+
+        if self._config.get('metrics_filename'):
+            # Writing the file should not hold up the dispatch loop
+            self._bot.scheduler.every(
+                self._config.get('metrics_dump_interval', 60),
+                self._dump_metrics, name='metrics_dump', initial_delay=0,
+                threaded=True)
+
+    def _reload_signal(self, signal_number, frame):
+        # The handler runs on the dispatch thread, which may be holding the
+        # scheduler lock, so the reload is handed to another thread
+        thread = threading.Thread(target=self._reload_in_background,
+                                  name='ConfigReload')
+        thread.daemon = True
+        thread.start()
+
+    def _reload_in_background(self):
+        try:
+            _logger.info('Reloaded config: %s', self.reload_config())
+        except Exception:
+            _logger.exception('Could not reload config')
+
+    def _call_in_dispatch(self, func, *args):
+        '''Run `func` on the dispatch thread and return its result.'''
+        future = concurrent.futures.Future()
+
+        def run():
+            try:
+                future.set_result(func(*args))
+            except Exception as error:
+                future.set_exception(error)
+
+        self._bot.scheduler.call_later(0, run)
+
+        return future.result(CONTROL_TIMEOUT)
+
+    def reload_config(self):
+        '''Load the config again and apply the keys that can change live.
+
+        Called from a thread other than the dispatch thread; the file is
+        read here and only the changes are applied on the dispatch thread.
+        Returns a summary of the changes.
+        '''
+        if not self._config_loader:
+            raise ControlError('Config was not loaded from a file')
+
+        config = self._config_loader()
+        needs_restart = sorted(
+            key for key in frozenset(config) | frozenset(self._config)
+            if key not in RELOADABLE_CONFIG_KEYS and
+            config.get(key) != self._config.get(key)
+        )
+
+        if needs_restart:
+            _logger.warning('Restart needed to apply config keys: %s',
+                            ', '.join(needs_restart))
+
+        return self._call_in_dispatch(self._apply_config, config)
+
+    def _apply_config(self, config):
+        for key in RELOADABLE_CONFIG_KEYS:
+            self._config[key] = config.get(key) or []
+
+        joined, parted = self._bot.reconfigure(
+            channels=self._config['channels'],
+            ignored_users=self._config['ignored_users'],
+            silent_channels=self._config['silent_channels'])
+        self._features.alert_channels = self._config['alert_channels']
+
+        return 'joined={} parted={}'.format(
+            ','.join(joined) or '-', ','.join(parted) or '-')
+
+    def _handle_control(self, command, argument):
+        if command == 'reload':
+            return self.reload_config()
+        elif command in ('join', 'part'):
+            return self._call_in_dispatch(self._join_or_part, command,
+                                          argument)
+        elif command == 'channels':
+            return ' '.join(self._bot.channels)
+        else:
+            raise ControlError('Unknown command {}'.format(command))
+
+    def _join_or_part(self, command, channel):
+        # Lasts until the next reload, which uses the config file's list
+        if not channel.startswith('#'):
+            raise ControlError('Not a channel: {}'.format(channel))
+
+        if self._shard_bus and not self._shard_bus.owns(channel):
+            raise ControlError('Channel belongs to another worker')
+
+        channels = self._bot.channels
+
+        if command == 'join' and channel not in channels:
+            channels += (channel,)
+        elif command == 'part':
+            channels = tuple(name for name in channels if name != channel)
+
+        joined, parted = self._bot.reconfigure(channels=channels)
+
+        return ','.join(joined + parted) or 'unchanged'
+
+    def _dump_metrics(self):
+        try:
+            metrics.REGISTRY.dump_to_file(self._config['metrics_filename'])
+        except OSError:
+            _logger.exception('Could not write metrics file')
 
     def run(self):
         username = self._config['username']
@@ -31,21 +335,38 @@ class App(object):
         main_address[1] = int(main_address[1])
         group_address[1] = int(group_address[1])
 
-        main_connect_factory = Client.new_connect_factory(
-            hostname=main_address[0], use_ssl=self._config.get('ssl'))
-        group_connect_factory = Client.new_connect_factory(
-            hostname=group_address[0], use_ssl=self._config.get('ssl'))
+        if self._config['channels']:
+            REPORT.expect('main_joined', 'group_welcome')
+        else:
+            REPORT.expect('main_welcome', 'group_welcome')
 
-        self._main_client.async_connect(
-            main_address[0], main_address[1], username, password=password,
-            connect_factory=main_connect_factory
-        )
-        self._group_client.async_connect(
-            group_address[0], group_address[1], username, password=password,
-            connect_factory=group_connect_factory
-        )
+        with REPORT.phase('connect_start'):
+            main_connect_factory = Client.new_connect_factory(
+                hostname=main_address[0], use_ssl=self._config.get('ssl'))
+            group_connect_factory = Client.new_connect_factory(
+                hostname=group_address[0], use_ssl=self._config.get('ssl'))
+
+            self._main_client.async_connect(
+                main_address[0], main_address[1], username, password=password,
+                connect_factory=main_connect_factory
+            )
+            self._group_client.async_connect(
+                group_address[0], group_address[1], username,
+                password=password, connect_factory=group_connect_factory
+            )
+
+            self._main_client_thread.start()
+            self._group_client_thread.start()
+
+        # Loads in the background while the clients connect
+        self._features.warm()
+
+        if self._shard_bus:
+            self._shard_bus.start(self._bot)
 
-        self._main_client_thread.start()
-        self._group_client_thread.start()
+        if self._control_server:
+            self._control_server.start()
+            atexit.register(self._control_server.stop)
+            _logger.info('Control socket at %s', self._control_server.path)
 
         self._bot.run()
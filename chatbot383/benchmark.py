@@ -0,0 +1,392 @@
+'''Microbenchmarks for the hot paths of the bot.
+
+Run with ``python -m chatbot383.benchmark``. Results can be saved as JSON
+and compared against a previous run with ``--baseline``.
+'''
+import argparse
+import gc
+import itertools
+import json
+import os
+import platform
+import queue
+import random
+import re
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCHMARKS = []
+
+
+def benchmark(name, number=1000):
+    '''Register a benchmark.
+
+    The decorated function receives a context dict and returns the function
+    to time, which is called with the iteration index. Raising ImportError
+    skips the benchmark.
+    '''
+    def decorator(setup_func):
+        BENCHMARKS.append((name, number, setup_func))
+        return setup_func
+
+    return decorator
+
+
+class BenchClient(object):
+    '''Stand-in for `Client` that records outgoing messages.'''
+    def __init__(self, inbound_queue):
+        self.inbound_queue = inbound_queue
+        self.inbound_filter = None
+        self.sent = []
+
+    def get_nickname(self, lower=False):
+        return 'chatbot383'
+
+    def privmsg(self, target, text, action=False, trace=None):
+        self.sent.append((target, text))
+
+        if len(self.sent) > 1000:
+            del self.sent[:]
+
+    def join(self, channel):
+        pass
+
+
+def new_bot(context):
+    from chatbot383.bot import Bot
+
+    inbound_queue = queue.Queue()
+    client = BenchClient(inbound_queue)
+
+    return Bot(['#bench'], client, client, inbound_queue), client
+
+
+def write_match_fixture(path, count=493):
+    from chatbot383.featurecomponents import matchgen
+
+    rng = random.Random(383)
+    records = [
+        matchgen.PokemonRecord(
+            pokemon_id, 'Pokemon{}'.format(pokemon_id),
+            rng.randint(1, 5000), rng.choice(matchgen.COLORS),
+            tuple(rng.sample(matchgen.TYPES, rng.randint(1, 2))))
+        for pokemon_id in range(1, count + 1)
+    ]
+    matchgen.write_snapshot(records, path)
+
+
+SAMPLE_TEXT = ('Groudonger ヽ༼ຈل͜ຈ༽ﾉ raise your dongers! ' * 40).strip()
+
+
+@benchmark('split_utf8', number=2000)
+def bench_split_utf8(context):
+    from chatbot383.util import split_utf8
+
+    return lambda index: list(split_utf8(SAMPLE_TEXT, 400))
+
+
+@benchmark('bot_split_multiline', number=2000)
+def bench_split_multiline(context):
+    from chatbot383.bot import Bot
+
+    return lambda index: list(Bot.split_multiline(SAMPLE_TEXT))
+
+
+@benchmark('bot_is_text_safe', number=20000)
+def bench_is_text_safe(context):
+    bot, client = new_bot(context)
+    texts = ('@someone, Squeeeak! Hello there', SAMPLE_TEXT[:390], '!nope')
+
+    return lambda index: bot.is_text_safe(texts[index % 3], '#bench')
+
+
+@benchmark('client_tags_to_dict', number=20000)
+def bench_tags_to_dict(context):
+    from chatbot383.client import Client
+
+    tags = [
+        {'key': 'badges', 'value': 'subscriber/12,premium/1'},
+        {'key': 'color', 'value': '#1E90FF'},
+        {'key': 'display-name', 'value': 'SomeViewer'},
+        {'key': 'emotes', 'value': None},
+        {'key': 'id', 'value': 'b34ccfc7-4977-403a-8a94-33c6bac34fb8'},
+        {'key': 'mod', 'value': '0'},
+        {'key': 'room-id', 'value': '56648155'},
+        {'key': 'subscriber', 'value': '1'},
+        {'key': 'tmi-sent-ts', 'value': '1507246572675'},
+        {'key': 'user-id', 'value': '100612361'},
+    ]
+
+    return lambda index: Client.tags_to_dict(tags)
+
+
+@benchmark('bot_dispatch', number=5000)
+def bench_dispatch(context):
+    from chatbot383.features import Features, Database
+
+    bot, client = new_bot(context)
+    match_path = os.path.join(context['temp_dir'], 'matchdata.json.gz')
+    write_match_fixture(match_path)
+    config = {
+        'match_data_snapshot': match_path,
+        'hype_stats_builtin': True,
+        'hype_stats_hints': ['(?i)^(up|down|left|right|a|b|start)$'],
+        'mail_disabled_channels': [],
+    }
+    database = Database(os.path.join(context['temp_dir'], 'dispatch.db'))
+    Features(bot, 'help text', database, config)
+    texts = ('PogChamp', '!groudon', 'left', '!genmatch red vs blue',
+             'some ordinary chat line Kappa', '!hypestats', '!klappa',
+             'up', '!foodcurrent', 'a')
+
+    def dispatch(index):
+        # Unique users and channels so the limiters never skip commands
+        bot._process_message({
+            'client': client,
+            'event_type': 'pubmsg',
+            'channel': '#bench{}'.format(index),
+            'nick': 'User{}'.format(index),
+            'username': 'user{}'.format(index),
+            'text': texts[index % len(texts)],
+        }, client)
+
+    return dispatch
+
+
+@benchmark('limiter', number=20000)
+def bench_limiter(context):
+    from chatbot383.bot import Limiter
+
+    limiter = Limiter(min_interval=5)
+
+    def check_and_update(index):
+        key = 'user{}'.format(index % 700)
+
+        if limiter.is_ok(key):
+            limiter.update(key)
+
+    return check_and_update
+
+
+@benchmark('flood_detector_add', number=20000)
+def bench_flood_detector(context):
+    from chatbot383.flood import FloodDetector
+
+    detector = FloodDetector()
+    texts = (SAMPLE_TEXT, 'PogChamp', 'Kappa Kappa Kappa', 'a', SAMPLE_TEXT[:100])
+
+    return lambda index: detector.add('#bench', texts[index % len(texts)])
+
+
+@benchmark('scheduler_call_later', number=20000)
+def bench_scheduler(context):
+    from chatbot383.scheduler import Scheduler
+
+    scheduler = Scheduler()
+    timers = []
+
+    def schedule(index):
+        # Mostly short timers, cancelled like reply timeouts usually are
+        timers.append(scheduler.call_later(
+            (index % 500) * 0.7, lambda: None))
+
+        if len(timers) > 1000:
+            timers.pop(0).cancel()
+
+        if index % 100 == 0:
+            scheduler.run_pending()
+            scheduler.get_timeout()
+
+    return schedule
+
+
+@benchmark('log_debug_record', number=20000)
+def bench_log_debug_record(context):
+    import logging
+    import logging.handlers
+    from chatbot383.logsetup import BackgroundQueueHandler
+
+    # Caller side cost of a debug line like the one for each inbound item
+    record_queue = queue.SimpleQueue()
+    logger = logging.getLogger('chatbot383.benchmark.log')
+    logger.propagate = False
+    logger.setLevel(logging.DEBUG)
+    logger.addHandler(BackgroundQueueHandler(record_queue))
+    null_file = open(os.devnull, 'w')
+    listener = logging.handlers.QueueListener(
+        record_queue, logging.StreamHandler(null_file))
+    listener.start()
+    context['cleanup'].append(listener.stop)
+    context['cleanup'].append(null_file.close)
+    item = {'event_type': 'pubmsg', 'channel': '#bench', 'nick': 'User',
+            'username': 'user', 'text': SAMPLE_TEXT[:100]}
+
+    return lambda index: logger.debug(
+        'Process inbound queue item %s %s', ('127.0.0.1', 6667), item)
+
+
+@benchmark('gen_roar', number=20000)
+def bench_gen_roar(context):
+    from chatbot383.roar import gen_roar
+
+    return lambda index: gen_roar()
+
+
+@benchmark('regex_server_search', number=200)
+def bench_regex_server(context):
+    from chatbot383.regex import RegexServer
+
+    server = RegexServer()
+    pattern = re.compile(r'(?i)squ+e+a+k')
+    server.search(pattern, 'warm up')
+    context['cleanup'].append(server._stop_server)
+
+    return lambda index: server.search(pattern, SAMPLE_TEXT)
+
+
+@benchmark('database_mail', number=500)
+def bench_database(context):
+    from chatbot383.features import Database
+
+    database = Database(os.path.join(context['temp_dir'], 'mail.db'))
+
+    def put_and_get(index):
+        database.put_mail('user{}'.format(index % 50), 'Mail number {}'.format(index))
+        database.get_mail()
+
+    return put_and_get
+
+
+@benchmark('matchgen_pick_teams', number=2000)
+def bench_pick_teams(context):
+    from chatbot383.featurecomponents.matchgen import MatchGenerator
+
+    path = os.path.join(context['temp_dir'], 'matchgen.json.gz')
+    write_match_fixture(path)
+    generator = MatchGenerator(path)
+    arg_lists = (['red'], ['light', 'vs', 'heavy'], ['fire'], [])
+
+    return lambda index: generator.pick_teams(arg_lists[index % len(arg_lists)])
+
+
+def run_benchmark(func, number, repeat):
+    timings = []
+    counter = itertools.count()
+
+    for dummy in range(repeat):
+        gc.collect()
+        start_time = time.perf_counter()
+
+        for dummy in range(number):
+            func(next(counter))
+
+        timings.append((time.perf_counter() - start_time) / number)
+
+    return {
+        'number': number,
+        'repeat': repeat,
+        'best': min(timings),
+        'median': statistics.median(timings),
+    }
+
+
+def run_all(name_filter=None, repeat=5, scale=1.0):
+    results = {}
+    skipped = {}
+    temp_dir = tempfile.mkdtemp(prefix='chatbot383-bench-')
+    context = {'temp_dir': temp_dir, 'cleanup': []}
+    random.seed(383)
+
+    try:
+        for name, number, setup_func in BENCHMARKS:
+            if name_filter and not re.search(name_filter, name):
+                continue
+
+            try:
+                func = setup_func(context)
+            except ImportError as error:
+                skipped[name] = str(error)
+                continue
+
+            number = max(1, int(number * scale))
+            results[name] = run_benchmark(func, number, repeat)
+            print_result(name, results[name])
+    finally:
+        for cleanup_func in context['cleanup']:
+            cleanup_func()
+
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+    for name, reason in skipped.items():
+        print('{:24} skipped ({})'.format(name, reason))
+
+    return results
+
+
+def print_result(name, result):
+    print('{:24} {:>12.3f} us/op (median {:.3f} us, {}x{})'.format(
+        name, result['best'] * 1e6, result['median'] * 1e6,
+        result['repeat'], result['number']))
+
+
+def compare(results, baseline, threshold):
+    regressions = []
+
+    print()
+    print('{:24} {:>12} {:>12} {:>8}'.format('benchmark', 'baseline', 'current', 'change'))
+
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+
+        old = baseline[name]['best']
+        new = result['best']
+        change = (new - old) / old
+        flag = ''
+
+        if change > threshold:
+            flag = '  REGRESSION'
+            regressions.append(name)
+
+        print('{:24} {:>9.3f} us {:>9.3f} us {:>+7.1%}{}'.format(
+            name, old * 1e6, new * 1e6, change, flag))
+
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--filter', help='Regex of benchmark names to run')
+    arg_parser.add_argument('--repeat', type=int, default=5)
+    arg_parser.add_argument('--scale', type=float, default=1.0,
+                            help='Multiply the iteration counts')
+    arg_parser.add_argument('--output', help='Save results as JSON')
+    arg_parser.add_argument('--baseline', help='Compare against saved JSON')
+    arg_parser.add_argument('--threshold', type=float, default=0.1,
+                            help='Slowdown ratio reported as a regression')
+    args = arg_parser.parse_args()
+
+    results = run_all(args.filter, args.repeat, args.scale)
+
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump({
+                'python': sys.version,
+                'platform': platform.platform(),
+                'timestamp': time.time(),
+                'results': results,
+            }, file, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as file:
+            baseline = json.load(file)['results']
+
+        if compare(results, baseline, args.threshold):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,14 +1,32 @@
+import collections
 import logging
-import queue
-import random
 import re
 import itertools
-import sched
 import time
 
+from chatbot383 import metrics
+from chatbot383.flood import FloodDetector
+from chatbot383.inboundfilter import InboundFilter
+from chatbot383.membership import MembershipTracker
+from chatbot383.scheduler import Scheduler
+from chatbot383.tracing import TRACER
 from chatbot383.util import split_utf8
 
 _logger = logging.getLogger(__name__)
+_command_invocations = metrics.counter(
+    'chatbot383_command_invocations_total', 'Commands run',
+    ('command',))
+_limiter_rejections = metrics.counter(
+    'chatbot383_limiter_rejections_total',
+    'Text messages skipped by the command rate limiters', ('limiter',))
+_discarded_lines = metrics.counter(
+    'chatbot383_discarded_lines_total',
+    'Outgoing lines discarded by is_text_safe')
+_process_duration = metrics.histogram(
+    'chatbot383_process_message_seconds',
+    'Time spent processing one inbound item', ('event_type',))
+
+BATCH_SIZE = 20
 
 
 class InboundMessageSession(object):
@@ -42,35 +60,174 @@ class InboundMessageSession(object):
 
 class Bot(object):
     def __init__(self, channels, main_client, group_client, inbound_queue,
-                 ignored_users=None, silent_channels=None):
-        self._channels = channels
+                 ignored_users=None, silent_channels=None, clock=time.time,
+                 shard_bus=None, collapse_duplicates=False):
+        self._channels = tuple(channels)
         self._main_client = main_client
         self._group_client = group_client
         self._inbound_queue = inbound_queue
         self._ignored_users = frozenset(ignored_users or ())
         self._silent_channels = frozenset(silent_channels or ())
-        self._user_limiter = Limiter(min_interval=5)
-        self._channel_spam_limiter = Limiter(min_interval=1)
-        self._scheduler = sched.scheduler()
+        self._clock = clock
+        self._user_limiter = Limiter(min_interval=5, clock=clock)
+        self._channel_spam_limiter = Limiter(min_interval=1, clock=clock)
+        self._scheduler = Scheduler()
+        self._inbound_filter = InboundFilter()
+        self._shard_bus = shard_bus
+        self._flood_detector = FloodDetector(clock=clock)
+        self._membership_tracker = MembershipTracker()
+        self._collapse_duplicates = collapse_duplicates
 
         self._commands = []
         self._message_handlers = []
+        self._duplicate_skipping_handlers = set()
+        # Handlers that only want lines from some channels
+        self._handler_channels = {}
+        self._shard_calls = {}
 
         self.register_message_handler('welcome', self._join_channels)
 
         assert self._main_client.inbound_queue == inbound_queue
         assert self._group_client.inbound_queue == inbound_queue
 
+        # A plain queue.Queue, as in replays, cannot be interrupted
+        if hasattr(inbound_queue, 'wakeup'):
+            self._scheduler.wakeup = inbound_queue.wakeup
+
+        self._main_client.inbound_filter = self._inbound_filter
+        self._group_client.inbound_filter = self._inbound_filter
+        self._main_client.membership_tracker = self._membership_tracker
+        self._group_client.membership_tracker = self._membership_tracker
+        self._main_client.flood_detector = self._flood_detector
+        self._group_client.flood_detector = self._flood_detector
+
     def register_command(self, command_regex, func):
         self._commands.append((command_regex, func))
+        self._publish_interest()
+
+    def register_message_handler(self, event_type, func,
+                                 skip_duplicates=False, channels=None):
+        '''Call `func` with each session of the event type.
 
-    def register_message_handler(self, event_type, func):
+        If `channels` is given, only lines from those channels are passed,
+        and the inbound filter may drop lines from the others.
+        '''
         self._message_handlers.append((event_type, func))
 
+        if skip_duplicates:
+            self._duplicate_skipping_handlers.add(func)
+
+        if channels is not None:
+            self._handler_channels[func] = frozenset(
+                channel.lower() for channel in channels)
+
+        self._publish_interest()
+
+    def register_shard_call(self, name, func):
+        '''Let other workers run `func` through `call_on_owner`.'''
+        self._shard_calls[name] = func
+
+    def call_on_owner(self, channel, name, *args):
+        '''Run the shard call on the worker owning the channel.
+
+        The arguments must be picklable. Runs now if this worker owns it.
+        '''
+        if self._shard_bus and not self._shard_bus.owns(channel):
+            self._shard_bus.forward_call(channel, name, args)
+        else:
+            self._shard_calls[name](*args)
+
+    def handle_forwarded_item(self, item):
+        if 'call' in item:
+            func = self._shard_calls.get(item['call'])
+
+            if func:
+                func(*item['args'])
+            else:
+                _logger.warning('Unknown shard call %s', item['call'])
+        else:
+            self.send_text(item.pop('channel'), item.pop('text'), **item)
+
+    def _publish_interest(self):
+        event_types = set()
+        channel_event_types = collections.defaultdict(set)
+
+        for event_type, func in self._message_handlers:
+            channels = self._handler_channels.get(func)
+
+            if channels is None:
+                event_types.add(event_type)
+            else:
+                for channel in channels:
+                    channel_event_types[channel].add(event_type)
+
+        self._inbound_filter.publish(
+            event_types,
+            (pattern for pattern, func in self._commands),
+            self._ignored_users,
+            channel_event_types=channel_event_types
+        )
+
     @property
     def scheduler(self):
         return self._scheduler
 
+    @property
+    def inbound_filter(self):
+        return self._inbound_filter
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def channels(self):
+        return self._channels
+
+    @property
+    def ignored_users(self):
+        return self._ignored_users
+
+    @property
+    def silent_channels(self):
+        return self._silent_channels
+
+    @property
+    def flood_detector(self):
+        return self._flood_detector
+
+    @property
+    def membership_tracker(self):
+        return self._membership_tracker
+
+    def get_state(self):
+        return {
+            'user_limiter': self._user_limiter.get_state(),
+            'channel_spam_limiter': self._channel_spam_limiter.get_state(),
+        }
+
+    def set_state(self, state):
+        self._user_limiter.set_state(state.get('user_limiter', ()))
+        self._channel_spam_limiter.set_state(
+            state.get('channel_spam_limiter', ()))
+
+    def register_memory_probes(self, accountant):
+        accountant.register('bot_user_limiter', lambda: self._user_limiter)
+        accountant.register('bot_channel_limiter',
+                            lambda: self._channel_spam_limiter)
+        accountant.register('bot_flood_detector',
+                            lambda: self._flood_detector)
+        accountant.register('bot_membership',
+                            lambda: self._membership_tracker)
+
+    @property
+    def commands(self):
+        return tuple(self._commands)
+
+    @property
+    def message_handlers(self):
+        return tuple(self._message_handlers)
+
     @classmethod
     def is_group_chat(cls, channel_name):
         return channel_name.startswith('#_')
@@ -95,20 +252,29 @@ class Bot(object):
 
     def run(self):
         while True:
-            self._scheduler.run(blocking=False)
+            self._scheduler.run_pending()
+
+            # Wake up in time for the next timer
+            timeout = self._scheduler.get_timeout()
+
+            for item in self._inbound_queue.get_batch(BATCH_SIZE,
+                                                      timeout=timeout):
+                if item.get('trace'):
+                    item['trace'].mark('dequeued')
 
-            try:
-                item = self._inbound_queue.get(timeout=0.2)
-            except queue.Empty:
-                continue
-            else:
                 client = item['client']
                 _logger.debug('Process inbound queue item %s %s',
                               client.connection.server_address, item)
-                self._process_message(item, client)
+                with _process_duration.time(item['event_type']):
+                    self._process_message(item, client)
 
     def send_text(self, channel, text, me=False, reply_to=None,
                   multiline=False):
+        if self._shard_bus and not self._shard_bus.owns(channel):
+            self._shard_bus.forward(channel, text, me=me, reply_to=reply_to,
+                                    multiline=multiline)
+            return
+
         if self.is_group_chat(channel):
             client = self._group_client
         else:
@@ -124,13 +290,16 @@ class Bot(object):
 
         del text
 
+        trace = TRACER.current_trace
+
         for line in lines:
             if not self.is_text_safe(line, channel):
                 _logger.info('Discarded message %s %s',
                              ascii(channel), ascii(line))
+                _discarded_lines.inc()
                 return
 
-            client.privmsg(channel, line, action=me)
+            client.privmsg(channel, line, action=me, trace=trace)
 
     def send_whisper(self, username, text):
         pass
@@ -158,15 +327,88 @@ class Bot(object):
 
         client.join(channel)
 
+    def is_joined(self, channel):
+        '''Return whether lines sent to the channel now would be delivered.
+
+        Channels owned by another worker are left to that worker.
+        '''
+        if self._shard_bus and not self._shard_bus.owns(channel):
+            return True
+
+        if self.is_group_chat(channel):
+            return self._group_client.is_joined(channel)
+        else:
+            return self._main_client.is_joined(channel)
+
+    def part(self, channel):
+        if self.is_group_chat(channel):
+            client = self._group_client
+        else:
+            client = self._main_client
+
+        client.part(channel)
+
+    def reconfigure(self, channels=None, ignored_users=None,
+                    silent_channels=None):
+        '''Apply changed settings without reconnecting.
+
+        Only channels that were added or removed are joined or parted.
+        Arguments left as None are unchanged. Must be called on the dispatch
+        thread. Returns the channels joined and the channels parted.
+        '''
+        joined = parted = ()
+
+        if channels is not None:
+            old_channels = frozenset(self._channels)
+            new_channels = frozenset(channels)
+            joined = tuple(channel for channel in channels
+                           if channel not in old_channels)
+            parted = tuple(channel for channel in self._channels
+                           if channel not in new_channels)
+            # Replaced rather than changed so a welcome being handled sees
+            # either list
+            self._channels = tuple(channels)
+
+            for channel in parted:
+                self.part(channel)
+
+            for channel in joined:
+                self.join(channel)
+
+        if ignored_users is not None:
+            self._ignored_users = frozenset(ignored_users)
+            self._publish_interest()
+
+        if silent_channels is not None:
+            self._silent_channels = frozenset(silent_channels)
+
+        return joined, parted
+
     def _process_message(self, message, client):
         session = InboundMessageSession(message, self, client)
+        trace = message.get('trace')
 
-        self._process_message_handlers(session)
+        if trace:
+            trace.mark('handler_start')
+            TRACER.current_trace = trace
 
-        event_type = message['event_type']
+        try:
+            event_type = message['event_type']
 
-        if event_type in ('pubmsg', 'action'):
-            self._process_text_commands(session)
+            self._process_message_handlers(session)
+
+            # Lines are counted by the flood detector on the client thread;
+            # similar lines only collapse, handlers skip exact repeats only
+            if event_type in ('pubmsg', 'action') and not \
+                    (self._collapse_duplicates and message.get('duplicate')):
+                self._process_text_commands(session)
+        finally:
+            if trace:
+                TRACER.current_trace = None
+                trace.mark('handler_end')
+
+                if 'send_enqueued' not in trace.marks:
+                    trace.finish()
 
     def _process_text_commands(self, session):
         message = session.message
@@ -180,8 +422,10 @@ class Bot(object):
 
         if username != our_username:
             if not self._user_limiter.is_ok(username):
+                _limiter_rejections.inc('user')
                 return
             if not self._channel_spam_limiter.is_ok(channel):
+                _limiter_rejections.inc('channel')
                 return
 
             for pattern, command_func in self._commands:
@@ -191,14 +435,27 @@ class Bot(object):
                     self._user_limiter.update(username)
                     self._channel_spam_limiter.update(channel)
                     session.match = match
+                    _command_invocations.inc(command_func.__name__)
                     command_func(session)
                     break
 
     def _process_message_handlers(self, session):
         event_type = session.message['event_type']
+        duplicate = session.message.get('exact_duplicate')
+        channel = session.message.get('channel')
 
         for command_event_type, command_func in self._message_handlers:
             if event_type == command_event_type:
+                if duplicate and \
+                        command_func in self._duplicate_skipping_handlers:
+                    continue
+
+                handler_channels = self._handler_channels.get(command_func)
+
+                if handler_channels is not None and \
+                        channel not in handler_channels:
+                    continue
+
                 command_func(session)
 
     def _join_channels(self, session):
@@ -212,21 +469,39 @@ class Bot(object):
 
 
 class Limiter(object):
-    def __init__(self, min_interval=5):
+    def __init__(self, min_interval=5, clock=time.time):
         self._min_interval = min_interval
+        self._clock = clock
         self._table = {}
 
     def is_ok(self, key):
         if key not in self._table:
             return True
 
-        time_now = time.time()
+        time_now = self._clock()
 
         return time_now - self._table[key] > self._min_interval
 
     def update(self, key):
-        self._table[key] = time.time()
+        # Re-insert so the dict stays ordered from least to most recent
+        self._table.pop(key, None)
+        self._table[key] = self._clock()
 
         if len(self._table) > 500:
-            key = random.choice(self._table)
-            del self._table[key]
+            del self._table[next(iter(self._table))]
+
+    def __len__(self):
+        return len(self._table)
+
+    def get_state(self):
+        # Tuple keys become lists in JSON
+        return [[list(key) if isinstance(key, tuple) else key, timestamp]
+                for key, timestamp in self._table.items()]
+
+    def set_state(self, state):
+        time_now = self._clock()
+
+        for key, timestamp in state:
+            if time_now - timestamp <= self._min_interval:
+                key = tuple(key) if isinstance(key, list) else key
+                self._table[key] = timestamp
@@ -0,0 +1,71 @@
+'''Record raw inbound IRC lines so they can be replayed later.
+
+A capture is a gzip text file. Each line is the receive time, the client
+name and the raw IRC line, separated by tabs. The file is flushed every
+few seconds, so a capture is readable even if the bot is killed.
+'''
+import collections
+import gzip
+import logging
+import threading
+import time
+import zlib
+
+_logger = logging.getLogger(__name__)
+
+CAPTURE_HEADER = '#chatbot383-capture 1'
+
+CapturedLine = collections.namedtuple(
+    'CapturedLine', ['timestamp', 'client_name', 'line'])
+
+
+class CaptureWriter(object):
+    def __init__(self, path, flush_interval=5):
+        self._path = path
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+        # Appending adds a new gzip member which readers handle transparently
+        self._file = gzip.open(path, 'at', encoding='utf-8', newline='\n')
+        self._file.write(CAPTURE_HEADER + '\n')
+
+        _logger.info('Capturing inbound lines to %s', path)
+
+    def write(self, client_name, line):
+        timestamp = time.time()
+
+        with self._lock:
+            if not self._file:
+                return
+
+            self._file.write('{:.3f}\t{}\t{}\n'.format(
+                timestamp, client_name, line))
+
+            if time.monotonic() - self._last_flush > self._flush_interval:
+                self._file.flush()
+                self._last_flush = time.monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    '''Yield `CapturedLine` tuples from a capture file.'''
+    with gzip.open(path, 'rt', encoding='utf-8', newline='\n') as file:
+        try:
+            for line in file:
+                line = line.rstrip('\n')
+
+                if not line or line.startswith('#'):
+                    continue
+
+                timestamp, client_name, line = line.split('\t', 2)
+
+                yield CapturedLine(float(timestamp), client_name, line)
+        except (EOFError, zlib.error):
+            # The writer was not closed cleanly, but everything flushed
+            # before that is still usable
+            _logger.warning('Capture %s ends abruptly', path)
@@ -0,0 +1,171 @@
+import math
+import re
+import time
+
+SPARKLINE_CHARS = '▁▂▃▄▅▆▇█'
+DEFAULT_HORIZONS = (10, 60, 300)
+
+
+class BucketRing(object):
+    '''Event counts over a sliding window split into fixed time buckets.
+
+    Adding an event is amortized O(1): stale buckets are only cleared
+    when time moves past them.
+    '''
+    __slots__ = ('_bucket_seconds', '_counts', '_last_index')
+
+    def __init__(self, bucket_count, bucket_seconds=1):
+        self._bucket_seconds = bucket_seconds
+        self._counts = [0] * bucket_count
+        self._last_index = None
+
+    def add(self, timestamp, amount=1):
+        index = self._advance(timestamp)
+        self._counts[index % len(self._counts)] += amount
+
+    def _advance(self, timestamp):
+        index = int(timestamp // self._bucket_seconds)
+
+        if self._last_index is None:
+            self._last_index = index
+        elif index > self._last_index:
+            bucket_count = len(self._counts)
+
+            if index - self._last_index >= bucket_count:
+                self._counts = [0] * bucket_count
+            else:
+                for stale_index in range(self._last_index + 1, index + 1):
+                    self._counts[stale_index % bucket_count] = 0
+
+            self._last_index = index
+
+        return max(index, self._last_index)
+
+    def recent(self, timestamp, seconds):
+        '''Return the counts of the last `seconds`, oldest first.'''
+        index = self._advance(timestamp)
+        bucket_count = len(self._counts)
+        count = min(bucket_count, int(math.ceil(seconds / self._bucket_seconds)))
+
+        return [self._counts[(index - offset) % bucket_count]
+                for offset in range(count - 1, -1, -1)]
+
+    def total(self, timestamp, seconds):
+        return sum(self.recent(timestamp, seconds))
+
+
+class ChannelStats(object):
+    __slots__ = ('first_timestamp', 'lines', 'hints')
+
+    def __init__(self, timestamp, bucket_count, bucket_seconds):
+        self.first_timestamp = timestamp
+        self.lines = BucketRing(bucket_count, bucket_seconds)
+        self.hints = BucketRing(bucket_count, bucket_seconds)
+
+
+class ChatStats(object):
+    '''Per-channel chat rates computed from the inbound message stream.'''
+    def __init__(self, hint_patterns=(), horizons=DEFAULT_HORIZONS,
+                 bucket_seconds=1, graph_columns=15):
+        self._horizons = tuple(sorted(horizons))
+        self._bucket_seconds = bucket_seconds
+        self._bucket_count = int(math.ceil(self._horizons[-1] / bucket_seconds))
+        self._graph_columns = graph_columns
+        self._channels = {}
+        self._hint_regexes = tuple(
+            re.compile(pattern) for pattern in hint_patterns)
+
+    def add_message(self, channel, text, timestamp=None):
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        stats = self._channels.get(channel)
+
+        if not stats:
+            stats = self._channels[channel] = ChannelStats(
+                timestamp, self._bucket_count, self._bucket_seconds)
+
+        stats.lines.add(timestamp)
+
+        for hint_regex in self._hint_regexes:
+            if hint_regex.search(text):
+                stats.hints.add(timestamp)
+                break
+
+    def get_rates(self, channel, timestamp=None):
+        '''Return lines/sec and hints/sec for each horizon.'''
+        stats = self._channels.get(channel)
+
+        if not stats:
+            return
+
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        elapsed = max(self._bucket_seconds, timestamp - stats.first_timestamp)
+        line_rates = []
+        hint_rates = []
+
+        for horizon in self._horizons:
+            duration = min(horizon, elapsed)
+            line_rates.append(stats.lines.total(timestamp, duration) / duration)
+            hint_rates.append(stats.hints.total(timestamp, duration) / duration)
+
+        return line_rates, hint_rates
+
+    def format_lines(self, channel, timestamp=None):
+        '''Return the two lines of text shown by !hypestats.'''
+        stats = self._channels.get(channel)
+
+        if not stats:
+            return
+
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        line_rates, hint_rates = self.get_rates(channel, timestamp)
+        duration = min(self._horizons[-1], timestamp - stats.first_timestamp)
+        graph_seconds = self._bucket_count * self._bucket_seconds
+
+        text_1 = '[{duration}] Lines/sec {averages_str} ' \
+            '· Hints/sec {hint_averages_str}'.format(
+                duration=format_duration(duration),
+                averages_str=format_rates(line_rates),
+                hint_averages_str=format_rates(hint_rates),
+            )
+        text_2 = 'Chat {chat_graph} · Hint {hint_graph}'.format(
+            chat_graph=sparkline(
+                stats.lines.recent(timestamp, graph_seconds),
+                self._graph_columns),
+            hint_graph=sparkline(
+                stats.hints.recent(timestamp, graph_seconds),
+                self._graph_columns),
+        )
+
+        return text_1, text_2
+
+
+def format_duration(seconds):
+    if seconds >= 60:
+        return '{}m'.format(int(seconds // 60))
+    else:
+        return '{}s'.format(int(seconds))
+
+
+def format_rates(rates):
+    return ' '.join('{:.1f}'.format(rate) for rate in rates)
+
+
+def sparkline(counts, columns):
+    column_size = max(1, int(math.ceil(len(counts) / columns)))
+    sums = [sum(counts[index:index + column_size])
+            for index in range(0, len(counts), column_size)]
+    maximum = max(sums) if sums else 0
+
+    if not maximum:
+        return SPARKLINE_CHARS[0] * len(sums)
+
+    scale = len(SPARKLINE_CHARS) - 1
+
+    return ''.join(SPARKLINE_CHARS[int(round(value / maximum * scale))]
+                   for value in sums)
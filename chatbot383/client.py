@@ -1,7 +1,9 @@
+import collections
 import logging
 import queue
 import ssl
 import threading
+import time
 import functools
 import re
 
@@ -9,10 +11,33 @@ import irc.client
 import irc.strings
 import irc.connection
 
+from chatbot383 import metrics
+from chatbot383.coalesce import DuplicateGuard, merge
+from chatbot383.flood import LineCount
+from chatbot383.health import Backoff, ConnectionHealth
+from chatbot383.pacing import SendPacer
+from chatbot383.startup import REPORT
+from chatbot383.tracing import MessageTrace
+
 _logger = logging.getLogger(__name__)
+_inbound_events = metrics.counter(
+    'chatbot383_irc_inbound_events_total', 'IRC events received',
+    ('event_type',))
+_outbound_items = metrics.counter(
+    'chatbot383_irc_outbound_items_total', 'Outbound queue items processed',
+    ('message_type', 'result'))
+_connection_events = metrics.counter(
+    'chatbot383_irc_connection_events_total',
+    'Disconnects, stalls and reconnect requests', ('client', 'event'))
+_ping_duration = metrics.histogram(
+    'chatbot383_irc_ping_seconds', 'PING round trip time', ('client',))
 
-IRC_RATE_LIMIT = (20 - 0.5) / 30
 RECONNECT_INTERVAL = 60 * 2
+HEALTH_CHECK_INTERVAL = 5
+MEMBERSHIP_FLUSH_INTERVAL = 1
+POLL_TIMEOUT = 0.2
+MAX_PENDING = 20
+MAX_CHANNEL_PENDING = 5
 
 
 class InvalidTextError(ValueError):
@@ -20,26 +45,93 @@ class InvalidTextError(ValueError):
 
 
 class Client(irc.client.SimpleIRCClient):
-    def __init__(self, inbound_queue=None):
+    def __init__(self, inbound_queue=None, name='main', coalesce_window=None,
+                 send_share=1.0):
         super().__init__()
 
         irc.client.ServerConnection.buffer_class.errors = 'replace'
-        self.connection.set_rate_limit(IRC_RATE_LIMIT)
         self._running = True
         self._inbound_queue = inbound_queue or queue.Queue(100)
         self._outbound_queue = queue.Queue(10)
+        self._pending = collections.OrderedDict()
+        self._pending_count = 0
+        self._pacer = SendPacer(share=send_share)
+        self._coalesce_window = coalesce_window
+        self._duplicate_guard = DuplicateGuard()
+        self._health = ConnectionHealth()
+        self._backoff = Backoff(maximum=RECONNECT_INTERVAL)
+        self._reconnect_scheduled = False
+
+        self.reactor.execute_delayed(HEALTH_CHECK_INTERVAL,
+                                     self._check_health_sched)
+        self._inbound_filter = None
+        self._name = name
+        self._capture = None
+        self._membership_tracker = None
+        self._flood_detector = None
+        self._membership_changes = []
+        self._membership_flushed = time.monotonic()
+        self._joined_channels = set()
+
+    @property
+    def name(self):
+        return self._name
 
     @property
     def inbound_queue(self):
         return self._inbound_queue
 
+    @property
+    def inbound_filter(self):
+        return self._inbound_filter
+
+    @inbound_filter.setter
+    def inbound_filter(self, inbound_filter):
+        self._inbound_filter = inbound_filter
+
+    @property
+    def membership_tracker(self):
+        return self._membership_tracker
+
+    @membership_tracker.setter
+    def membership_tracker(self, membership_tracker):
+        self._membership_tracker = membership_tracker
+
+    @property
+    def flood_detector(self):
+        return self._flood_detector
+
+    @flood_detector.setter
+    def flood_detector(self, flood_detector):
+        self._flood_detector = flood_detector
+
+    @property
+    def capture(self):
+        return self._capture
+
+    @capture.setter
+    def capture(self, capture):
+        self._capture = capture
+
     @property
     def outbound_queue(self):
         return self._outbound_queue
 
+    @property
+    def pending_count(self):
+        return self._pending_count
+
+    @property
+    def pacer(self):
+        return self._pacer
+
+    def is_joined(self, channel):
+        return irc.strings.lower(channel) in self._joined_channels
+
     def _dispatcher(self, connection, event):
         # Override parent class
         _logger.debug("_dispatcher: %s", event.type)
+        _inbound_events.inc(event.type)
 
         do_nothing = lambda c, e: None
         method = getattr(self, "_on_" + event.type, do_nothing)
@@ -61,6 +153,7 @@ class Client(irc.client.SimpleIRCClient):
             0, functools.partial(self.autoconnect, *args, **kwargs))
 
     def autoconnect(self, *args, **kwargs):
+        self._reconnect_scheduled = False
         _logger.info('Connecting %s...', args[:2] or self.connection.server_address)
         try:
             if args:
@@ -69,17 +162,62 @@ class Client(irc.client.SimpleIRCClient):
                 self.connection.reconnect()
         except irc.client.ServerConnectionError:
             _logger.exception('Connect failed.')
+            _connection_events.inc(self._name, 'connect_failed')
             self._schedule_reconnect()
+        else:
+            self._health.reset()
 
     def _schedule_reconnect(self):
-        self.reactor.execute_delayed(RECONNECT_INTERVAL, self.autoconnect)
+        if self._reconnect_scheduled:
+            return
+
+        self._reconnect_scheduled = True
+        delay = self._backoff.next_delay()
+        _logger.info('Reconnecting in %.1f seconds', delay)
+        self.reactor.execute_delayed(delay, self.autoconnect)
 
     def _on_disconnect(self, connection, event):
         _logger.info('Disconnected %s!', self.connection.server_address)
+        _connection_events.inc(self._name, 'disconnect')
+
+        # Membership is unknown until the channels are joined again
+        for channel in self._joined_channels:
+            self._membership_changes.append(('drop', channel, ()))
+
+        self._joined_channels.clear()
+        self._flush_membership_changes()
 
         if self._running:
             self._schedule_reconnect()
 
+    def _on_reconnect(self, connection, event):
+        _logger.info('Server %s asked us to reconnect',
+                     self.connection.server_address)
+        _connection_events.inc(self._name, 'reconnect_request')
+        self.connection.disconnect('Reconnecting')
+
+    def _check_health_sched(self):
+        if self._running and self.connection.connected:
+            if self._health.is_stalled():
+                _logger.warning('Nothing received from %s for %.0f seconds',
+                                self.connection.server_address,
+                                self._health.get_idle_time())
+                _connection_events.inc(self._name, 'stall')
+                self.connection.disconnect('Connection stalled')
+            elif self._health.should_ping():
+                self.connection.ping(self._health.new_ping_token())
+
+        self.reactor.execute_delayed(HEALTH_CHECK_INTERVAL,
+                                     self._check_health_sched)
+
+    def _on_pong(self, connection, event):
+        token = event.arguments[-1] if event.arguments else event.target
+        rtt = self._health.on_pong(token)
+
+        if rtt is not None:
+            _logger.debug('PING round trip %s %.3f', self._name, rtt)
+            _ping_duration.observe(rtt, self._name)
+
     def stop(self):
         self._running = False
         self.reactor.disconnect_all()
@@ -87,15 +225,63 @@ class Client(irc.client.SimpleIRCClient):
     def process(self):
         self._process_outbound_messages()
 
-        self.reactor.process_once(0.2)
+        self.reactor.process_once(self._get_poll_timeout())
+
+        if self._membership_changes and time.monotonic() - \
+                self._membership_flushed > MEMBERSHIP_FLUSH_INTERVAL:
+            self._flush_membership_changes()
+
+    def _flush_membership_changes(self):
+        changes = self._membership_changes
+        self._membership_changes = []
+        self._membership_flushed = time.monotonic()
+
+        if self._membership_tracker is not None:
+            self._membership_tracker.apply(changes)
+
+    def _on_join(self, connection, event):
+        channel = irc.strings.lower(event.target)
+        username = irc.strings.lower(event.source.nick)
+
+        if username == self.get_nickname(lower=True):
+            self._joined_channels.add(channel)
+            REPORT.mark('{}_joined'.format(self._name))
+
+        self._membership_changes.append(('join', channel, (username,)))
+
+    def _on_part(self, connection, event):
+        channel = irc.strings.lower(event.target)
+        username = irc.strings.lower(event.source.nick)
+
+        if username == self.get_nickname(lower=True):
+            self._joined_channels.discard(channel)
+            self._membership_changes.append(('drop', channel, ()))
+        else:
+            self._membership_changes.append(('part', channel, (username,)))
+
+    def _on_namreply(self, connection, event):
+        # Arguments are the channel type, the channel and the names
+        channel = irc.strings.lower(event.arguments[1])
+        usernames = [irc.strings.lower(name.lstrip('@+'))
+                     for name in event.arguments[2].split()]
+
+        self._membership_changes.append(('join', channel, usernames))
 
     @classmethod
     def validate_text(cls, text):
         if re.search(r'[\x00-\x1f]', text):
             raise InvalidTextError('Forbidden control characters')
 
+    def _on_all_raw_messages(self, connection, event):
+        self._health.on_receive()
+
+        if self._capture:
+            self._capture.write(self._name, event.arguments[0])
+
     def _on_welcome(self, connection, event):
         _logger.info('Logged in to server %s.', self.connection.server_address)
+        self._backoff.reset()
+        REPORT.mark('{}_welcome'.format(self._name))
         self.connection.cap('REQ', 'twitch.tv/membership')
         self.connection.cap('REQ', 'twitch.tv/commands')
         self.connection.cap('REQ', 'twitch.tv/tags')
@@ -106,14 +292,23 @@ class Client(irc.client.SimpleIRCClient):
         })
 
     def _on_pubmsg(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = self.tags_to_dict(event.tags).get('display-name') or event.source.nick
+        received = time.perf_counter()
         username = irc.strings.lower(event.source.nick)
 
         if not event.arguments:
             return
 
         text = event.arguments[0]
+        channel = irc.strings.lower(event.target)
+
+        # Counted before filtering so floods of unwanted lines show up
+        line_count = self._count_line(channel, text)
+
+        if not self._accept_text('pubmsg', channel, username, text):
+            return
+
+        tags = self.tags_to_dict(event.tags)
+        nick = tags.get('display-name') or event.source.nick
 
         self._inbound_queue.put({
             'client': self,
@@ -121,18 +316,31 @@ class Client(irc.client.SimpleIRCClient):
             'channel': channel,
             'nick': nick,
             'username': username,
-            'text': text
+            'text': text,
+            'trace': self._new_trace(received, tags, channel, username),
+            'repeat_count': line_count.count,
+            'duplicate': line_count.count > 1,
+            'exact_duplicate': line_count.exact_repeat,
         })
 
     def _on_action(self, connection, event):
-        channel = irc.strings.lower(event.target)
-        nick = self.tags_to_dict(event.tags).get('display-name') or event.source.nick
+        received = time.perf_counter()
         username = irc.strings.lower(event.source.nick)
 
         if not event.arguments:
             return
 
         text = event.arguments[0]
+        channel = irc.strings.lower(event.target)
+
+        # Counted before filtering so floods of unwanted lines show up
+        line_count = self._count_line(channel, text)
+
+        if not self._accept_text('action', channel, username, text):
+            return
+
+        tags = self.tags_to_dict(event.tags)
+        nick = tags.get('display-name') or event.source.nick
 
         self._inbound_queue.put({
             'client': self,
@@ -140,9 +348,48 @@ class Client(irc.client.SimpleIRCClient):
             'channel': channel,
             'nick': nick,
             'username': username,
-            'text': text
+            'text': text,
+            'trace': self._new_trace(received, tags, channel, username),
+            'repeat_count': line_count.count,
+            'duplicate': line_count.count > 1,
+            'exact_duplicate': line_count.exact_repeat,
         })
 
+    def _count_line(self, channel, text):
+        if self._flood_detector is None:
+            return LineCount(1, False)
+
+        return self._flood_detector.add(channel, text)
+
+    def _accept_text(self, event_type, channel, username, text):
+        if not self._inbound_filter:
+            return True
+
+        return self._inbound_filter.accept(
+            event_type, channel, username, text,
+            self.get_nickname(lower=True))
+
+    @classmethod
+    def _new_trace(cls, received, tags, channel, username):
+        server_timestamp = tags.get('tmi-sent-ts')
+
+        if server_timestamp:
+            try:
+                server_timestamp = int(server_timestamp) / 1000
+            except ValueError:
+                server_timestamp = None
+
+        return MessageTrace(received, server_timestamp,
+                            '{} {}'.format(channel, username))
+
+    def _on_userstate(self, connection, event):
+        channel = irc.strings.lower(event.target)
+        self._pacer.update_user_state(channel, self.tags_to_dict(event.tags))
+
+    def _on_roomstate(self, connection, event):
+        channel = irc.strings.lower(event.target)
+        self._pacer.update_room_state(channel, self.tags_to_dict(event.tags))
+
     def _on_pubnotice(self, connection, event):
         channel = irc.strings.lower(event.target)
         text = event.arguments[0]
@@ -181,57 +428,148 @@ class Client(irc.client.SimpleIRCClient):
         })
 
     def _process_outbound_messages(self):
-        for dummy in range(5):
+        self._fill_pending()
+
+        for key in tuple(self._pending):
+            items = self._pending[key]
+
+            if self._get_item_delay(key, items[0]) > 0:
+                continue
+
+            item = items.popleft()
+            self._pending_count -= 1
+
+            if not items:
+                del self._pending[key]
+
+            self._send_item(item)
+
+    def _fill_pending(self):
+        # Items stay in the bounded outbound queue while too many are waiting
+        # so senders still get back pressure
+        while self._pending_count < MAX_PENDING:
             try:
                 item = self._outbound_queue.get_nowait()
             except queue.Empty:
                 break
 
-            if not self.connection.connected:
-                _logger.error('Not connected. Dropping output item %s', item)
-                return
-
-            _logger.debug('Process outbound queue item %s %s',
-                          item, self.connection.server_address)
+            if item['message_type'] == 'privmsg':
+                key = item['target']
+            else:
+                key = None
 
-            outbound_message_type = item['message_type']
+            items = self._pending.setdefault(key, collections.deque())
 
-            if outbound_message_type == 'privmsg':
-                target = item['target']
-                text = item['text']
+            if key and items and self._coalesce_window is not None:
+                merged = merge(items[-1], item)
 
-                try:
-                    self.validate_text(target)
-                    self.validate_text(text)
-                except InvalidTextError:
-                    _logger.exception('Skipping messages')
+                if merged:
+                    items[-1] = merged
                     continue
 
-                if item['format_action']:
-                    self.connection.action(target, text)
-                else:
-                    self.connection.privmsg(target, text)
+            if key and len(items) >= MAX_CHANNEL_PENDING:
+                dropped_item = items.popleft()
+                _logger.info('Too many lines waiting for %s. Dropping %s',
+                             key, dropped_item)
+                self._drop_item(dropped_item, 'dropped')
+                self._pending_count -= 1
+
+            item['queued_time'] = time.monotonic()
+            items.append(item)
+            self._pending_count += 1
+
+    def _get_item_delay(self, key, item):
+        if key and self._coalesce_window:
+            # Hold new lines briefly so replies arriving together share a line
+            return max(self._pacer.get_send_delay(key),
+                       item['queued_time'] + self._coalesce_window -
+                       time.monotonic())
+        elif key:
+            return self._pacer.get_send_delay(key)
+        elif item['message_type'] == 'join':
+            return self._pacer.get_join_delay()
+        else:
+            return 0
+
+    def _get_poll_timeout(self):
+        timeout = POLL_TIMEOUT
+
+        for key, items in self._pending.items():
+            timeout = min(timeout, self._get_item_delay(key, items[0]))
+
+        return max(0, timeout)
 
-            elif outbound_message_type == 'join':
-                _logger.info('Join %s', item['channel'])
-                self.connection.join(item['channel'])
+    def _send_item(self, item):
+        outbound_message_type = item['message_type']
 
-            elif outbound_message_type == 'part':
-                _logger.info('Part %s', item['channel'])
-                self.connection.part(item['channel'])
+        if not self.connection.connected:
+            _logger.error('Not connected. Dropping output item %s', item)
+            self._drop_item(item, 'not_connected')
+            return
+
+        _logger.debug('Process outbound queue item %s %s',
+                      item, self.connection.server_address)
+
+        if outbound_message_type == 'privmsg':
+            target = item['target']
+            text = self._duplicate_guard.vary(target, item['text'])
+
+            try:
+                self.validate_text(target)
+                self.validate_text(text)
+            except InvalidTextError:
+                _logger.exception('Skipping messages')
+                self._drop_item(item, 'invalid')
+                return
 
+            if item['format_action']:
+                self.connection.action(target, text)
             else:
-                raise ValueError('Unknown message type {}'
-                                 .format(outbound_message_type))
+                self.connection.privmsg(target, text)
 
-            self.reactor.process_once(0.01)
+            self._pacer.record_send(target)
+
+            for trace in self._get_item_traces(item):
+                trace.mark_sent()
+
+        elif outbound_message_type == 'join':
+            _logger.info('Join %s', item['channel'])
+            self.connection.join(item['channel'])
+            self._pacer.record_join()
+
+        elif outbound_message_type == 'part':
+            _logger.info('Part %s', item['channel'])
+            self.connection.part(item['channel'])
+            self._pacer.forget_channel(item['channel'])
+
+        else:
+            raise ValueError('Unknown message type {}'
+                             .format(outbound_message_type))
+
+        _outbound_items.inc(outbound_message_type, 'sent')
+
+    @classmethod
+    def _get_item_traces(cls, item):
+        # Merged lines carry the traces of every reply in them
+        return [trace for trace in item.get('traces', (item.get('trace'),))
+                if trace]
+
+    def _drop_item(self, item, result):
+        _outbound_items.inc(item['message_type'], result)
+
+        for trace in self._get_item_traces(item):
+            trace.mark_dropped()
+
+    def privmsg(self, target, text, action=False, trace=None):
+        if trace:
+            trace.mark('send_enqueued')
 
-    def privmsg(self, target, text, action=False):
         self._outbound_queue.put({
             'message_type': 'privmsg',
             'target': target,
             'text': text,
-            'format_action': action
+            'format_action': action,
+            'trace': trace,
         })
 
     def join(self, channel):
@@ -262,7 +600,7 @@ class Client(irc.client.SimpleIRCClient):
 
 class ClientThread(threading.Thread):
     def __init__(self, client):
-        super().__init__()
+        super().__init__(name='ClientThread')
         self.daemon = True
         self._client = client
         self._running = False
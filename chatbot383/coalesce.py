@@ -0,0 +1,64 @@
+'''Merge waiting chat lines and keep repeated lines distinct.'''
+import collections
+
+# Same limits as Bot.is_text_safe
+MAX_LENGTH = 400
+MAX_BYTES = 450
+SEPARATOR = ' · '
+# Twitch drops a line identical to the previous one. This invisible suffix
+# makes it differ without changing what viewers see.
+DUPLICATE_SUFFIX = ' \U000E0000'
+
+
+def fits(text, max_length=MAX_LENGTH, max_bytes=MAX_BYTES):
+    return len(text) <= max_length and \
+        len(text.encode('utf-8', 'replace')) <= max_bytes
+
+
+def merge(first, second):
+    '''Return an item that sends both lines as one, or None.
+
+    Lines are only merged while the combined text stays within the length
+    limits; otherwise they keep separate lines.
+    '''
+    if first['message_type'] != 'privmsg' or \
+            second['message_type'] != 'privmsg' or \
+            first['target'] != second['target'] or \
+            first['format_action'] != second['format_action']:
+        return None
+
+    text = first['text'] + SEPARATOR + second['text']
+
+    if not fits(text):
+        return None
+
+    merged = dict(first)
+    merged['text'] = text
+    merged['traces'] = first.get('traces', [first.get('trace')]) + \
+        [second.get('trace')]
+
+    return merged
+
+
+class DuplicateGuard(object):
+    '''Alternate a suffix on lines that repeat the previous line.'''
+    def __init__(self, max_channels=500):
+        self._max_channels = max_channels
+        self._last_lines = collections.OrderedDict()
+
+    def vary(self, channel, text):
+        last_text, varied = self._last_lines.pop(channel, (None, False))
+
+        if text == last_text and not varied and fits(text + DUPLICATE_SUFFIX):
+            result = text + DUPLICATE_SUFFIX
+            varied = True
+        else:
+            result = text
+            varied = False
+
+        self._last_lines[channel] = (text, varied)
+
+        if len(self._last_lines) > self._max_channels:
+            self._last_lines.popitem(last=False)
+
+        return result
@@ -0,0 +1,95 @@
+'''Local control interface on a Unix socket.
+
+Each connection sends one command per line, such as ``reload`` or
+``join #channel``, and gets one line back starting with ``ok`` or
+``error``. For example::
+
+    echo reload | socat - UNIX-CONNECT:control.sock
+'''
+import logging
+import os
+import socketserver
+import threading
+
+_logger = logging.getLogger(__name__)
+
+
+class ControlError(Exception):
+    pass
+
+
+class _ControlRequestHandler(socketserver.StreamRequestHandler):
+    handler = None
+
+    def handle(self):
+        for line in self.rfile:
+            line = line.decode('utf-8', 'replace').strip()
+
+            if not line:
+                continue
+
+            command, dummy, argument = line.partition(' ')
+            _logger.info('Control command %s', line)
+
+            try:
+                reply = 'ok {}'.format(
+                    self.handler(command, argument.strip()) or '').rstrip()
+            except ControlError as error:
+                reply = 'error {}'.format(error)
+            except Exception as error:
+                _logger.exception('Control command %s failed', line)
+                reply = 'error {}'.format(error)
+
+            self.wfile.write(reply.encode('utf-8') + b'\n')
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class ControlServer(threading.Thread):
+    '''Call `handler(command, argument)` for each line sent to the socket.
+
+    The handler returns the reply text or raises `ControlError`.
+    '''
+    def __init__(self, path, handler):
+        super().__init__()
+        self.daemon = True
+        self.name = 'ControlServer'
+        self._path = path
+
+        if os.path.exists(path):
+            # Left behind by a previous run
+            os.unlink(path)
+
+        handler_class = type('ControlRequestHandler',
+                             (_ControlRequestHandler,),
+                             {'handler': staticmethod(handler)})
+        self._server = _ThreadingUnixServer(path, handler_class)
+        os.chmod(path, 0o600)
+        self._stopped = False
+
+    @property
+    def path(self):
+        return self._path
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        if self._stopped:
+            return
+
+        self._stopped = True
+
+        # shutdown() waits for serve_forever, which never ran if not started
+        if self.is_alive():
+            self._server.shutdown()
+
+        self._server.server_close()
+
+        try:
+            os.unlink(self._path)
+        except OSError:
+            pass
@@ -0,0 +1,433 @@
+'''Local stand-in for the Twitch IRC server.
+
+Speaks enough of the Twitch dialect for the bot: capability requests,
+tagged PRIVMSG, CLEARCHAT, WHISPER, channel NOTICE, ROOMSTATE, USERSTATE
+and RECONNECT. Send, join and duplicate line limits are enforced like
+Twitch does, by dropping the excess and answering with a NOTICE.
+'''
+import argparse
+import collections
+import itertools
+import logging
+import queue
+import socketserver
+import threading
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+SERVER_NAME = 'tmi.twitch.tv'
+SEND_LIMIT = (20, 30)
+MODERATOR_SEND_LIMIT = (100, 30)
+JOIN_LIMIT = (20, 10)
+DUPLICATE_WINDOW = 30
+
+ReceivedMessage = collections.namedtuple(
+    'ReceivedMessage', ['timestamp', 'username', 'channel', 'text'])
+
+
+class SlidingWindow(object):
+    def __init__(self, period):
+        self._period = period
+        self._timestamps = collections.deque()
+
+    def count(self, time_now):
+        while self._timestamps and \
+                self._timestamps[0] <= time_now - self._period:
+            self._timestamps.popleft()
+
+        return len(self._timestamps)
+
+    def add(self, time_now):
+        self._timestamps.append(time_now)
+
+
+def format_tags(tags):
+    return '@' + ';'.join(
+        '{}={}'.format(key, escape_tag_value(value))
+        for key, value in tags.items())
+
+
+def escape_tag_value(value):
+    return str(value).replace('\\', '\\\\').replace(';', '\\:')\
+        .replace(' ', '\\s').replace('\r', '\\r').replace('\n', '\\n')
+
+
+def user_prefix(username):
+    return '{0}!{0}@{0}.{1}'.format(username, SERVER_NAME)
+
+
+class FakeTwitchSession(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        self.username = None
+        self.capabilities = set()
+        self.channels = set()
+        self.send_window = SlidingWindow(SEND_LIMIT[1])
+        self.join_window = SlidingWindow(JOIN_LIMIT[1])
+        self.last_channel_send = {}
+        self.last_channel_text = {}
+        self._write_lock = threading.Lock()
+        self._quit = False
+
+    def send_line(self, line):
+        if self.server.stalled:
+            return
+
+        with self._write_lock:
+            try:
+                self.wfile.write(line.encode('utf-8') + b'\r\n')
+            except (OSError, ValueError):
+                pass
+
+    def send_server_line(self, command, *params, tags=None):
+        line = ':{} {}'.format(SERVER_NAME, ' '.join((command,) + params))
+
+        if tags and 'twitch.tv/tags' in self.capabilities:
+            line = '{} {}'.format(format_tags(tags), line)
+
+        self.send_line(line)
+
+    def handle(self):
+        self.server.add_session(self)
+
+        try:
+            for raw_line in self.rfile:
+                line = raw_line.decode('utf-8', 'replace').rstrip('\r\n')
+
+                if line:
+                    self._handle_line(line)
+
+                if self._quit:
+                    break
+        except (OSError, ValueError):
+            pass
+        finally:
+            self.server.remove_session(self)
+
+    def _handle_line(self, line):
+        if line.startswith('@'):
+            line = line.split(' ', 1)[1]
+
+        if ' :' in line:
+            params, trailing = line.split(' :', 1)
+            params = params.split() + [trailing]
+        else:
+            params = line.split()
+
+        command = params.pop(0).upper()
+        handler = getattr(self, '_on_' + command.lower(), None)
+
+        if handler:
+            handler(params)
+
+    def _on_pass(self, params):
+        pass
+
+    def _on_nick(self, params):
+        self.username = params[0].lower()
+
+        for number, text in (('001', 'Welcome, GLHF!'),
+                             ('002', 'Your host is ' + SERVER_NAME),
+                             ('003', 'This server is rather new'),
+                             ('004', '-'),
+                             ('375', '-'),
+                             ('372', 'You are in a maze of twisty passages.'),
+                             ('376', '>')):
+            self.send_server_line(number, self.username, ':' + text)
+
+    def _on_user(self, params):
+        pass
+
+    def _on_cap(self, params):
+        if params[0].upper() == 'REQ':
+            requested = params[-1].split()
+            self.capabilities.update(requested)
+            self.send_server_line('CAP', '*', 'ACK', ':' + ' '.join(requested))
+        elif params[0].upper() == 'LS':
+            self.send_server_line(
+                'CAP', '*', 'LS',
+                ':twitch.tv/membership twitch.tv/tags twitch.tv/commands')
+
+    def _on_ping(self, params):
+        self.send_server_line('PONG', SERVER_NAME, ':' + (params[-1] if params else ''))
+
+    def _on_join(self, params):
+        for channel in params[0].split(','):
+            channel = channel.lower()
+            time_now = time.monotonic()
+
+            if self.join_window.count(time_now) >= JOIN_LIMIT[0]:
+                self.server.count_rejected('join')
+                continue
+
+            self.join_window.add(time_now)
+            self.channels.add(channel)
+            self.server.join(self, channel)
+
+    def _on_part(self, params):
+        for channel in params[0].split(','):
+            channel = channel.lower()
+            self.channels.discard(channel)
+            self.server.part(self, channel)
+
+    def _on_privmsg(self, params):
+        channel = params[0].lower()
+        text = params[1] if len(params) > 1 else ''
+        time_now = time.monotonic()
+        is_moderator = self.server.is_moderator(channel, self.username)
+
+        if is_moderator:
+            limit = MODERATOR_SEND_LIMIT[0]
+        else:
+            limit = SEND_LIMIT[0]
+
+        if self.send_window.count(time_now) >= limit:
+            self.server.count_rejected('rate_limit')
+            self._send_notice(channel, 'msg_ratelimit',
+                              'Your message was not sent because you are '
+                              'sending messages too quickly.')
+            return
+
+        slow_seconds = self.server.get_slow(channel)
+        last_send = self.last_channel_send.get(channel)
+
+        if not is_moderator and slow_seconds and last_send and \
+                time_now - last_send < slow_seconds:
+            self.server.count_rejected('slow_mode')
+            self._send_notice(channel, 'msg_slowmode',
+                              'This room is in slow mode.')
+            return
+
+        last_text, last_text_time = self.last_channel_text.get(channel, (None, 0))
+
+        if not is_moderator and text == last_text and \
+                time_now - last_text_time < DUPLICATE_WINDOW:
+            self.server.count_rejected('duplicate')
+            self._send_notice(channel, 'msg_duplicate',
+                              'Your message was not sent because it is '
+                              'identical to the previous one you sent, '
+                              'less than 30 seconds ago.')
+            return
+
+        self.send_window.add(time_now)
+        self.last_channel_send[channel] = time_now
+        self.last_channel_text[channel] = (text, time_now)
+        self.server.receive_privmsg(self, channel, text)
+
+    def _send_notice(self, channel, msg_id, text):
+        self.send_server_line('NOTICE', channel, ':' + text,
+                              tags={'msg-id': msg_id})
+
+    def _on_quit(self, params):
+        self._quit = True
+
+
+class FakeTwitchServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0)):
+        super().__init__(address, FakeTwitchSession)
+        self._lock = threading.Lock()
+        self._sessions = set()
+        self._channels = collections.defaultdict(set)
+        self._moderators = set()
+        self._slow_channels = {}
+        self._message_ids = itertools.count(1)
+        self._thread = None
+        self.received = queue.Queue()
+        self.rejected_counts = collections.Counter()
+        self.stalled = False
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever,
+                                        name='FakeTwitchServer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def add_session(self, session):
+        with self._lock:
+            self._sessions.add(session)
+
+    def remove_session(self, session):
+        with self._lock:
+            self._sessions.discard(session)
+
+            for members in self._channels.values():
+                members.discard(session)
+
+    def count_rejected(self, reason):
+        with self._lock:
+            self.rejected_counts[reason] += 1
+
+    def set_moderator(self, channel, username, moderator=True):
+        if moderator:
+            self._moderators.add((channel, username))
+        else:
+            self._moderators.discard((channel, username))
+
+    def is_moderator(self, channel, username):
+        return (channel, username) in self._moderators
+
+    def set_slow(self, channel, seconds):
+        self._slow_channels[channel] = seconds
+
+        for session in self.get_channel_sessions(channel):
+            self._send_roomstate(session, channel)
+
+    def get_slow(self, channel):
+        return self._slow_channels.get(channel, 0)
+
+    def get_channel_sessions(self, channel):
+        with self._lock:
+            return tuple(self._channels.get(channel, ()))
+
+    def get_joined_channels(self, username):
+        with self._lock:
+            return set(
+                channel for channel, members in self._channels.items()
+                if any(session.username == username for session in members))
+
+    def join(self, session, channel):
+        with self._lock:
+            self._channels[channel].add(session)
+
+        session.send_line(':{} JOIN {}'.format(user_prefix(session.username), channel))
+        session.send_server_line('353', session.username, '=', channel,
+                                 ':' + session.username)
+        session.send_server_line('366', session.username, channel,
+                                 ':End of /NAMES list')
+        self._send_roomstate(session, channel)
+        session.send_server_line('USERSTATE', channel, tags={
+            'badges': 'moderator/1' if self.is_moderator(channel, session.username) else '',
+            'display-name': session.username,
+            'mod': int(self.is_moderator(channel, session.username)),
+            'user-type': 'mod' if self.is_moderator(channel, session.username) else '',
+        })
+
+    def _send_roomstate(self, session, channel):
+        session.send_server_line('ROOMSTATE', channel, tags={
+            'emote-only': 0,
+            'followers-only': -1,
+            'r9k': 0,
+            'slow': self.get_slow(channel),
+            'subs-only': 0,
+        })
+
+    def part(self, session, channel):
+        with self._lock:
+            self._channels[channel].discard(session)
+
+        session.send_line(':{} PART {}'.format(user_prefix(session.username), channel))
+
+    def receive_privmsg(self, session, channel, text):
+        self.received.put(ReceivedMessage(
+            time.monotonic(), session.username, channel, text))
+
+        for other_session in self.get_channel_sessions(channel):
+            if other_session is not session:
+                self._send_privmsg(other_session, channel, session.username,
+                                   session.username, text)
+
+    def _send_privmsg(self, session, channel, username, nick, text):
+        session.send_line('{} :{} PRIVMSG {} :{}'.format(
+            format_tags({
+                'badges': '',
+                'color': '',
+                'display-name': nick,
+                'emotes': '',
+                'id': str(uuid.uuid4()),
+                'mod': 0,
+                'room-id': 1,
+                'subscriber': 0,
+                'tmi-sent-ts': int(time.time() * 1000),
+                'turbo': 0,
+                'user-id': next(self._message_ids),
+                'user-type': '',
+            }) if 'twitch.tv/tags' in session.capabilities else '',
+            user_prefix(username), channel, text).lstrip())
+
+    def send_privmsg(self, channel, nick, text):
+        '''Send a chat line from a viewer to everyone in the channel.'''
+        for session in self.get_channel_sessions(channel):
+            self._send_privmsg(session, channel, nick.lower(), nick, text)
+
+    def send_action(self, channel, nick, text):
+        self.send_privmsg(channel, nick, '\x01ACTION {}\x01'.format(text))
+
+    def send_join(self, channel, nick):
+        for session in self.get_channel_sessions(channel):
+            session.send_line(':{} JOIN {}'.format(
+                user_prefix(nick.lower()), channel))
+
+    def send_part(self, channel, nick):
+        for session in self.get_channel_sessions(channel):
+            session.send_line(':{} PART {}'.format(
+                user_prefix(nick.lower()), channel))
+
+    def send_names(self, channel, nicks):
+        for session in self.get_channel_sessions(channel):
+            session.send_server_line(
+                '353', session.username, '=', channel,
+                ':' + ' '.join(nick.lower() for nick in nicks))
+            session.send_server_line('366', session.username, channel,
+                                     ':End of /NAMES list')
+
+    def send_clearchat(self, channel, nick=None):
+        for session in self.get_channel_sessions(channel):
+            if nick:
+                session.send_server_line('CLEARCHAT', channel, ':' + nick.lower())
+            else:
+                session.send_server_line('CLEARCHAT', channel)
+
+    def send_pubnotice(self, channel, text, msg_id='host_on'):
+        for session in self.get_channel_sessions(channel):
+            session.send_server_line('NOTICE', channel, ':' + text,
+                                     tags={'msg-id': msg_id})
+
+    def send_whisper(self, username, nick, text):
+        with self._lock:
+            sessions = tuple(session for session in self._sessions
+                             if session.username == username)
+
+        for session in sessions:
+            session.send_line(':{} WHISPER {} :{}'.format(
+                user_prefix(nick.lower()), username, text))
+
+    def set_stalled(self, stalled):
+        '''Stop sending anything, like a half-open connection.'''
+        self.stalled = stalled
+
+    def send_reconnect(self):
+        with self._lock:
+            sessions = tuple(self._sessions)
+
+        for session in sessions:
+            session.send_server_line('RECONNECT')
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=6667)
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    server = FakeTwitchServer((args.host, args.port))
+    _logger.info('Listening on %s:%s', args.host, server.port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,8 @@
+import collections
+import gzip
+import json
 import random
 import sqlite3
-import collections
 
 import sys
 
@@ -53,17 +55,122 @@ VERSUS = (
 )
 
 
+SNAPSHOT_FORMAT = 'chatbot383-matchgen'
+SNAPSHOT_VERSION = 1
+SQLITE_HEADER = b'SQLite format 3\x00'
+MAX_POKEMON_ID = 493
+# DB has weight in kg * 10
+LIGHT_WEIGHT_LIMIT = 1102
+HEAVY_WEIGHT_LIMIT = 3307
+
+
 PokemonInfo = collections.namedtuple('PokemonInfo', ['id', 'name', 'weight'])
+PokemonRecord = collections.namedtuple(
+    'PokemonRecord', ['id', 'name', 'weight', 'color', 'types'])
 
 
 class MatchError(ValueError):
     pass
 
 
+class SnapshotError(ValueError):
+    pass
+
+
+def read_veekun_database(db_path):
+    con = sqlite3.connect(db_path)
+
+    try:
+        rows = con.execute('''SELECT
+            pokemon.id,
+            pokemon_species_names.name,
+            pokemon.weight,
+            pokemon_colors.identifier,
+            types.identifier
+            FROM pokemon
+            JOIN pokemon_species_names ON pokemon.id == pokemon_species_names.pokemon_species_id AND
+                pokemon_species_names.local_language_id = 9
+            JOIN pokemon_species ON pokemon.id == pokemon_species.id
+            JOIN pokemon_colors ON
+                pokemon_species.color_id == pokemon_colors.id
+            JOIN pokemon_types ON pokemon.id = pokemon_types.pokemon_id
+            JOIN types ON pokemon_types.type_id = types.id
+            WHERE pokemon.id <= ?
+            ORDER BY pokemon.id, pokemon_types.slot
+            ''', (MAX_POKEMON_ID,)).fetchall()
+    finally:
+        con.close()
+
+    records = collections.OrderedDict()
+
+    for pokemon_id, name, weight, color, type_ in rows:
+        if pokemon_id not in records:
+            records[pokemon_id] = PokemonRecord(
+                pokemon_id, name, weight, color, [])
+
+        records[pokemon_id].types.append(type_)
+
+    return [record._replace(types=tuple(record.types))
+            for record in records.values()]
+
+
+def write_snapshot(records, snapshot_path):
+    doc = {
+        'format': SNAPSHOT_FORMAT,
+        'version': SNAPSHOT_VERSION,
+        'pokemon': [
+            [record.id, record.name, record.weight, record.color,
+             list(record.types)]
+            for record in records
+        ]
+    }
+
+    with gzip.open(snapshot_path, 'wt', encoding='utf-8') as file:
+        json.dump(doc, file, ensure_ascii=False, separators=(',', ':'))
+
+
+def read_snapshot(snapshot_path):
+    try:
+        with gzip.open(snapshot_path, 'rt', encoding='utf-8') as file:
+            doc = json.load(file)
+    except (OSError, ValueError) as error:
+        raise SnapshotError('Unreadable snapshot {}'.format(snapshot_path)) \
+            from error
+
+    if doc.get('format') != SNAPSHOT_FORMAT:
+        raise SnapshotError('Not a match data snapshot')
+
+    if doc.get('version') != SNAPSHOT_VERSION:
+        raise SnapshotError('Unsupported snapshot version {}'
+                            .format(doc.get('version')))
+
+    return [
+        PokemonRecord(pokemon_id, name, weight, color, tuple(types))
+        for pokemon_id, name, weight, color, types in doc['pokemon']
+    ]
+
+
+def export_snapshot(db_path, snapshot_path):
+    records = read_veekun_database(db_path)
+    write_snapshot(records, snapshot_path)
+    return len(records)
+
+
+def is_sqlite_file(path):
+    with open(path, 'rb') as file:
+        return file.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+
+
 class MatchGenerator(object):
-    def __init__(self, db_path):
-        self._path = db_path
-        self._con = sqlite3.connect(db_path)
+    def __init__(self, path):
+        # Accepts either a snapshot from export_snapshot() or the full
+        # Veekun database. The database is only read once and then closed.
+        self._path = path
+
+        if is_sqlite_file(path):
+            self._records = read_veekun_database(path)
+        else:
+            self._records = read_snapshot(path)
 
     def get_match_string(self, args):
         blue_team, red_team = self.pick_teams(args)
@@ -140,56 +247,40 @@ class MatchGenerator(object):
 
     def pick_three(self, color=None, weight=None, weight_sort='light-to-heavy',
                    type_=None, not_ids=None):
-        query = '''SELECT
-            pokemon.id,
-            pokemon_species_names.name,
-            pokemon.weight
-            FROM pokemon
-            JOIN pokemon_species_names ON pokemon.id == pokemon_species_names.pokemon_species_id AND
-                pokemon_species_names.local_language_id = 9
-            JOIN pokemon_species ON pokemon.id == pokemon_species.id
-            JOIN pokemon_colors ON
-                pokemon_species.color_id == pokemon_colors.id
-            JOIN pokemon_types ON pokemon.id = pokemon_types.pokemon_id
-            JOIN types ON pokemon_types.type_id = types.id
-            WHERE pokemon.id <= 493
-            '''
+        if type_ in ('normal', 'fairy'):
+            wanted_types = frozenset(['normal', 'fairy'])
+        elif type_:
+            wanted_types = frozenset([type_])
+        else:
+            wanted_types = None
 
-        args = []
+        if not_ids:
+            assert len(not_ids) == 3
+
+        not_ids = frozenset(not_ids or ())
+        results = []
 
-        if color:
-            query += ''' AND pokemon_colors.identifier = ?'''
-            args.append(color)
+        for record in self._records:
+            if color and record.color != color:
+                continue
 
-        if weight:
-            # DB has weight in kg * 10
             if weight == 'light':
-                query += ''' AND pokemon.weight < 1102'''
+                if record.weight >= LIGHT_WEIGHT_LIMIT:
+                    continue
             elif weight == 'medium':
-                query += ''' AND pokemon.weight >= 1102
-                AND pokemon.weight < 3307'''
-            else:
-                query += ''' AND pokemon.weight >= 3307'''
+                if not LIGHT_WEIGHT_LIMIT <= record.weight < HEAVY_WEIGHT_LIMIT:
+                    continue
+            elif weight:
+                if record.weight < HEAVY_WEIGHT_LIMIT:
+                    continue
 
-        if type_:
-            if type_ in ('normal', 'fairy'):
-                query += ''' AND types.identifier in ('normal', 'fairy')'''
-            else:
-                query += ''' AND types.identifier = ?'''
-                args.append(type_)
+            if wanted_types and wanted_types.isdisjoint(record.types):
+                continue
 
-        if not_ids:
-            assert len(not_ids) == 3
-            query += ''' AND pokemon.id NOT IN (?, ?, ?)'''
-            args.extend(not_ids)
-
-        query += ''' GROUP BY pokemon.id LIMIT 1000'''
-
-        rows = self._con.execute(query, args)
-        results = []
+            if record.id in not_ids:
+                continue
 
-        for row in rows:
-            results.append(PokemonInfo(row[0], row[1], row[2]))
+            results.append(PokemonInfo(record.id, record.name, record.weight))
 
         if len(results) < 3:
             raise MatchError('Not enough results to satisfy constraints')
@@ -206,5 +297,9 @@ class MatchGenerator(object):
 
 
 if __name__ == '__main__':
-    generator = MatchGenerator(sys.argv[1])
-    print(generator.get_match_string(sys.argv[2:]))
+    if sys.argv[1] == 'export':
+        count = export_snapshot(sys.argv[2], sys.argv[3])
+        print('Exported {} records to {}'.format(count, sys.argv[3]))
+    else:
+        generator = MatchGenerator(sys.argv[1])
+        print(generator.get_match_string(sys.argv[2:]))
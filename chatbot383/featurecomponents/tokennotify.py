@@ -1,6 +1,4 @@
 import logging
-import os
-
 import time
 
 from chatbot383.bot import Limiter
@@ -8,98 +6,103 @@ from chatbot383.roar import gen_roar
 
 _logger = logging.getLogger(__name__)
 
+MAX_FILE_AGE = 120
+# How often to check whether a channel waiting for a notification is joined
+JOIN_RETRY_INTERVAL = 5
+
 
 class TokenNotifier(object):
-    def __init__(self, token_analysis_filename, channels, update_interval=60):
+    def __init__(self, token_analysis_filename, channels, bot, file_watcher):
         self._token_analysis_filename = token_analysis_filename
         self._channels = channels
-        self._update_interval = update_interval
+        self._bot = bot
         self._last_button_labels = frozenset()
-        self._last_timestamp = None
         self._limiter = Limiter(30)
-
-    def notify(self, bot):
-        doc = self._read_file()
-
-        if not doc:
-            return
-
-        _logger.info('Check for tokens')
-
-        next_interval = self._get_next_update_interval()
-
+        # Texts for channels not joined yet, with when they were made
+        self._pending_texts = {}
+        self._retry_timer = None
+
+        file_watcher.watch(token_analysis_filename,
+                           formatter=self.format_doc,
+                           callback=self._on_file_changed)
+
+    def get_state(self):
+        return {
+            'last_button_labels': sorted(self._last_button_labels),
+            'limiter': self._limiter.get_state(),
+        }
+
+    def set_state(self, state):
+        self._last_button_labels = frozenset(state['last_button_labels'])
+        self._limiter.set_state(state['limiter'])
+
+    @classmethod
+    def format_doc(cls, doc):
         token_button_labels = set()
         no_token_button_labels = set()
 
-        for button_label in sorted(doc['buttons'].keys()):
-            button_doc = doc['buttons'][button_label]
-
+        for button_label, button_doc in doc['buttons'].items():
             if button_doc['token_detected']:
                 token_button_labels.add(button_label)
             else:
                 no_token_button_labels.add(button_label)
 
-        if self._last_button_labels == token_button_labels:
-            return next_interval
+        return frozenset(token_button_labels), frozenset(no_token_button_labels)
 
-        self._last_button_labels = frozenset(token_button_labels)
+    def _on_file_changed(self, snapshot):
+        # Called on the watcher thread; sending belongs on the dispatch thread
+        self._bot.scheduler.call_later(0, self._check_snapshot, snapshot)
 
-        if not token_button_labels or not no_token_button_labels:
-            # No tokens or all buttons have tokens (likely false positive)
-            return next_interval
-
-        if self._limiter.is_ok(None):
-            self._limiter.update(None)
-            self._send_to_channels(bot, token_button_labels)
-
-        return next_interval
-
-    def _read_file(self):
-        if not self._token_analysis_filename or \
-                not os.path.isfile(self._token_analysis_filename) or \
-                not self._channels:
-            self._last_timestamp = None
+    def _check_snapshot(self, snapshot):
+        if time.time() - snapshot.mtime > MAX_FILE_AGE:
             return
 
-        time_now = time.time()
-        file_timestamp = os.path.getmtime(self._token_analysis_filename)
+        _logger.info('Check for tokens')
 
-        if time_now - file_timestamp > 120 or \
-                self._last_timestamp == file_timestamp:
-            return
+        self.notify(*snapshot.value)
 
-        if not self._last_timestamp:
-            _logger.info('Found token analysis file')
+    def notify(self, token_button_labels, no_token_button_labels):
+        if self._last_button_labels == token_button_labels:
+            return
 
-        self._last_timestamp = file_timestamp
+        self._last_button_labels = token_button_labels
 
-        with open(self._token_analysis_filename) as file:
-            try:
-                doc = json.load(file)
-            except ValueError:
-                _logger.exception('Error reading file')
-                return
-            else:
-                return doc
-
-    def _get_next_update_interval(self):
-        if not self._last_timestamp:
+        if not token_button_labels or not no_token_button_labels:
+            # No tokens or all buttons have tokens (likely false positive)
             return
 
-        time_now = time.time()
-        interval = self._update_interval - (time_now - self._last_timestamp)
-        interval = min(300, interval)
-        interval = max(5, interval)
-
-        return interval
+        if self._limiter.is_ok(None):
+            self._limiter.update(None)
+            self._send_to_channels(token_button_labels)
 
-    def _send_to_channels(self, bot, token_button_labels):
+    def _send_to_channels(self, token_button_labels):
         text = '[Token] {roar} Detected tokens on: {buttons}' \
             .format(
                 roar=gen_roar(),
                 buttons=', '.join(sorted(token_button_labels))
             )
 
+        time_now = time.time()
+
         for channel in self._channels:
-            _logger.info('Token notify to %s', channel)
-            bot.send_text(channel, text)
+            self._pending_texts[channel] = (text, time_now)
+
+        self._send_pending()
+
+    def _send_pending(self):
+        self._retry_timer = None
+        time_now = time.time()
+
+        for channel, (text, created) in tuple(self._pending_texts.items()):
+            if time_now - created > MAX_FILE_AGE:
+                _logger.info('Token notify to %s expired before joining',
+                             channel)
+                del self._pending_texts[channel]
+            elif self._bot.is_joined(channel):
+                _logger.info('Token notify to %s', channel)
+                del self._pending_texts[channel]
+                self._bot.send_text(channel, text)
+
+        if self._pending_texts and not self._retry_timer:
+            self._retry_timer = self._bot.scheduler.call_later(
+                JOIN_RETRY_INTERVAL, self._send_pending)
@@ -1,6 +1,5 @@
 import collections
 import copy
-import json
 import logging
 import os
 import random
@@ -8,13 +7,15 @@ import re
 import sqlite3
 import time
 import datetime
-import dateutil.relativedelta
-
-import arrow
 
+from chatbot383 import metrics
 from chatbot383.bot import Limiter
+from chatbot383.chatstats import ChatStats
+from chatbot383.filewatch import FileWatcher
+from chatbot383.memaccount import MemoryUsage, approximate_size
+from chatbot383.plugin import LazyResource, Plugin, PluginRegistry, \
+    command, message_handler, scheduled
 from chatbot383.featurecomponents.matchgen import MatchGenerator, MatchError
-from chatbot383.featurecomponents.tellnextdb import TellnextGenerator
 from chatbot383.featurecomponents.tokennotify import TokenNotifier
 from chatbot383.regex import RegexServer, RegexTimeout
 from chatbot383.roar import gen_roar
@@ -22,6 +23,19 @@ from chatbot383.roar import gen_roar
 
 _logger = logging.getLogger(__name__)
 _random = random.Random()
+_database_duration = metrics.histogram(
+    'chatbot383_database_seconds', 'Time spent in database calls',
+    ('operation',))
+_regex_timeouts = metrics.counter(
+    'chatbot383_regex_timeouts_total', 'Regex searches that timed out')
+
+# Message fields kept in snapshots; the rest, such as the client, are not
+SAVED_MESSAGE_KEYS = ('channel', 'nick', 'username', 'text', 'stacked')
+
+
+def get_saved_message(message):
+    return dict((key, message[key]) for key in SAVED_MESSAGE_KEYS
+                if key in message)
 
 
 class MailbagFullError(ValueError):
@@ -35,9 +49,16 @@ class SenderOutboxFullError(MailbagFullError):
 class Database(object):
     def __init__(self, db_path):
         self._path = db_path
-        self._con = sqlite3.connect(db_path)
+        self._connection = None
 
-        self._init_db()
+    @property
+    def _con(self):
+        # Opened on first use, which also keeps it on the bot's thread
+        if not self._connection:
+            self._connection = sqlite3.connect(self._path)
+            self._init_db()
+
+        return self._connection
 
     def _init_db(self):
         with self._con:
@@ -55,7 +76,7 @@ class Database(object):
             ''')
 
     def get_mail(self, skip_username=None):
-        with self._con:
+        with _database_duration.time('get_mail'), self._con:
             row = self._con.execute(
                 '''SELECT id, username, text, timestamp FROM
                 mail WHERE status = ? AND username != ? LIMIT 1''',
@@ -72,7 +93,7 @@ class Database(object):
                 return mail_info
 
     def get_old_mail(self):
-        with self._con:
+        with _database_duration.time('get_old_mail'), self._con:
             row = self._con.execute('''SELECT max(id) FROM mail''').fetchone()
 
             max_id = row[0]
@@ -94,7 +115,7 @@ class Database(object):
                     return mail_info
 
     def put_mail(self, username, text):
-        with self._con:
+        with _database_duration.time('put_mail'), self._con:
             row = self._con.execute(
                 '''SELECT count(1) FROM mail
                 WHERE status = 'unread' AND username = ? LIMIT 1
@@ -116,96 +137,111 @@ class Database(object):
             ''', (int(time.time()), username, text))
 
     def get_status_count(self, status):
-        with self._con:
+        with _database_duration.time('get_status_count'), self._con:
             row = self._con.execute('''SELECT count(1) FROM mail
             WHERE status = ? LIMIT 1''', (status,)).fetchone()
 
             return row[0]
 
 
-class Features(object):
-    DONGER_SONG_TEMPLATE = (
-        'I like to raise my {donger} I do it all the time ヽ༼ຈل͜ຈ༽ﾉ '
-        'and every time its lowered┌༼ຈل͜ຈ༽┐ '
-        'I cry and start to whine ┌༼@ل͜@༽┐'
-        'But never need to worry ༼ ºل͟º༽ '
-        'my {donger}\'s staying strong ヽ༼ຈل͜ຈ༽ﾉ'
-        'A {donger} saved is a {donger} earned so sing the {donger} song!'
-    )
-    TOO_LONG_TEXT_TEMPLATE = '{} Message length exceeds my capabilities!'
-    MAIL_MAX_LEN = 300
-    FOOD_LOG_FILENAME = 'foodlog.txt'
+PLUGINS = PluginRegistry()
+
 
+class Features(object):
+    '''Create the plugins enabled by the config and hold what they share.'''
     def __init__(self, bot, help_text, database, config, alert_channels=None):
         self._bot = bot
         self._help_text = help_text
         self._database = database
         self._config = config
-        self._recent_messages_for_regex = collections.defaultdict(lambda: collections.deque(maxlen=100))
-        self._last_message = {}
-        self._spam_limiter = Limiter(min_interval=10)
-        self._regex_server = RegexServer()
-        #self._token_notifier = TokenNotifier(
-        #    config.get('token_notify_filename'),
-        #    config.get('token_notify_channels'),
-        #    config.get('token_notify_interval', 60)
-        #)
-        self._tellnext_generator = None
         self._alert_channels = frozenset(alert_channels or ())
+        self._file_watcher = LazyResource('file_watcher', FileWatcher)
+        self._plugins = collections.OrderedDict(
+            (plugin_class.name, plugin_class(self))
+            for plugin_class in PLUGINS.get_enabled(config)
+        )
+        self._plugin_states = {}
 
-        self._food_current = ""
-        self._food_next = ""
+        for plugin in self._plugins.values():
+            plugin.register()
 
-        self._food_current_updated = None
-        self._food_next_updated = None
+        _logger.info('Enabled plugins: %s', ', '.join(self._plugins))
 
-        self._mail_disabled_channels = config.get('mail_disabled_channels')
-        #    self._tellnext_generator = TellnextGenerator(config['tellnext_database'])
-
-        bot.register_message_handler('pubmsg', self._collect_recent_message)
-        bot.register_message_handler('action', self._collect_recent_message)
-        #bot.register_command(r's/(.+/.*)', self._regex_command)
-        #bot.register_command(r'(?i)!double(team)?($|\s.*)', self._double_command)
-        bot.register_command(r'(?i)!(groudonger)?help($|\s.*)', self._help_command)
-        bot.register_command(r'(?i)!groudon(ger)?($|\s.*)', self._roar_command)
-        #bot.register_command(r'(?i)!hypestats($|\s.*)', self._hype_stats_command)
-        bot.register_command(r'(?i)!klappa($|\s.*)', self._klappa_command)
-        #bot.register_command(r'(?i)!(mail|post)($|\s.*)$', self._mail_command)
-        #bot.register_command(r'(?i)!(mail|post)status($|\s.*)', self._mail_status_command)
-        #bot.register_command(r'(?i)!pick\s+(.*)', self._pick_command)
-        #bot.register_command(r'(?i)!praise($|\s.{,100})$', self._praise_command)
-        #bot.register_command(r'(?i)!(?:shuffle|scramble)($|\s.*)', self._shuffle_command)
-        #bot.register_command(r'(?i)!song($|\s.{,50})$', self._song_command)
-        #bot.register_command(r'(?i)!sort($|\s.*)', self._sort_command)
-        #bot.register_command(r'(?i)!rand(?:om)?case($|\s.*)', self._rand_case_command)
-        #bot.register_command(r'(?i)!release($|\s.{,100})$', self._release_command)
-        #bot.register_command(r'(?i)!riot($|\s.{,100})$', self._riot_command)
-        #bot.register_command(r'(?i)!rip($|\s.{,100})$', self._rip_command)
-        #bot.register_command(r'(?i)!gen(?:erate)?match($|\s.*)$', self._generate_match_command)
-        #bot.register_command(r'(?i)!(xd|minglee|chfoo)($|\s.*)', self._xd_command)
-        # Temporary disabled. interferes with rate limit
-        # bot.register_command(r'.*\b[xX][dD] +MingLee\b.*', self._xd_rand_command)
-        #bot.register_command(r'(?i)!(wow)($|\s.*)', self._wow_command)
-        bot.register_command(r'(?i)!foodcurrent($|\s.*)', self._food_current_command)
-        bot.register_command(r'(?i)!foodnext($|\s.*)', self._food_next_command)
-
-        self._reseed_rng_sched()
-        #self._token_notify_sched()
-
-    def _reseed_rng_sched(self):
-        _reseed()
-        _logger.debug('RNG reseeded')
-        self._bot.scheduler.enter(300, 0, self._reseed_rng_sched)
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def config(self):
+        return self._config
+
+    @property
+    def help_text(self):
+        return self._help_text
+
+    @property
+    def database(self):
+        return self._database
+
+    @property
+    def alert_channels(self):
+        return self._alert_channels
+
+    @alert_channels.setter
+    def alert_channels(self, channels):
+        self._alert_channels = frozenset(channels or ())
+
+    @property
+    def file_watcher(self):
+        return self._file_watcher.get()
+
+    @property
+    def plugins(self):
+        return tuple(self._plugins.values())
+
+    def get_plugin(self, name):
+        return self._plugins.get(name)
+
+    def warm(self):
+        '''Start loading the expensive resources in the background.'''
+        for plugin in self._plugins.values():
+            for resource in plugin.get_resources():
+                if not resource.loaded:
+                    resource.warm()
+
+    def register_memory_probes(self, accountant):
+        for plugin in self._plugins.values():
+            plugin.register_memory_probes(accountant)
+
+    def get_state(self):
+        # States of plugins that are disabled for now are kept as they were
+        states = dict(self._plugin_states)
+
+        for name, plugin in self._plugins.items():
+            state = plugin.get_state()
+
+            if state is not None:
+                states[name] = state
+
+        return states
 
-    def _token_notify_sched(self):
-        interval = self._token_notifier.notify(self._bot)
+    def set_state(self, states):
+        self._plugin_states = dict(states)
 
-        if not interval:
-            interval = 60
+        for name, state in states.items():
+            plugin = self._plugins.get(name)
+
+            if not plugin:
+                continue
+
+            try:
+                plugin.set_state(state)
+            except (KeyError, TypeError, ValueError):
+                _logger.exception('Could not restore state of plugin %s', name)
 
-        _logger.debug('Next token analysis interval %s', interval)
 
-        self._bot.scheduler.enter(interval, 0, self._token_notify_sched)
+class FeaturePlugin(Plugin):
+    TOO_LONG_TEXT_TEMPLATE = '{} Message length exceeds my capabilities!'
 
     @classmethod
     def is_too_long(cls, text):
@@ -220,55 +256,456 @@ class Features(object):
             session.say(formatted_text)
             return True
 
-    def _collect_recent_message(self, session):
-        if session.message['event_type'] in ('pubmsg', 'action'):
-            channel = session.message['channel']
-            username = session.message['username']
-            our_username = session.client.get_nickname(lower=True)
 
-            if username != our_username:
-                #self._recent_messages_for_regex[channel].append(session.message)
+@PLUGINS.register
+class CorePlugin(FeaturePlugin):
+    name = 'core'
+    enabled_by_default = True
+
+    def __init__(self, features):
+        super().__init__(features)
+        _reseed()
 
-                #if not session.message['text'].startswith('!'):
-                #    self._last_message[channel] = session.message
-                if username.lower() == "food" and channel.lower() == "#food":
-                    self._collect_food_message(session.message)
+    @scheduled(300)
+    def _reseed_rng(self):
+        _reseed()
+        _logger.debug('RNG reseeded')
 
+    @command(r'(?i)!(groudonger)?help($|\s.*)')
     def _help_command(self, session):
-        session.reply('{} {}'.format(gen_roar(), self._help_text))
+        session.reply('{} {}'.format(gen_roar(), self._features.help_text))
 
+    @command(r'(?i)!groudon(ger)?($|\s.*)')
     def _roar_command(self, session):
         session.say('{} {} {}'.format(gen_roar(), gen_roar(), gen_roar().upper()))
 
+    @command(r'(?i)!klappa($|\s.*)')
+    def _klappa_command(self, session):
+        session.say('{}'.format(_random.choice(('Kappa //', gen_roar()))))
+
+
+@PLUGINS.register
+class HypeStatsPlugin(FeaturePlugin):
+    name = 'hype_stats'
+    config_keys = ('hype_stats_filename', 'hype_stats_builtin')
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._chat_stats = None
+
+        if self._config.get('hype_stats_filename'):
+            features.file_watcher.watch(self._config['hype_stats_filename'],
+                                        formatter=self.format_hype_stats)
+        else:
+            self._chat_stats = ChatStats(
+                self._config.get('hype_stats_hints', ()))
+
+    def register(self):
+        super().register()
+
+        if self._chat_stats:
+            # Only the stats channel is reported on if one is set
+            stats_channel = self._config.get('hype_stats_channel')
+            channels = (stats_channel,) if stats_channel else None
+            self._bot.register_message_handler(
+                'pubmsg', self._collect_chat_stats, channels=channels)
+            self._bot.register_message_handler(
+                'action', self._collect_chat_stats, channels=channels)
+            self._bot.register_shard_call('hype_stats', self._send_hype_stats)
+
+    def _collect_chat_stats(self, session):
+        self._chat_stats.add_message(
+            session.message['channel'], session.message['text'])
+
+    @classmethod
+    def format_hype_stats(cls, doc):
+        text_1 = '[{duration}] Lines/sec {averages_str} ' \
+            '· Hints/sec {hint_averages_str}'.format(
+                duration=doc['stats']['duration'],
+                averages_str=doc['stats']['averages_str'],
+                hint_averages_str=doc['stats']['hint_averages_str'],
+        )
+        text_2 = 'Chat {chat_graph} · Hint {hint_graph}'.format(
+            chat_graph=doc['stats']['chat_graph'],
+            hint_graph=doc['stats']['hint_graph'],
+        )
+
+        return text_1, text_2
+
+    @command(r'(?i)!hypestats($|\s.*)')
     def _hype_stats_command(self, session):
         stats_filename = self._config.get('hype_stats_filename')
+        channel = session.message['channel']
 
-        if not stats_filename or \
-                stats_filename and not os.path.exists(stats_filename):
-            session.reply(
-                '{} This command is currently unavailable!'.format(gen_roar()))
+        if stats_filename:
+            snapshot = self._features.file_watcher.get(stats_filename)
+            self._say_hype_stats(snapshot and snapshot.value, channel,
+                                 session.message['nick'])
+        else:
+            # With several workers, only the one owning the stats channel
+            # has its lines
+            stats_channel = self._config.get('hype_stats_channel') or channel
+            self._bot.call_on_owner(stats_channel, 'hype_stats',
+                                    stats_channel, channel,
+                                    session.message['nick'])
+
+    def _send_hype_stats(self, stats_channel, channel, nick):
+        self._say_hype_stats(self._chat_stats.format_lines(stats_channel),
+                             channel, nick)
+
+    def _say_hype_stats(self, lines, channel, nick):
+        if not lines:
+            self._bot.send_text(
+                channel,
+                '{} This command is currently unavailable!'.format(gen_roar()),
+                reply_to=nick)
             return
 
+        text_1, text_2 = lines
+        self._bot.send_text(channel, text_1)
+        self._bot.send_text(channel, text_2)
+
+
+@PLUGINS.register
+class MatchPlugin(FeaturePlugin):
+    name = 'match'
+    config_keys = ('match_data_snapshot', 'veekun_pokedex_database')
+
+    def __init__(self, features):
+        super().__init__(features)
+        match_data_path = self._config.get('match_data_snapshot') or \
+            self._config.get('veekun_pokedex_database')
+        self._match_generator = LazyResource(
+            'match_generator', lambda: MatchGenerator(match_data_path))
+
+    def get_resources(self):
+        return (self._match_generator,)
+
+    @command(r'(?i)!gen(?:erate)?match($|\s.*)$')
+    def _generate_match_command(self, session):
+        args = session.match.group(1).lower().split()
+
         try:
-            with open(stats_filename) as file:
-                doc = json.load(file)
-
-            text_1 = '[{duration}] Lines/sec {averages_str} ' \
-                '· Hints/sec {hint_averages_str}'.format(
-                    duration=doc['stats']['duration'],
-                    averages_str=doc['stats']['averages_str'],
-                    hint_averages_str=doc['stats']['hint_averages_str'],
+            match_string = self._match_generator.get().get_match_string(args)
+        except MatchError as error:
+            session.reply('{} {}!'.format(gen_roar(), error.args[0]))
+        else:
+            self._try_say_or_reply_too_long(
+                '{} {}'.format(gen_roar(), match_string), session)
+
+
+@PLUGINS.register
+class FoodPlugin(FeaturePlugin):
+    name = 'food'
+    enabled_by_default = True
+    FOOD_LOG_FILENAME = 'foodlog.txt'
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._food_current = ""
+        self._food_next = ""
+
+        self._food_current_updated = None
+        self._food_next_updated = None
+
+    def get_state(self):
+        return {
+            'current': self._food_current,
+            'next': self._food_next,
+            'current_updated': self._food_current_updated and
+            self._food_current_updated.isoformat(),
+            'next_updated': self._food_next_updated and
+            self._food_next_updated.isoformat(),
+        }
+
+    def set_state(self, state):
+        self._food_current = state['current']
+        self._food_next = state['next']
+        self._food_current_updated = state['current_updated'] and \
+            datetime.datetime.fromisoformat(state['current_updated'])
+        self._food_next_updated = state['next_updated'] and \
+            datetime.datetime.fromisoformat(state['next_updated'])
+
+    @message_handler('pubmsg', 'action', channels=('#food',))
+    def _collect_recent_message(self, session):
+        channel = session.message['channel']
+        username = session.message['username']
+
+        if username.lower() == "food" and channel.lower() == "#food":
+            self._collect_food_message(session.message)
+
+    def _alert_important_food_change(self, title, isNow):
+        # This is only called if the title is different from what we already had in our variables
+        if re.search(r"\bjulia\b", title, re.I) or re.search(r"\bfrench\s+chef\b", title, re.I):
+            if isNow:
+                out = 'twitch.tv/food is now playing "{}"'.format(title)
+            else:
+                out = 'twitch.tv/food will play "{}" next'.format(title)
+
+            for channel in self._features.alert_channels:
+                self._bot.send_text(channel, 'PogChamp {}'.format(out))
+
+    def _log_food_nowplaying(self):
+        output = "{}: {}\n".format(self._food_current_updated.isoformat(), self._food_current)
+        with open(self.FOOD_LOG_FILENAME, "a") as logfile:
+            logfile.write(output)
+
+    def _collect_food_message(self, message):
+        text = message['text']
+
+        # What's next
+        whats_next = ""
+        match = re.fullmatch(r"\s*will play \"([^\"]+)\" next\s*", text, re.I)
+
+        if match and self._food_next != "voting":
+            # This particular format is invalid when voting
+            whats_next = match.group(1)
+
+        match = re.fullmatch(r"\s*the vote is done! the winner is \"([^\"]+)\" with [0-9]+ votes?\s*", text, re.I)
+
+        if match:
+            whats_next = match.group(1)
+
+        if whats_next and self._food_next != whats_next:
+            self._alert_important_food_change(whats_next, False)
+            self._food_next = whats_next
+            self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
+
+        # What's playing
+        match = re.fullmatch(r"\s*now playing \"([^\"]+)\"\s*", text, re.I)
+
+        if match:
+            whats_on = match.group(1)
+            if whats_on and self._food_current != whats_on:
+                self._alert_important_food_change(whats_on, True)
+                self._food_current = whats_on
+                self._food_current_updated = datetime.datetime.now(datetime.timezone.utc)
+                self._log_food_nowplaying()
+
+                # If this was previously "next", then now we don't know what "next" is.
+                if self._food_next == self._food_current:
+                    self._food_next = ""
+                    self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
+
+        # Voting in progress
+        if text == "TIME TO VOTE!":
+            whats_next = "voting"
+            if self._food_next != whats_next:
+                self._food_next = whats_next
+                self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
+
+    def _food_updated_string(self, dt):
+        if not dt:
+            return ""
+
+        import dateutil.relativedelta
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        rd = dateutil.relativedelta.relativedelta(now, dt)
+
+        attrs = ['years', 'months', 'days', 'hours', 'minutes', 'seconds']
+        human_readable = lambda delta: [
+            '%d %s' % (getattr(delta, attr), getattr(delta, attr) > 1 and attr or attr[:-1])
+            for attr in attrs if getattr(delta, attr)
+        ]
+
+        hr = human_readable(rd)
+        if len(hr) > 0:
+            return "(last updated {} ago)".format(hr[0])
+        return ""
+
+    @command(r'(?i)!foodcurrent($|\s.*)')
+    def _food_current_command(self, session):
+        updated_string = self._food_updated_string(self._food_current_updated)
+        if not self._food_current:
+            session.reply(
+                '{} I have no idea what\'s playing on twitch.tv/food right now! :( {}'
+                .format(gen_roar(), updated_string)
             )
-            text_2 = 'Chat {chat_graph} · Hint {hint_graph}'.format(
-                chat_graph=doc['stats']['chat_graph'],
-                hint_graph=doc['stats']['hint_graph'],
+        else:
+            session.reply(
+                '{roar} twitch.tv/food is now playing "{title}"! {updated}'
+                .format(
+                    roar=gen_roar(),
+                    title=self._food_current,
+                    updated=updated_string
+                )
+            )
+
+    @command(r'(?i)!foodnext($|\s.*)')
+    def _food_next_command(self, session):
+        updated_string = self._food_updated_string(self._food_next_updated)
+        if not self._food_next:
+            session.reply(
+                '{} I have no idea what\'s playing on twitch.tv/food next! :( {}'
+                .format(gen_roar(), updated_string)
             )
-        except (ValueError, KeyError, IndexError):
-            _logger.exception('Error formatting stats')
         else:
-            session.say(text_1)
-            session.say(text_2)
+            title = self._food_next
+            if title == "voting":
+                message = "twitch.tv/food chat is currently voting for what to play next."
+            else:
+                message = 'twitch.tv/food will play "{}" next!'.format(title)
+            session.reply('{} {} {}'.format(gen_roar(), message, updated_string))
+
+
+@PLUGINS.register
+class TokenNotifyPlugin(FeaturePlugin):
+    name = 'token_notify'
+    config_keys = ('token_notify_filename',)
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._token_notifier = TokenNotifier(
+            self._config['token_notify_filename'],
+            self._config['token_notify_channels'],
+            self._bot, features.file_watcher
+        )
+
+    def get_state(self):
+        return self._token_notifier.get_state()
+
+    def set_state(self, state):
+        self._token_notifier.set_state(state)
 
+    @classmethod
+    def is_enabled(cls, config):
+        return super().is_enabled(config) and \
+            bool(config.get('token_notify_channels'))
+
+
+@PLUGINS.register
+class MailPlugin(FeaturePlugin):
+    name = 'mail'
+    MAIL_MAX_LEN = 300
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._database = features.database
+        self._mail_disabled_channels = frozenset(
+            self._config.get('mail_disabled_channels') or ())
+
+    @command(r'(?i)!(mail|post)($|\s.*)$')
+    def _mail_command(self, session):
+        import arrow
+
+        if session.message['channel'] in self._mail_disabled_channels:
+            session.reply(
+                '{} My mail services cannot be used here.'
+                .format(gen_roar().replace('!', '.'))
+            )
+            return
+
+        mail_text = session.match.group(2).strip()
+
+        if mail_text:
+            if len(mail_text) > self.MAIL_MAX_LEN:
+                session.reply(
+                    '{} Your message is too burdensome! '
+                    'Send a concise version instead. '
+                    '({}/{})'
+                    .format(gen_roar(), len(mail_text), self.MAIL_MAX_LEN)
+                )
+                return
+
+            try:
+                self._database.put_mail(session.message['username'], mail_text)
+            except SenderOutboxFullError:
+                session.reply(
+                    '{} How embarrassing! Your outbox is full!'
+                    .format(gen_roar()))
+            except MailbagFullError:
+                session.reply(
+                    '{} Incredulous! My mailbag is full! Read one instead!'
+                    .format(gen_roar()))
+            else:
+                session.reply(
+                    'Tremendous! I will deliver this mail to the next '
+                    'recipient without fail! {}'.format(gen_roar()))
+        else:
+            if _random.random() < 0.3:
+                mail_info = self._database.get_old_mail()
+            else:
+                if _random.random() < 0.7:
+                    skip_username = session.message['username']
+                else:
+                    skip_username = None
+
+                mail_info = self._database.get_mail(skip_username=skip_username)
+
+                if not mail_info and _random.random() < 0.3:
+                    mail_info = self._database.get_old_mail()
+
+            if not mail_info:
+                session.reply(
+                    '{} Outlandish! There is no new mail! You should send some!'
+                    .format(gen_roar())
+                )
+            else:
+                session.reply(
+                    '{roar} I am delivering mail! '
+                    'Here it is, {date}, from {username}: {msg}'
+                    .format(
+                        roar=gen_roar(),
+                        username=mail_info['username'].title(),
+                        date=arrow.get(mail_info['timestamp']).humanize(),
+                        msg=mail_info['text']),
+                    multiline=True
+                )
+
+    @command(r'(?i)!(mail|post)status($|\s.*)')
+    def _mail_status_command(self, session):
+        unread_count = self._database.get_status_count('unread')
+        read_count = self._database.get_status_count('read')
+
+        session.reply(
+            '{roar} {unread} unread, {read} read, {total} total!'.format(
+                roar=gen_roar(),
+                unread=unread_count,
+                read=read_count,
+                total=unread_count + read_count
+            )
+        )
+
+
+@PLUGINS.register
+class RegexPlugin(FeaturePlugin):
+    name = 'regex'
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._recent_messages_for_regex = collections.defaultdict(lambda: collections.deque(maxlen=100))
+        self._regex_server = RegexServer()
+
+    def register_memory_probes(self, accountant):
+        accountant.register(
+            'recent_messages_for_regex',
+            lambda: MemoryUsage(
+                sum(map(len, self._recent_messages_for_regex.values())),
+                approximate_size(self._recent_messages_for_regex)
+            ))
+        accountant.register(
+            'regex_server_queue',
+            lambda: MemoryUsage(self._regex_server.get_pending_count(), 0))
+
+    def get_state(self):
+        return dict(
+            (channel, [get_saved_message(message) for message in messages])
+            for channel, messages in self._recent_messages_for_regex.items()
+        )
+
+    def set_state(self, state):
+        for channel, messages in state.items():
+            self._recent_messages_for_regex[channel].extend(messages)
+
+    @message_handler('pubmsg', 'action', skip_duplicates=True)
+    def _collect_recent_message(self, session):
+        if session.message['username'] != \
+                session.client.get_nickname(lower=True):
+            channel = session.message['channel']
+            self._recent_messages_for_regex[channel].append(session.message)
+
+    @command(r's/(.+/.*)')
     def _regex_command(self, session):
         # Special split http://stackoverflow.com/a/21107911/1524507
         parts = re.split(r'(?<!\\)/', session.match.group(1))
@@ -304,6 +741,7 @@ class Features(object):
             try:
                 matched = self._regex_server.search(pattern, text)
             except RegexTimeout:
+                _regex_timeouts.inc()
                 _logger.warning(
                     'Regex DoS by %s on %s', session.message['username'],
                     session.message['channel'])
@@ -346,6 +784,48 @@ class Features(object):
         session.reply('{} Your request does not apply to any recent messages!'
                       .format(gen_roar()))
 
+
+@PLUGINS.register
+class ChatToysPlugin(FeaturePlugin):
+    name = 'chat_toys'
+    DONGER_SONG_TEMPLATE = (
+        'I like to raise my {donger} I do it all the time ヽ༼ຈل͜ຈ༽ﾉ '
+        'and every time its lowered┌༼ຈل͜ຈ༽┐ '
+        'I cry and start to whine ┌༼@ل͜@༽┐'
+        'But never need to worry ༼ ºل͟º༽ '
+        'my {donger}\'s staying strong ヽ༼ຈل͜ຈ༽ﾉ'
+        'A {donger} saved is a {donger} earned so sing the {donger} song!'
+    )
+
+    def __init__(self, features):
+        super().__init__(features)
+        self._last_message = {}
+        self._spam_limiter = Limiter(min_interval=10, clock=self._bot.clock)
+
+    def register_memory_probes(self, accountant):
+        accountant.register('last_message', lambda: self._last_message)
+        accountant.register('features_spam_limiter', lambda: self._spam_limiter)
+
+    def get_state(self):
+        return {
+            'last_message': dict(
+                (channel, get_saved_message(message))
+                for channel, message in self._last_message.items()),
+            'spam_limiter': self._spam_limiter.get_state(),
+        }
+
+    def set_state(self, state):
+        self._last_message.update(state['last_message'])
+        self._spam_limiter.set_state(state['spam_limiter'])
+
+    @message_handler('pubmsg', 'action', skip_duplicates=True)
+    def _collect_last_message(self, session):
+        if session.message['username'] != \
+                session.client.get_nickname(lower=True) and \
+                not session.message['text'].startswith('!'):
+            self._last_message[session.message['channel']] = session.message
+
+    @command(r'(?i)!double(team)?($|\s.*)')
     def _double_command(self, session):
         text = session.match.group(2).strip()
         last_message = self._last_message.get(session.message['channel'])
@@ -360,6 +840,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!pick\s+(.*)')
     def _pick_command(self, session):
         text = session.match.group(1).strip()
 
@@ -371,6 +852,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!praise($|\s.{,100})$')
     def _praise_command(self, session):
         text = session.match.group(1).strip()
 
@@ -381,6 +863,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!(?:shuffle|scramble)($|\s.*)')
     def _shuffle_command(self, session):
         text = session.match.group(1).strip()
         last_message = self._last_message.get(session.message['channel'])
@@ -398,6 +881,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!song($|\s.{,50})$')
     def _song_command(self, session):
         limiter_key = ('song', session.message['channel'])
         if not self._spam_limiter.is_ok(limiter_key):
@@ -414,6 +898,7 @@ class Features(object):
 
         self._spam_limiter.update(limiter_key)
 
+    @command(r'(?i)!sort($|\s.*)')
     def _sort_command(self, session):
         text = session.match.group(1).strip()
         last_message = self._last_message.get(session.message['channel'])
@@ -428,6 +913,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!rand(?:om)?case($|\s.*)')
     def _rand_case_command(self, session):
         text = session.match.group(1).strip()
         last_message = self._last_message.get(session.message['channel'])
@@ -445,6 +931,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!release($|\s.{,100})$')
     def _release_command(self, session):
         text = session.match.group(1).strip() or session.message['nick']
 
@@ -455,6 +942,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!riot($|\s.{,100})$')
     def _riot_command(self, session):
         text = session.match.group(1).strip()
 
@@ -476,6 +964,7 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
+    @command(r'(?i)!rip($|\s.{,100})$')
     def _rip_command(self, session):
         text = session.match.group(1).strip() or session.message['nick']
 
@@ -486,14 +975,14 @@ class Features(object):
 
         self._try_say_or_reply_too_long(formatted_text, session)
 
-    def _klappa_command(self, session):
-        session.say('{}'.format(_random.choice(('Kappa //', gen_roar()))))
-
+    @command(r'(?i)!(xd|minglee|chfoo)($|\s.*)')
     def _xd_command(self, session):
         session.say('{} xD MingLee'.format(
             gen_roar().lower().replace('!', '?'))
         )
 
+    # Not registered; interferes with rate limit
+    # @command(r'.*\b[xX][dD] +MingLee\b.*')
     def _xd_rand_command(self, session):
         if _random.random() < 0.1 or \
                 session.message['username'] == 'wow_deku_onehand' and \
@@ -505,204 +994,45 @@ class Features(object):
                 re.sub('!', rep_func, gen_roar().lower()))
             )
 
-    def _wow_command(self, session):
-        if self._tellnext_generator:
-            session.say('> {}'.format(self._tellnext_generator.get_paragraph()))
-        else:
-            session.reply('{} Feature not available!'.format(gen_roar()))
-
-    def _mail_command(self, session):
-        if session.message['channel'] in self._mail_disabled_channels:
-            session.reply(
-                '{} My mail services cannot be used here.'
-                .format(gen_roar().replace('!', '.'))
-            )
-            return
-
-        mail_text = session.match.group(2).strip()
-
-        if mail_text:
-            if len(mail_text) > self.MAIL_MAX_LEN:
-                session.reply(
-                    '{} Your message is too burdensome! '
-                    'Send a concise version instead. '
-                    '({}/{})'
-                    .format(gen_roar(), len(mail_text), self.MAIL_MAX_LEN)
-                )
-                return
-
-            try:
-                self._database.put_mail(session.message['username'], mail_text)
-            except SenderOutboxFullError:
-                session.reply(
-                    '{} How embarrassing! Your outbox is full!'
-                    .format(gen_roar()))
-            except MailbagFullError:
-                session.reply(
-                    '{} Incredulous! My mailbag is full! Read one instead!'
-                    .format(gen_roar()))
-            else:
-                session.reply(
-                    'Tremendous! I will deliver this mail to the next '
-                    'recipient without fail! {}'.format(gen_roar()))
-        else:
-            if _random.random() < 0.3:
-                mail_info = self._database.get_old_mail()
-            else:
-                if _random.random() < 0.7:
-                    skip_username = session.message['username']
-                else:
-                    skip_username = None
-
-                mail_info = self._database.get_mail(skip_username=skip_username)
-
-                if not mail_info and _random.random() < 0.3:
-                    mail_info = self._database.get_old_mail()
-
-            if not mail_info:
-                session.reply(
-                    '{} Outlandish! There is no new mail! You should send some!'
-                    .format(gen_roar())
-                )
-            else:
-                session.reply(
-                    '{roar} I am delivering mail! '
-                    'Here it is, {date}, from {username}: {msg}'
-                    .format(
-                        roar=gen_roar(),
-                        username=mail_info['username'].title(),
-                        date=arrow.get(mail_info['timestamp']).humanize(),
-                        msg=mail_info['text']),
-                    multiline=True
-                )
-
-    def _mail_status_command(self, session):
-        unread_count = self._database.get_status_count('unread')
-        read_count = self._database.get_status_count('read')
-
-        session.reply(
-            '{roar} {unread} unread, {read} read, {total} total!'.format(
-                roar=gen_roar(),
-                unread=unread_count,
-                read=read_count,
-                total=unread_count + read_count
-            )
-        )
-
-    def _alert_important_food_change(self, title, isNow):
-        # This is only called if the title is different from what we already had in our variables
-        if re.search(r"\bjulia\b", title, re.I) or re.search(r"\bfrench\s+chef\b", title, re.I):
-            if isNow:
-                out = 'twitch.tv/food is now playing "{}"'.format(title)
-            else:
-                out = 'twitch.tv/food will play "{}" next'.format(title)
-
-            for channel in self._alert_channels:
-                self._bot.send_text(channel, 'PogChamp {}'.format(out))
-
-    def _log_food_nowplaying(self):
-        output = "{}: {}\n".format(self._food_current_updated.isoformat(), self._food_current)
-        with open(self.FOOD_LOG_FILENAME, "a") as logfile:
-            logfile.write(output)
-
-    def _collect_food_message(self, message):
-        text = message['text']
-
-        # What's next
-        whats_next = ""
-        match = re.fullmatch(r"\s*will play \"([^\"]+)\" next\s*", text, re.I)
-
-        if match and self._food_next != "voting":
-            # This particular format is invalid when voting
-            whats_next = match.group(1)
-
-        match = re.fullmatch(r"\s*the vote is done! the winner is \"([^\"]+)\" with [0-9]+ votes?\s*", text, re.I)
-
-        if match:
-            whats_next = match.group(1)
-
-        if whats_next and self._food_next != whats_next:
-            self._alert_important_food_change(whats_next, False)
-            self._food_next = whats_next
-            self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
-
-        # What's playing
-        match = re.fullmatch(r"\s*now playing \"([^\"]+)\"\s*", text, re.I)
-
-        if match:
-            whats_on = match.group(1)
-            if whats_on and self._food_current != whats_on:
-                self._alert_important_food_change(whats_on, True)
-                self._food_current = whats_on
-                self._food_current_updated = datetime.datetime.now(datetime.timezone.utc)
-                self._log_food_nowplaying()
-
-                # If this was previously "next", then now we don't know what "next" is.
-                if self._food_next == self._food_current:
-                    self._food_next = ""
-                    self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
 
-        # Voting in progress
-        if text == "TIME TO VOTE!":
-            whats_next = "voting"
-            if self._food_next != whats_next:
-                self._food_next = whats_next
-                self._food_next_updated = datetime.datetime.now(datetime.timezone.utc)
+@PLUGINS.register
+class WowPlugin(FeaturePlugin):
+    name = 'wow'
 
-    def _food_updated_string(self, dt):
-        if not dt:
-            return ""
+    def __init__(self, features):
+        super().__init__(features)
+        self._tellnext_generator = None
 
-        now = datetime.datetime.now(datetime.timezone.utc)
-        rd = dateutil.relativedelta.relativedelta(now, dt)
+        if self._config.get('tellnext_database'):
+            self._tellnext_generator = LazyResource(
+                'tellnext_generator', self._new_tellnext_generator)
 
-        attrs = ['years', 'months', 'days', 'hours', 'minutes', 'seconds']
-        human_readable = lambda delta: [
-            '%d %s' % (getattr(delta, attr), getattr(delta, attr) > 1 and attr or attr[:-1])
-            for attr in attrs if getattr(delta, attr)
-        ]
+    def _new_tellnext_generator(self):
+        # Imported here as tellnext is optional
+        from chatbot383.featurecomponents.tellnextdb import TellnextGenerator
 
-        hr = human_readable(rd)
-        if len(hr) > 0:
-            return "(last updated {} ago)".format(hr[0])
-        return ""
+        return TellnextGenerator(self._config['tellnext_database'])
 
-    def _food_current_command(self, session):
-        updated_string = self._food_updated_string(self._food_current_updated)
-        if not self._food_current:
-            session.reply(
-                '{} I have no idea what\'s playing on twitch.tv/food right now! :( {}'
-                .format(gen_roar(), updated_string)
-            )
-        else:
-            session.reply(
-                '{roar} twitch.tv/food is now playing "{title}"! {updated}'
-                .format(
-                    roar=gen_roar(),
-                    title=self._food_current,
-                    updated=updated_string
-                )
-            )
+    def get_resources(self):
+        return (self._tellnext_generator,) if self._tellnext_generator else ()
 
-    def _food_next_command(self, session):
-        updated_string = self._food_updated_string(self._food_next_updated)
-        if not self._food_next:
-            session.reply(
-                '{} I have no idea what\'s playing on twitch.tv/food next! :( {}'
-                .format(gen_roar(), updated_string)
-            )
+    @command(r'(?i)!(wow)($|\s.*)')
+    def _wow_command(self, session):
+        if self._tellnext_generator:
+            session.say('> {}'.format(
+                self._tellnext_generator.get().get_paragraph()))
         else:
-            title = self._food_next
-            if title == "voting":
-                message = "twitch.tv/food chat is currently voting for what to play next."
-            else:
-                message = 'twitch.tv/food will play "{}" next!'.format(title)
-            session.reply('{} {} {}'.format(gen_roar(), message, updated_string))
+            session.reply('{} Feature not available!'.format(gen_roar()))
 
 
 _seed = int.from_bytes(os.urandom(2500), 'big')  # copied from std lib
 
 
+def seed(value):
+    '''Make the feature responses repeatable, e.g. for replaying a capture.'''
+    _random.seed(value)
+
+
 def _reseed():
     # scrubs keep complaining about the rng so this function exists
     global _seed
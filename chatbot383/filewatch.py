@@ -0,0 +1,261 @@
+import collections
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_CLOEXEC = 0o2000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+_EVENT_HEADER = struct.Struct('iIII')
+
+FileSnapshot = collections.namedtuple('FileSnapshot', ['path', 'mtime', 'value'])
+
+
+class Inotify(object):
+    def __init__(self):
+        library_name = ctypes.util.find_library('c')
+
+        if not library_name:
+            raise OSError('libc not found')
+
+        self._libc = ctypes.CDLL(library_name, use_errno=True)
+        self._fd = self._libc.inotify_init1(IN_CLOEXEC)
+
+        if self._fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number))
+
+    def add_watch(self, path, mask=WATCH_MASK):
+        watch_descriptor = self._libc.inotify_add_watch(
+            self._fd, os.fsencode(path), mask)
+
+        if watch_descriptor < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number), path)
+
+        return watch_descriptor
+
+    def wait(self, timeout):
+        '''Return whether events are ready to read within the timeout.'''
+        readable, dummy, dummy = select.select([self._fd], [], [], timeout)
+
+        return bool(readable)
+
+    def close(self):
+        os.close(self._fd)
+
+    def read_events(self):
+        data = os.read(self._fd, 65536)
+        offset = 0
+
+        while offset < len(data):
+            watch_descriptor, mask, dummy, name_length = \
+                _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            name = data[offset:offset + name_length].rstrip(b'\x00')
+            offset += name_length
+
+            yield watch_descriptor, mask, os.fsdecode(name)
+
+
+def load_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+class FileWatcher(threading.Thread):
+    '''Watch JSON files and keep a parsed snapshot of each.
+
+    Files are parsed on this thread whenever they change. Readers call
+    `get()` for the latest snapshot and never touch the file themselves.
+    Uses inotify where available and polls modification times otherwise.
+    The watch tables are only touched while holding the lock, since
+    `watch()` may be called from other threads.
+    '''
+    def __init__(self, poll_interval=1.0):
+        super().__init__()
+        self.daemon = True
+        self.name = 'FileWatcher'
+        self._poll_interval = poll_interval
+        # Reentrant so a callback may call watch()
+        self._lock = threading.RLock()
+        self._watches = {}
+        self._snapshots = {}
+        self._seen_mtimes = {}
+        self._directory_watches = {}
+        # Dropped after a failure; closed by the watcher thread, which may
+        # be waiting on it
+        self._retired_inotify = None
+        self._thread_started = False
+
+        try:
+            self._inotify = Inotify()
+        except (OSError, AttributeError):
+            _logger.info('inotify unavailable. Polling files instead.')
+            self._inotify = None
+
+    def watch(self, path, formatter=None, callback=None):
+        '''Start watching a file.
+
+        `formatter` converts the parsed document into the value published
+        in the snapshot and should return something immutable. `callback`
+        is called on the watcher thread with each new snapshot, or on this
+        thread for the first one, and should hand off anything slow.
+        '''
+        path = os.path.abspath(path)
+
+        with self._lock:
+            self._watches[path] = (formatter, callback)
+
+            if self._inotify:
+                directory = os.path.dirname(path)
+
+                if directory not in self._directory_watches.values():
+                    try:
+                        watch_descriptor = self._inotify.add_watch(directory)
+                    except OSError:
+                        _logger.exception('Could not watch %s. Polling instead.',
+                                          directory)
+                        self._stop_inotify()
+                    else:
+                        self._directory_watches[watch_descriptor] = directory
+
+        self._reload(path)
+
+        with self._lock:
+            if not self._thread_started:
+                self._thread_started = True
+                self.start()
+
+    def _stop_inotify(self):
+        with self._lock:
+            if self._thread_started:
+                self._retired_inotify = self._inotify
+            else:
+                self._inotify.close()
+
+            self._inotify = None
+
+    def get(self, path):
+        return self._snapshots.get(os.path.abspath(path))
+
+    def run(self):
+        while True:
+            with self._lock:
+                retired_inotify = self._retired_inotify
+                self._retired_inotify = None
+
+            if retired_inotify:
+                retired_inotify.close()
+
+            if self._inotify:
+                self._process_inotify_events()
+            else:
+                self._poll_files()
+                time.sleep(self._poll_interval)
+
+    def _process_inotify_events(self):
+        changed_paths = set()
+        inotify = self._inotify
+
+        try:
+            # Returns now and then so a switch to polling is noticed
+            if not inotify.wait(self._poll_interval):
+                return
+
+            events = list(inotify.read_events())
+        except OSError:
+            _logger.exception('inotify read failed. Polling instead.')
+
+            with self._lock:
+                # Otherwise it was retired and is closed by the run loop
+                if self._inotify is inotify:
+                    self._inotify = None
+                    inotify.close()
+            return
+
+        with self._lock:
+            for watch_descriptor, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    changed_paths.update(self._watches)
+                    continue
+
+                directory = self._directory_watches.get(watch_descriptor)
+
+                if directory:
+                    path = os.path.join(directory, name)
+
+                    if path in self._watches:
+                        changed_paths.add(path)
+
+        for path in changed_paths:
+            self._reload(path)
+
+    def _poll_files(self):
+        with self._lock:
+            paths = tuple(self._watches)
+
+        for path in paths:
+            try:
+                mtime = os.path.getmtime(path)
+            except OSError:
+                mtime = None
+
+            with self._lock:
+                changed = self._seen_mtimes.get(path) != mtime
+
+            if changed:
+                self._reload(path)
+
+    def _reload(self, path):
+        # Held throughout so the first load in watch() and the watcher
+        # thread do not publish snapshots out of order
+        with self._lock:
+            self._reload_locked(path)
+
+    def _reload_locked(self, path):
+        formatter, callback = self._watches[path]
+
+        try:
+            mtime = os.path.getmtime(path)
+        except OSError:
+            self._seen_mtimes.pop(path, None)
+
+            if self._snapshots.pop(path, None):
+                _logger.info('Watched file %s removed', path)
+            return
+
+        self._seen_mtimes[path] = mtime
+
+        try:
+            value = load_json(path)
+
+            if formatter:
+                value = formatter(value)
+        except FileNotFoundError:
+            self._snapshots.pop(path, None)
+            return
+        except (OSError, ValueError, KeyError, IndexError, TypeError):
+            _logger.exception('Error reading watched file %s', path)
+            return
+
+        snapshot = FileSnapshot(path, mtime, value)
+        self._snapshots[path] = snapshot
+
+        if callback:
+            try:
+                callback(snapshot)
+            except Exception:
+                _logger.exception('Error in file watch callback for %s', path)
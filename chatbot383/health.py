@@ -0,0 +1,88 @@
+'''Connection liveness tracking and reconnect backoff.'''
+import random
+import time
+
+PING_INTERVAL = 30
+STALL_TIMEOUT = 45
+RECONNECT_MIN_INTERVAL = 1
+
+
+class Backoff(object):
+    '''Exponential backoff with jitter.
+
+    The first delay is short so a dropped connection is retried almost
+    immediately; repeated failures wait longer, up to `maximum`.
+    '''
+    def __init__(self, initial=RECONNECT_MIN_INTERVAL, maximum=120,
+                 rng=None):
+        self._initial = initial
+        self._maximum = maximum
+        self._rng = rng or random.Random()
+        self._attempts = 0
+
+    @property
+    def attempts(self):
+        return self._attempts
+
+    def next_delay(self):
+        delay = min(self._maximum, self._initial * 2 ** self._attempts)
+        self._attempts += 1
+
+        return self._rng.uniform(delay / 2, delay)
+
+    def reset(self):
+        self._attempts = 0
+
+
+class ConnectionHealth(object):
+    '''Track when the server was last heard from and the PING round trip.
+
+    Twitch only pings every few minutes, so we send our own PINGs to find
+    out early when a connection has silently died.
+    '''
+    def __init__(self, ping_interval=PING_INTERVAL,
+                 stall_timeout=STALL_TIMEOUT, clock=time.monotonic):
+        self._ping_interval = ping_interval
+        self._stall_timeout = stall_timeout
+        self._clock = clock
+        self._last_received = None
+        self._ping_token = None
+        self._ping_sent = None
+        self.last_rtt = None
+
+    def reset(self):
+        self._last_received = self._clock()
+        self._ping_token = None
+        self._ping_sent = self._last_received
+
+    def on_receive(self):
+        self._last_received = self._clock()
+
+    def get_idle_time(self):
+        if self._last_received is None:
+            return 0
+
+        return self._clock() - self._last_received
+
+    def is_stalled(self):
+        return self.get_idle_time() > self._stall_timeout
+
+    def should_ping(self):
+        return self._ping_sent is None or \
+            self._clock() - self._ping_sent >= self._ping_interval
+
+    def new_ping_token(self):
+        self._ping_sent = self._clock()
+        self._ping_token = 'chatbot383-{:.3f}'.format(self._ping_sent)
+
+        return self._ping_token
+
+    def on_pong(self, token):
+        '''Return the round trip time if the PONG answers our last PING.'''
+        if not self._ping_token or token != self._ping_token:
+            return None
+
+        self._ping_token = None
+        self.last_rtt = self._clock() - self._ping_sent
+
+        return self.last_rtt
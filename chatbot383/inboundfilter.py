@@ -0,0 +1,67 @@
+import collections
+import re
+import threading
+
+Interest = collections.namedtuple(
+    'Interest', ['event_types', 'channel_event_types', 'command_patterns',
+                 'ignored_users'])
+
+
+class InboundFilter(object):
+    '''Drop chat lines on the client thread before they are queued.
+
+    The bot publishes an `Interest` describing which lines it can use:
+    event types wanted in every channel, event types wanted only in some
+    channels, and command patterns. Publishing replaces the whole tuple so
+    client threads always see a consistent view without locking.
+    '''
+    def __init__(self):
+        self._interest = Interest(frozenset(), {}, (), frozenset())
+        self._drop_counts = collections.Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def interest(self):
+        return self._interest
+
+    def publish(self, event_types, command_patterns, ignored_users,
+                channel_event_types=None):
+        '''Replace the interest.
+
+        `channel_event_types` maps a channel to the event types wanted only
+        in that channel.
+        '''
+        self._interest = Interest(
+            frozenset(event_types),
+            dict((channel, frozenset(types)) for channel, types
+                 in (channel_event_types or {}).items()),
+            tuple(re.compile(pattern) for pattern in command_patterns),
+            frozenset(ignored_users)
+        )
+
+    def accept(self, event_type, channel, username, text, our_username):
+        interest = self._interest
+
+        if username in interest.ignored_users:
+            reason = 'ignored_user'
+        elif username == our_username:
+            reason = 'own_message'
+        elif event_type in interest.event_types or \
+                event_type in interest.channel_event_types.get(channel, ()):
+            return True
+        else:
+            for pattern in interest.command_patterns:
+                if pattern.match(text):
+                    return True
+
+            reason = 'no_interest'
+
+        with self._lock:
+            self._drop_counts[reason] += 1
+
+        return False
+
+    @property
+    def drop_counts(self):
+        with self._lock:
+            return dict(self._drop_counts)
@@ -0,0 +1,149 @@
+'''Inbound queue that serves channels fairly.
+
+Each channel has its own queue and the channels are served by deficit
+round-robin, so a flood in one channel does not delay the others. Events
+without a channel, such as welcome and whispers, are served first.
+
+The queue never blocks the client threads putting items. When a channel's
+queue, or the queue of events without a channel, is full, its oldest item
+is dropped. Welcome events are never dropped, since the bot joins its
+channels on them.
+'''
+import collections
+import threading
+
+from chatbot383 import metrics
+
+_dropped_items = metrics.counter(
+    'chatbot383_inbound_dropped_total',
+    'Inbound items dropped because their channel queue was full')
+
+MAX_CHANNEL_ITEMS = 100
+MAX_CONTROL_ITEMS = 100
+# Events without a channel that must not be dropped
+KEPT_EVENT_TYPES = frozenset(['welcome'])
+
+
+def check_shares(shares):
+    '''Return the shares as a dict, raising ValueError if one is not positive.
+
+    A channel with a share of zero or less would never be served, and the
+    round would go on forever.
+    '''
+    shares = dict(shares or {})
+
+    for channel, share in shares.items():
+        if isinstance(share, bool) or not isinstance(share, (int, float)) \
+                or not share > 0:
+            raise ValueError('Share of {} must be a positive number, not {!r}'
+                             .format(channel, share))
+
+    return shares
+
+
+class FairInboundQueue(object):
+    def __init__(self, shares=None, max_channel_items=MAX_CHANNEL_ITEMS,
+                 max_control_items=MAX_CONTROL_ITEMS):
+        self._shares = check_shares(shares)
+        self._max_channel_items = max_channel_items
+        self._max_control_items = max_control_items
+        self._control_items = collections.deque()
+        self._channel_items = {}
+        # Channels with waiting items, in service order, with their deficit
+        self._active = collections.OrderedDict()
+        self._size = 0
+        self._woken = False
+        self._condition = threading.Condition()
+
+    def qsize(self):
+        return self._size
+
+    def set_shares(self, shares):
+        shares = check_shares(shares)
+
+        with self._condition:
+            self._shares = shares
+
+    def put(self, item):
+        '''Add an item, dropping the oldest one of its kind if full.'''
+        channel = item.get('channel')
+
+        with self._condition:
+            if channel is None:
+                if len(self._control_items) >= self._max_control_items:
+                    self._drop_control_item()
+
+                self._control_items.append(item)
+            else:
+                items = self._channel_items.get(channel)
+
+                if items is None:
+                    items = self._channel_items[channel] = collections.deque()
+
+                if len(items) >= self._max_channel_items:
+                    items.popleft()
+                    self._size -= 1
+                    _dropped_items.inc()
+
+                items.append(item)
+
+                if channel not in self._active:
+                    self._active[channel] = 0
+
+            self._size += 1
+            self._condition.notify()
+
+    def _drop_control_item(self):
+        for index, item in enumerate(self._control_items):
+            if item.get('event_type') not in KEPT_EVENT_TYPES:
+                del self._control_items[index]
+                self._size -= 1
+                _dropped_items.inc()
+                return
+
+    def wakeup(self):
+        '''Make the current or next `get_batch` return without waiting.'''
+        with self._condition:
+            self._woken = True
+            self._condition.notify()
+
+    def get_batch(self, max_items, timeout=None):
+        '''Return up to `max_items` items, waiting until at least one.
+
+        Returns an empty list if nothing arrived within the timeout or
+        `wakeup` was called.
+        '''
+        with self._condition:
+            if not self._size and not self._woken:
+                self._condition.wait(timeout)
+
+            self._woken = False
+
+            batch = []
+
+            while self._control_items and len(batch) < max_items:
+                batch.append(self._control_items.popleft())
+
+            while self._active and len(batch) < max_items:
+                self._serve_next_channel(batch, max_items)
+
+            self._size -= len(batch)
+
+            return batch
+
+    def _serve_next_channel(self, batch, max_items):
+        channel, deficit = next(iter(self._active.items()))
+        items = self._channel_items[channel]
+        deficit += self._shares.get(channel, 1)
+
+        while items and deficit >= 1 and len(batch) < max_items:
+            batch.append(items.popleft())
+            deficit -= 1
+
+        if items:
+            # Keep the remaining deficit and move to the back of the round
+            del self._active[channel]
+            self._active[channel] = deficit
+        else:
+            del self._active[channel]
+            del self._channel_items[channel]
@@ -0,0 +1,255 @@
+'''Drive a real App against the fake Twitch server and measure it.
+
+Each viewer line goes to a random channel. A fraction of the lines are
+``!help`` commands from unique viewers. The bot answers those with
+``@Nick, ...``, so every reply can be matched to the command it answers.
+'''
+import argparse
+import json
+import logging
+import os
+import queue
+import random
+import re
+import shutil
+import tempfile
+import threading
+import time
+
+from chatbot383 import metrics
+from chatbot383.fakeserver import FakeTwitchServer
+from chatbot383.logsetup import setup_logging
+
+_logger = logging.getLogger(__name__)
+
+BOT_USERNAME = 'chatbot383'
+REPLY_NICK_PATTERN = re.compile(r'@(\w+),')
+CHAT_LINES = (
+    'PogChamp', 'Kappa', 'left', 'right', 'a', 'b', 'start', 'democracy',
+    'anarchy', 'ヽ༼ຈل͜ຈ༽ﾉ raise your dongers ヽ༼ຈل͜ຈ༽ﾉ',
+    'this is a perfectly ordinary chat line',
+)
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+
+    return values[index]
+
+
+def get_metric_total(name, label_index=None, label_value=None):
+    metric = metrics.REGISTRY.get(name)
+    total = 0
+
+    if not metric:
+        return total
+
+    for label_values, value in metric.collect().items():
+        if label_index is not None and label_values[label_index] != label_value:
+            continue
+
+        if isinstance(value, list):
+            value = value[-1]
+
+        total += value
+
+    return total
+
+
+class LoadTest(object):
+    def __init__(self, channel_count=10, lines_per_second=50,
+                 command_ratio=0.02, duration=30, reply_timeout=10,
+                 extra_config=None, moderator_channels=0, slow_channels=0,
+                 slow_seconds=30):
+        self._channels = ['#loadtest{}'.format(index)
+                          for index in range(channel_count)]
+        self._lines_per_second = lines_per_second
+        self._command_ratio = command_ratio
+        self._duration = duration
+        self._reply_timeout = reply_timeout
+        self._extra_config = extra_config or {}
+        self._moderator_channels = self._channels[:moderator_channels]
+        self._slow_channels = self._channels[
+            len(self._channels) - slow_channels:] if slow_channels else []
+        self._slow_seconds = slow_seconds
+        self._pending_commands = {}
+        self._latencies = []
+        self._random = random.Random(383)
+
+    def run(self):
+        server = FakeTwitchServer()
+        server.start()
+
+        for channel in self._moderator_channels:
+            server.set_moderator(channel, BOT_USERNAME)
+
+        for channel in self._slow_channels:
+            server.set_slow(channel, self._slow_seconds)
+
+        temp_dir = tempfile.mkdtemp(prefix='chatbot383-loadtest-')
+
+        try:
+            self._start_app(server, temp_dir)
+            self._wait_for_joins(server)
+            return self._drive(server)
+        finally:
+            server.stop()
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _start_app(self, server, temp_dir):
+        from chatbot383.app import App
+
+        address = '127.0.0.1:{}'.format(server.port)
+        config = {
+            'main_server': address,
+            'group_server': address,
+            'ssl': False,
+            'username': BOT_USERNAME,
+            'password': 'oauth:loadtest',
+            'channels': self._channels,
+            'help_text': 'Load test.',
+            'database': os.path.join(temp_dir, 'loadtest.db'),
+            'memory_report_interval': 3600,
+        }
+        config.update(self._extra_config)
+
+        app = App(config)
+        thread = threading.Thread(target=app.run, name='LoadTestApp')
+        thread.daemon = True
+        thread.start()
+
+    def _wait_for_joins(self, server, timeout=60):
+        deadline = time.monotonic() + timeout
+
+        while time.monotonic() < deadline:
+            if server.get_joined_channels(BOT_USERNAME) >= set(self._channels):
+                return
+
+            time.sleep(0.1)
+
+        raise RuntimeError('Bot did not join all channels')
+
+    def _drive(self, server):
+        processed_before = get_metric_total('chatbot383_process_message_seconds')
+        sent_lines = 0
+        sent_commands = 0
+        replies = 0
+        interval = 1 / self._lines_per_second
+        start_time = time.monotonic()
+        next_time = start_time
+
+        while time.monotonic() - start_time < self._duration:
+            time_now = time.monotonic()
+
+            while next_time <= time_now:
+                sent_lines += 1
+                sent_commands += self._send_line(server, sent_lines)
+                next_time += interval
+
+            replies += self._collect_replies(server, next_time - time.monotonic())
+
+        drive_duration = time.monotonic() - start_time
+        deadline = time.monotonic() + self._reply_timeout
+
+        while self._pending_commands and time.monotonic() < deadline:
+            replies += self._collect_replies(server, 0.1)
+
+        processed = get_metric_total('chatbot383_process_message_seconds') - \
+            processed_before
+
+        return {
+            'channels': len(self._channels),
+            'duration': drive_duration,
+            'sent_lines': sent_lines,
+            'sent_lines_per_second': sent_lines / drive_duration,
+            'processed_items': processed,
+            'processed_per_second': processed / drive_duration,
+            'sent_commands': sent_commands,
+            'replies': replies,
+            'answered_commands': len(self._latencies),
+            'unanswered_commands': len(self._pending_commands),
+            'limiter_rejections': get_metric_total(
+                'chatbot383_limiter_rejections_total'),
+            'server_rejected': dict(server.rejected_counts),
+            'latency_p50': percentile(self._latencies, 0.5),
+            'latency_p90': percentile(self._latencies, 0.9),
+            'latency_p99': percentile(self._latencies, 0.99),
+            'latency_max': max(self._latencies) if self._latencies else None,
+        }
+
+    def _send_line(self, server, index):
+        channel = self._random.choice(self._channels)
+
+        if self._random.random() < self._command_ratio:
+            nick = 'Commander{}'.format(index)
+            self._pending_commands[nick] = time.monotonic()
+            server.send_privmsg(channel, nick, '!help')
+            return 1
+        else:
+            nick = 'Viewer{}'.format(self._random.randint(1, 10000))
+            server.send_privmsg(channel, nick, self._random.choice(CHAT_LINES))
+            return 0
+
+    def _collect_replies(self, server, timeout):
+        count = 0
+
+        try:
+            message = server.received.get(timeout=max(0, timeout))
+        except queue.Empty:
+            return count
+
+        while True:
+            count += 1
+
+            # Coalesced lines answer several commands at once
+            for nick in REPLY_NICK_PATTERN.findall(message.text):
+                sent_time = self._pending_commands.pop(nick, None)
+
+                if sent_time is not None:
+                    self._latencies.append(message.timestamp - sent_time)
+
+            try:
+                message = server.received.get_nowait()
+            except queue.Empty:
+                return count
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('--channels', type=int, default=10)
+    arg_parser.add_argument('--rate', type=float, default=50,
+                            help='Viewer lines per second over all channels')
+    arg_parser.add_argument('--command-ratio', type=float, default=0.02)
+    arg_parser.add_argument('--duration', type=float, default=30)
+    arg_parser.add_argument('--moderator-channels', type=int, default=0,
+                            help='Number of channels where the bot is a moderator')
+    arg_parser.add_argument('--slow-channels', type=int, default=0,
+                            help='Number of channels in slow mode')
+    arg_parser.add_argument('--slow-seconds', type=int, default=30)
+    arg_parser.add_argument('--config', help='JSON file with extra bot config')
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    setup_logging(logging.DEBUG if args.debug else logging.WARNING)
+
+    extra_config = None
+
+    if args.config:
+        with open(args.config) as file:
+            extra_config = json.load(file)
+
+    load_test = LoadTest(
+        channel_count=args.channels, lines_per_second=args.rate,
+        command_ratio=args.command_ratio, duration=args.duration,
+        extra_config=extra_config, moderator_channels=args.moderator_channels,
+        slow_channels=args.slow_channels, slow_seconds=args.slow_seconds)
+
+    print(json.dumps(load_test.run(), indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
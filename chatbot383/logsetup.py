@@ -0,0 +1,219 @@
+'''Logging that stays off the dispatch path.
+
+Records are put on a queue by the calling thread and formatted and written
+by a background thread. Debug records from chatty loggers can be sampled
+or capped per second before they are queued. Records can be written as
+one JSON object per line.
+
+The calling thread merges the message with its arguments and renders any
+traceback, as the standard `QueueHandler` does, so a record shows the
+state at the time it was logged. Records dropped by sampling are never
+formatted.
+'''
+import atexit
+import collections
+import copy
+import json
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+
+from chatbot383 import metrics
+
+_dropped_records = metrics.counter(
+    'chatbot383_log_records_dropped_total',
+    'Log records dropped before being written', ('logger', 'reason'))
+
+DEFAULT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+MAX_QUEUED_RECORDS = 10000
+
+# Attributes every LogRecord has; anything else came from `extra`
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord(
+    '', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        doc = {
+            'time': record.created,
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES:
+                doc[key] = value
+
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+
+        if record.exc_text:
+            doc['exception'] = record.exc_text
+
+        return json.dumps(doc, default=repr, ensure_ascii=False)
+
+
+class LogSampler(logging.Filter):
+    '''Drop records from chatty loggers before they are queued.
+
+    `sample_rates` maps a logger name (and its children) to the fraction of
+    records below WARNING to keep. `rate_limits` maps a logger name to the
+    records per second below WARNING it may log, with bursts of up to one
+    second's worth. Warnings and errors are always kept.
+    '''
+    def __init__(self, sample_rates=None, rate_limits=None,
+                 clock=time.monotonic):
+        super().__init__()
+        self._sample_rates = dict(sample_rates or {})
+        self._rate_limits = dict(rate_limits or {})
+        self._clock = clock
+        # Starting with credit keeps the first record of each logger
+        self._sample_credit = collections.defaultdict(lambda: 1.0)
+        self._tokens = {}
+        self._refilled = {}
+        self._prefixes = {}
+        self._lock = threading.Lock()
+
+    def _get_prefix(self, name, table):
+        key = (name, id(table))
+        prefix = self._prefixes.get(key, False)
+
+        if prefix is False:
+            prefix = None
+            parts = name.split('.')
+
+            for length in range(len(parts), 0, -1):
+                candidate = '.'.join(parts[:length])
+
+                if candidate in table:
+                    prefix = candidate
+                    break
+
+            self._prefixes[key] = prefix
+
+        return prefix
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING:
+            return True
+
+        if self._sample_rates:
+            prefix = self._get_prefix(record.name, self._sample_rates)
+
+            if prefix is not None and not self._sample(prefix):
+                _dropped_records.inc(prefix, 'sampled')
+                return False
+
+        if self._rate_limits:
+            prefix = self._get_prefix(record.name, self._rate_limits)
+
+            if prefix is not None and not self._take_token(prefix):
+                _dropped_records.inc(prefix, 'rate_limited')
+                return False
+
+        return True
+
+    def _sample(self, prefix):
+        # Keeps an even spread, e.g. every 10th record for 0.1
+        with self._lock:
+            self._sample_credit[prefix] += self._sample_rates[prefix]
+
+            if self._sample_credit[prefix] >= 1:
+                self._sample_credit[prefix] -= 1
+                return True
+
+        return False
+
+    def _take_token(self, prefix):
+        rate = self._rate_limits[prefix]
+        # A rate below one a second still needs room for a whole record
+        capacity = max(1, rate)
+        time_now = self._clock()
+
+        with self._lock:
+            tokens = self._tokens.get(prefix, capacity)
+            elapsed = time_now - self._refilled.get(prefix, time_now)
+            tokens = min(capacity, tokens + elapsed * rate)
+            self._refilled[prefix] = time_now
+
+            if tokens < 1:
+                self._tokens[prefix] = tokens
+                return False
+
+            self._tokens[prefix] = tokens - 1
+
+        return True
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    '''Queue records with their message merged and never block.'''
+    _exception_formatter = logging.Formatter()
+
+    def prepare(self, record):
+        # Unlike the standard handler, the layout is left to the writer
+        # thread; only what may change after the call is rendered here
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self._exception_formatter.formatException(
+                    record.exc_info)
+
+            record.exc_info = None
+
+        return record
+
+    def enqueue(self, record):
+        # SimpleQueue is much cheaper to put on than Queue but unbounded
+        if self.queue.qsize() >= MAX_QUEUED_RECORDS:
+            _dropped_records.inc(record.name, 'queue_full')
+        else:
+            self.queue.put_nowait(record)
+
+
+class BackgroundListener(logging.handlers.QueueListener):
+    def stop(self):
+        # Also called at exit, which may be after an explicit stop
+        if self._thread:
+            super().stop()
+
+
+def setup_logging(level=logging.INFO, json_format=False, sample_rates=None,
+                  rate_limits=None, log_format=DEFAULT_FORMAT, stream=None):
+    '''Send the root logger's records through a queue to a stream.
+
+    Returns the `QueueListener` writing the records. It is stopped, and
+    the queue flushed, at exit.
+    '''
+    stream_handler = logging.StreamHandler(stream)
+
+    if json_format:
+        stream_handler.setFormatter(JsonFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(log_format))
+
+    record_queue = queue.SimpleQueue()
+    queue_handler = BackgroundQueueHandler(record_queue)
+
+    if sample_rates or rate_limits:
+        queue_handler.addFilter(LogSampler(sample_rates, rate_limits))
+
+    root_logger = logging.getLogger()
+
+    for handler in tuple(root_logger.handlers):
+        root_logger.removeHandler(handler)
+
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(level)
+
+    listener = BackgroundListener(record_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    return listener
@@ -0,0 +1,122 @@
+import collections
+import logging
+import sys
+import tracemalloc
+
+from chatbot383 import metrics
+
+_logger = logging.getLogger(__name__)
+_entries_gauge = metrics.gauge(
+    'chatbot383_memory_entries', 'Entries held by a structure', ('structure',))
+_bytes_gauge = metrics.gauge(
+    'chatbot383_memory_bytes', 'Approximate bytes held by a structure',
+    ('structure',))
+
+MemoryUsage = collections.namedtuple('MemoryUsage', ['entries', 'bytes'])
+
+
+def approximate_size(obj, max_depth=4, _seen=None):
+    '''Sum `sys.getsizeof` over an object and the containers inside it.'''
+    if _seen is None:
+        _seen = set()
+
+    if id(obj) in _seen:
+        return 0
+
+    _seen.add(id(obj))
+    size = sys.getsizeof(obj)
+
+    if max_depth <= 0:
+        return size
+
+    if isinstance(obj, dict):
+        for key, value in tuple(obj.items()):
+            size += approximate_size(key, max_depth - 1, _seen)
+            size += approximate_size(value, max_depth - 1, _seen)
+    elif isinstance(obj, (list, tuple, set, frozenset, collections.deque)):
+        for item in tuple(obj):
+            size += approximate_size(item, max_depth - 1, _seen)
+    elif hasattr(obj, '__dict__') and not isinstance(obj, type):
+        size += approximate_size(vars(obj), max_depth - 1, _seen)
+
+    return size
+
+
+def measure(obj):
+    if isinstance(obj, MemoryUsage):
+        return obj
+
+    try:
+        entries = len(obj)
+    except TypeError:
+        entries = 1
+
+    return MemoryUsage(entries, approximate_size(obj))
+
+
+class MemoryAccountant(object):
+    '''Report the size of long-lived structures registered as probes.
+
+    A probe is a function returning the structure to measure, or a
+    `MemoryUsage` when the structure cannot be walked directly.
+    '''
+    def __init__(self, warn_entries=100000):
+        self._warn_entries = warn_entries
+        self._probes = collections.OrderedDict()
+        self._tracemalloc_snapshot = None
+
+    def register(self, name, func, warn_entries=None):
+        self._probes[name] = (func, warn_entries or self._warn_entries)
+
+    def measure(self):
+        results = collections.OrderedDict()
+
+        for name, (func, warn_entries) in self._probes.items():
+            try:
+                results[name] = measure(func())
+            except Exception:
+                _logger.exception('Memory probe %s failed', name)
+
+        return results
+
+    def report(self):
+        results = self.measure()
+
+        for name, usage in results.items():
+            _entries_gauge.set(usage.entries, name)
+            _bytes_gauge.set(usage.bytes, name)
+            _logger.info('Memory %s: %s entries, ~%s bytes',
+                         name, usage.entries, usage.bytes)
+
+            warn_entries = self._probes[name][1]
+
+            if usage.entries > warn_entries:
+                _logger.warning('Memory %s has grown to %s entries (limit %s)',
+                                name, usage.entries, warn_entries)
+
+        return results
+
+    def tracemalloc_diff(self, limit=15):
+        '''Log the allocation sites that grew since the previous call.
+
+        The first call only starts tracing when it is not already active.
+        '''
+        if not tracemalloc.is_tracing():
+            _logger.info('Starting tracemalloc')
+            tracemalloc.start()
+            self._tracemalloc_snapshot = tracemalloc.take_snapshot()
+            return
+
+        snapshot = tracemalloc.take_snapshot()
+        previous_snapshot = self._tracemalloc_snapshot
+        self._tracemalloc_snapshot = snapshot
+
+        if not previous_snapshot:
+            return
+
+        stats = snapshot.compare_to(previous_snapshot, 'lineno')
+
+        for stat in stats[:limit]:
+            _logger.info('tracemalloc %s', stat)
+
+        return stats[:limit]
@@ -0,0 +1,56 @@
+'''Who is in each channel, from the twitch.tv/membership capability.
+
+Twitch sends JOIN and PART in bursts every few seconds plus a NAMES list
+on join (only for channels below about 1000 chatters). Clients queue the
+changes and apply them together. Usernames are interned, so a user in many
+channels is stored once, and each channel is a set for O(1) lookups.
+'''
+import sys
+import threading
+
+
+class MembershipTracker(object):
+    def __init__(self):
+        self._channels = {}
+        self._lock = threading.Lock()
+
+    def apply(self, changes):
+        '''Apply a batch of ``(action, channel, usernames)`` changes.
+
+        The action is ``join``, ``part`` or ``drop``, which forgets the
+        channel.
+        '''
+        with self._lock:
+            for action, channel, usernames in changes:
+                if action == 'drop':
+                    self._channels.pop(channel, None)
+                    continue
+
+                members = self._channels.get(channel)
+
+                if members is None:
+                    if action != 'join':
+                        continue
+
+                    members = self._channels[channel] = set()
+
+                if action == 'join':
+                    members.update(sys.intern(username)
+                                   for username in usernames)
+                else:
+                    members.difference_update(usernames)
+
+    def is_present(self, channel, username):
+        members = self._channels.get(channel)
+        return members is not None and username in members
+
+    def count(self, channel):
+        return len(self._channels.get(channel, ()))
+
+    def get_counts(self):
+        with self._lock:
+            return dict((channel, len(members))
+                        for channel, members in self._channels.items())
+
+    def __len__(self):
+        return sum(self.get_counts().values())
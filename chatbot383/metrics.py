@@ -0,0 +1,305 @@
+import bisect
+import collections
+import contextlib
+import http.server
+import logging
+import os
+import socketserver
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Metric(object):
+    '''Base for metrics that accumulate values per thread.
+
+    Each thread writes only to its own dict, so updates never take a lock.
+    Collecting sums the dicts of every thread that ever touched the metric.
+    '''
+    type_name = None
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = tuple(label_names)
+        self._local = threading.local()
+        self._thread_values = []
+        self._lock = threading.Lock()
+        self._function = None
+
+    def _values(self):
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = {}
+
+            with self._lock:
+                self._thread_values.append(values)
+
+            return values
+
+    def set_function(self, func):
+        '''Compute the value when collected instead of accumulating it.
+
+        `func` returns a number, or a dict mapping tuples of label values
+        to numbers.
+        '''
+        self._function = func
+
+    def collect(self):
+        '''Return a dict mapping tuples of label values to values.'''
+        if self._function:
+            value = self._function()
+
+            if isinstance(value, dict):
+                return value
+            else:
+                return {(): value}
+
+        with self._lock:
+            thread_values = tuple(self._thread_values)
+
+        merged = {}
+
+        for values in thread_values:
+            for key, value in values.copy().items():
+                merged[key] = self._merge(merged.get(key), value)
+
+        return merged
+
+    def _merge(self, total, value):
+        return (total or 0) + value
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+        ]
+
+        for label_values, value in sorted(self.collect().items()):
+            lines.append('{}{} {}'.format(
+                self.name, format_labels(self.label_names, label_values),
+                format_value(value)))
+
+        return lines
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, *label_values, amount=1):
+        values = self._values()
+        values[label_values] = values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    type_name = 'gauge'
+
+    def __init__(self, name, help_text, label_names=()):
+        super().__init__(name, help_text, label_names)
+        self._gauge_values = {}
+
+    def set(self, value, *label_values):
+        self._gauge_values[label_values] = value
+
+    def collect(self):
+        if self._function:
+            return super().collect()
+
+        return self._gauge_values.copy()
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name, help_text, label_names=(),
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, label_names)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *label_values):
+        values = self._values()
+        state = values.get(label_values)
+
+        if state is None:
+            # Bucket counts including +Inf, then the sum and the count
+            state = values[label_values] = [0] * (len(self.buckets) + 3)
+
+        state[bisect.bisect_left(self.buckets, value)] += 1
+        state[-2] += value
+        state[-1] += 1
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start_time, *label_values)
+
+    def _merge(self, total, value):
+        if total is None:
+            return list(value)
+
+        return [a + b for a, b in zip(total, value)]
+
+    def render(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.help_text),
+            '# TYPE {} {}'.format(self.name, self.type_name),
+        ]
+        label_names = self.label_names + ('le',)
+
+        for label_values, state in sorted(self.collect().items()):
+            cumulative = 0
+
+            for bucket, count in zip(self.buckets + ('+Inf',), state):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name,
+                    format_labels(label_names, label_values + (bucket,)),
+                    cumulative))
+
+            labels = format_labels(self.label_names, label_values)
+            lines.append('{}_sum{} {}'.format(
+                self.name, labels, format_value(state[-2])))
+            lines.append('{}_count{} {}'.format(self.name, labels, state[-1]))
+
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+
+            if not metric:
+                metric = self._metrics[name] = \
+                    metric_class(name, *args, **kwargs)
+            elif not isinstance(metric, metric_class):
+                raise ValueError('Metric {} already registered as {}'
+                                 .format(name, metric.type_name))
+
+            return metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def counter(self, name, help_text, label_names=()):
+        return self._get_or_create(Counter, name, help_text, label_names)
+
+    def gauge(self, name, help_text, label_names=()):
+        return self._get_or_create(Gauge, name, help_text, label_names)
+
+    def histogram(self, name, help_text, label_names=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self._get_or_create(Histogram, name, help_text, label_names,
+                                   buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = tuple(self._metrics.values())
+
+        lines = []
+
+        for metric in metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception:
+                _logger.exception('Error collecting metric %s', metric.name)
+
+        lines.append('')
+
+        return '\n'.join(lines)
+
+    def dump_to_file(self, path):
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'w', encoding='utf-8') as file:
+            file.write(self.render())
+
+        os.replace(temp_path, path)
+
+
+def format_labels(label_names, label_values):
+    if not label_names:
+        return ''
+
+    return '{' + ','.join(
+        '{}="{}"'.format(name, escape_label_value(value))
+        for name, value in zip(label_names, label_values)
+    ) + '}'
+
+
+def escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n')\
+        .replace('"', '\\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    else:
+        return str(value)
+
+
+REGISTRY = Registry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
+
+
+class _MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+
+        body = self.registry.render().encode('utf-8')
+
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug('Metrics request: ' + format, *args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+
+class MetricsServer(threading.Thread):
+    '''Serve the registry in the Prometheus text format.'''
+    def __init__(self, host='127.0.0.1', port=9383, registry=REGISTRY):
+        super().__init__()
+        self.daemon = True
+        self.name = 'MetricsServer'
+        handler_class = type('MetricsRequestHandler',
+                             (_MetricsRequestHandler,),
+                             {'registry': registry})
+        self._server = _ThreadingHTTPServer((host, port), handler_class)
+
+    @property
+    def server_address(self):
+        return self._server.server_address
+
+    def run(self):
+        self._server.serve_forever()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,116 @@
+'''Outbound pacing that follows the Twitch chat limits per channel.
+
+The send budget is shared by the whole connection, but a line sent to a
+channel where we are a moderator or the broadcaster may use the larger
+moderator budget. Non-moderators must also wait out slow mode and may
+not send more than one line per second to the same channel.
+'''
+import collections
+import time
+
+SEND_WINDOW = 30
+SEND_LIMIT = 20 - 1
+MODERATOR_SEND_LIMIT = 100 - 1
+CHANNEL_INTERVAL = 1
+SLOW_MODE_MARGIN = 0.25
+JOIN_WINDOW = 10
+JOIN_LIMIT = 20 - 1
+
+ChannelState = collections.namedtuple('ChannelState', ['moderator', 'slow'])
+
+
+def is_moderator_tags(tags):
+    if tags.get('mod') == '1':
+        return True
+
+    badges = tags.get('badges') or ''
+
+    return any(badge.split('/', 1)[0] in ('broadcaster', 'moderator')
+               for badge in badges.split(','))
+
+
+class SendPacer(object):
+    '''Track sends and channel states to pace outbound lines.
+
+    The budget is per account, so when several worker processes send as the
+    same account each one gets a `share` of it.
+    '''
+    def __init__(self, clock=time.monotonic, share=1.0):
+        self._clock = clock
+        self._send_limit = max(1, int(SEND_LIMIT * share))
+        self._moderator_send_limit = max(1, int(MODERATOR_SEND_LIMIT * share))
+        self._join_limit = max(1, int(JOIN_LIMIT * share))
+        self._send_times = collections.deque(maxlen=self._moderator_send_limit)
+        self._join_times = collections.deque(maxlen=self._join_limit)
+        self._channel_states = {}
+        self._last_channel_send = {}
+
+    def get_channel_state(self, channel):
+        return self._channel_states.get(channel, ChannelState(False, 0))
+
+    def update_user_state(self, channel, tags):
+        state = self.get_channel_state(channel)
+        self._channel_states[channel] = state._replace(
+            moderator=is_moderator_tags(tags))
+
+    def update_room_state(self, channel, tags):
+        # ROOMSTATE updates only carry the tags that changed
+        if 'slow' not in tags:
+            return
+
+        try:
+            slow = int(tags['slow'] or 0)
+        except ValueError:
+            return
+
+        state = self.get_channel_state(channel)
+        self._channel_states[channel] = state._replace(slow=slow)
+
+    def forget_channel(self, channel):
+        self._channel_states.pop(channel, None)
+        self._last_channel_send.pop(channel, None)
+
+    def get_send_delay(self, channel):
+        '''Return the seconds to wait before a line may be sent to channel.'''
+        time_now = self._clock()
+        state = self.get_channel_state(channel)
+
+        if state.moderator:
+            limit = self._moderator_send_limit
+        else:
+            limit = self._send_limit
+
+        delay = self._get_window_delay(
+            self._send_times, limit, SEND_WINDOW, time_now)
+
+        last_send = self._last_channel_send.get(channel)
+
+        if not state.moderator and last_send is not None:
+            if state.slow:
+                interval = state.slow + SLOW_MODE_MARGIN
+            else:
+                interval = CHANNEL_INTERVAL
+
+            delay = max(delay, last_send + interval - time_now)
+
+        return delay
+
+    def get_join_delay(self):
+        return self._get_window_delay(
+            self._join_times, self._join_limit, JOIN_WINDOW, self._clock())
+
+    @classmethod
+    def _get_window_delay(cls, timestamps, limit, window, time_now):
+        if len(timestamps) < limit:
+            return 0
+
+        # The oldest of the last `limit` sends has to leave the window
+        return max(0, timestamps[-limit] + window - time_now)
+
+    def record_send(self, channel):
+        time_now = self._clock()
+        self._send_times.append(time_now)
+        self._last_channel_send[channel] = time_now
+
+    def record_join(self):
+        self._join_times.append(self._clock())
@@ -0,0 +1,204 @@
+'''Feature plugins and lazily created resources.
+
+A plugin groups the commands, message handlers and scheduled jobs of one
+feature. Only plugins enabled by the config are created, so disabled
+features do not load anything. Expensive objects are wrapped in
+`LazyResource` and built on first use, or ahead of time in a background
+thread.
+'''
+import itertools
+import logging
+import threading
+import time
+
+from chatbot383 import metrics
+
+_logger = logging.getLogger(__name__)
+_load_duration = metrics.gauge(
+    'chatbot383_resource_load_seconds', 'Time taken to load a resource',
+    ('resource',))
+
+_declaration_counter = itertools.count()
+
+
+def command(regex):
+    '''Declare a plugin method as a command matching `regex`.'''
+    def decorator(func):
+        func.plugin_declaration = ('command', next(_declaration_counter),
+                                   regex)
+        return func
+    return decorator
+
+
+def message_handler(*event_types, skip_duplicates=False, channels=None):
+    '''Declare a plugin method as a handler for the event types.
+
+    `channels` limits it to lines from those channels.
+    '''
+    def decorator(func):
+        func.plugin_declaration = ('message_handler',
+                                   next(_declaration_counter),
+                                   (event_types, skip_duplicates, channels))
+        return func
+    return decorator
+
+
+def scheduled(interval, jitter=0):
+    '''Declare a plugin method to be run every `interval` seconds.'''
+    def decorator(func):
+        func.plugin_declaration = ('scheduled', next(_declaration_counter),
+                                   (interval, jitter))
+        return func
+    return decorator
+
+
+class LazyResource(object):
+    '''Build a value with `factory` the first time it is needed.'''
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._value = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def get(self):
+        if self._loaded:
+            return self._value
+
+        with self._lock:
+            if not self._loaded:
+                _logger.info('Loading %s', self._name)
+                start_time = time.monotonic()
+                self._value = self._factory()
+                self._loaded = True
+                duration = time.monotonic() - start_time
+                _load_duration.set(duration, self._name)
+                _logger.info('Loaded %s in %.2f s', self._name, duration)
+
+        return self._value
+
+    def warm(self):
+        '''Load in a background thread so the first use does not wait.'''
+        thread = threading.Thread(target=self._warm,
+                                  name='Warm {}'.format(self._name))
+        thread.daemon = True
+        thread.start()
+
+    def _warm(self):
+        try:
+            self.get()
+        except Exception:
+            # Tried again, and reported to the user, on first use
+            _logger.exception('Could not load %s', self._name)
+
+
+class Plugin(object):
+    '''A feature that can be turned on and off in the config.
+
+    A plugin is enabled if any of its `config_keys` is set, or always if it
+    is `enabled_by_default`. The ``plugins`` config object can turn a
+    plugin on or off by name.
+    '''
+    name = None
+    config_keys = ()
+    enabled_by_default = False
+
+    def __init__(self, features):
+        self._features = features
+        self._bot = features.bot
+        self._config = features.config
+
+    @classmethod
+    def is_enabled(cls, config):
+        override = (config.get('plugins') or {}).get(cls.name)
+
+        if override is not None:
+            return bool(override)
+
+        return cls.enabled_by_default or \
+            any(config.get(key) for key in cls.config_keys)
+
+    def get_declarations(self):
+        declarations = []
+
+        for attribute_name in dir(type(self)):
+            declaration = getattr(getattr(type(self), attribute_name),
+                                  'plugin_declaration', None)
+
+            if declaration:
+                kind, order, argument = declaration
+                declarations.append(
+                    (order, kind, argument, getattr(self, attribute_name)))
+
+        declarations.sort(key=lambda item: item[0])
+
+        return [(kind, argument, func)
+                for dummy, kind, argument, func in declarations]
+
+    def register(self):
+        '''Add the declared commands, handlers and jobs to the bot.'''
+        for kind, argument, func in self.get_declarations():
+            if kind == 'command':
+                self._bot.register_command(argument, func)
+            elif kind == 'message_handler':
+                event_types, skip_duplicates, channels = argument
+
+                for event_type in event_types:
+                    self._bot.register_message_handler(
+                        event_type, func, skip_duplicates=skip_duplicates,
+                        channels=channels)
+            else:
+                interval, jitter = argument
+                self._bot.scheduler.every(
+                    interval, func, jitter=jitter,
+                    name='{}.{}'.format(self.name, func.__name__))
+
+    def get_resources(self):
+        '''Return the `LazyResource` instances to warm at startup.'''
+        return ()
+
+    def get_state(self):
+        '''Return state to keep across restarts, as JSON friendly values.
+
+        Called on the dispatch thread; the values must be copies.
+        '''
+        return None
+
+    def set_state(self, state):
+        pass
+
+    def register_memory_probes(self, accountant):
+        pass
+
+
+class PluginRegistry(object):
+    def __init__(self):
+        self._plugin_classes = []
+
+    def register(self, plugin_class):
+        '''Add a plugin class. Can be used as a class decorator.'''
+        self._plugin_classes.append(plugin_class)
+        return plugin_class
+
+    @property
+    def plugin_classes(self):
+        return tuple(self._plugin_classes)
+
+    def get_enabled(self, config):
+        unknown_names = frozenset(config.get('plugins') or ()) - \
+            frozenset(plugin_class.name for plugin_class in self._plugin_classes)
+
+        if unknown_names:
+            _logger.warning('Unknown plugins in config: %s',
+                            ', '.join(sorted(unknown_names)))
+
+        return [plugin_class for plugin_class in self._plugin_classes
+                if plugin_class.is_enabled(config)]
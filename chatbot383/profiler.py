@@ -0,0 +1,128 @@
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+
+def get_code(func):
+    func = getattr(func, '__func__', func)
+    return getattr(func, '__code__', None)
+
+
+def format_frame(frame):
+    code = frame.f_code
+    module_name = frame.f_globals.get('__name__', '?')
+
+    return '{}:{}'.format(module_name, getattr(code, 'co_qualname', code.co_name))
+
+
+class SamplingProfiler(object):
+    '''Sample the stacks of all threads for a while on request.
+
+    Nothing runs until `start()` is called, so there is no overhead while
+    idle. Output is in the collapsed stack format used by flamegraph tools.
+    Only threads of this process are sampled; the RegexServer process is
+    not included.
+    '''
+    def __init__(self, output_dir='.', sample_rate=200, duration=30,
+                 functions_getter=None):
+        self._output_dir = output_dir
+        self._sample_rate = sample_rate
+        self._duration = duration
+        self._functions_getter = functions_getter
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def install_signal_handler(self, signal_number=signal.SIGUSR1):
+        signal.signal(signal_number, self._signal_handler)
+
+    def _signal_handler(self, signal_number, frame):
+        self.start()
+
+    def start(self, duration=None):
+        with self._lock:
+            if self.running:
+                _logger.info('Profiler is already running')
+                return False
+
+            self._thread = threading.Thread(
+                target=self._run, args=(duration or self._duration,),
+                name='SamplingProfiler')
+            self._thread.daemon = True
+            self._thread.start()
+
+            return True
+
+    def _get_function_names(self):
+        names = {}
+
+        for func in self._functions_getter() if self._functions_getter else ():
+            code = get_code(func)
+
+            if code:
+                names[code] = getattr(func, '__qualname__', code.co_name)
+
+        return names
+
+    def _run(self, duration):
+        _logger.info('Profiling for %s seconds', duration)
+
+        function_names = self._get_function_names()
+        stack_counts = collections.Counter()
+        function_counts = collections.Counter()
+        interval = 1 / self._sample_rate
+        own_thread_id = threading.get_ident()
+        deadline = time.monotonic() + duration
+        sample_count = 0
+
+        while time.monotonic() < deadline:
+            thread_names = dict(
+                (thread.ident, thread.name) for thread in threading.enumerate())
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_thread_id:
+                    continue
+
+                stack = []
+
+                while frame:
+                    stack.append(format_frame(frame))
+
+                    if frame.f_code in function_names:
+                        function_counts[function_names[frame.f_code]] += 1
+
+                    frame = frame.f_back
+
+                stack.append(thread_names.get(thread_id, str(thread_id)))
+                stack_counts[';'.join(reversed(stack))] += 1
+
+            sample_count += 1
+            time.sleep(interval)
+
+        self._write_output(stack_counts, function_counts, sample_count)
+
+    def _write_output(self, stack_counts, function_counts, sample_count):
+        path = os.path.join(
+            self._output_dir,
+            'profile-{}.collapsed'.format(time.strftime('%Y%m%d-%H%M%S')))
+
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in stack_counts.most_common():
+                file.write('{} {}\n'.format(stack, count))
+
+        _logger.info('Wrote %s samples to %s', sample_count, path)
+
+        for name, count in function_counts.most_common():
+            _logger.info('Profile %s: %s samples (%.1f%%)', name, count,
+                         count / max(1, sample_count) * 100)
+
+        return path
@@ -39,6 +39,15 @@ class RegexServer(object):
         self._request_queue = None
         self._response_queue = None
 
+    def get_pending_count(self):
+        if not self._response_queue:
+            return 0
+
+        try:
+            return self._response_queue.qsize()
+        except NotImplementedError:
+            return 0
+
     def search(self, pattern, text):
         if not self._process:
             self._launch_process()
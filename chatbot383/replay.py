@@ -0,0 +1,208 @@
+'''Replay a traffic capture through the bot without a network.
+
+The captured lines are parsed by the same `Client` code as live traffic and
+each resulting inbound item goes through `Bot._process_message`. The RNGs
+are seeded and the limiters run on the capture's clock, so replaying the
+same capture twice gives the same output.
+
+Scheduled tasks are not run during a replay.
+'''
+import argparse
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import queue
+import shutil
+import tempfile
+import time
+
+from chatbot383 import features, roar
+from chatbot383.bot import Bot
+from chatbot383.capture import read_capture
+from chatbot383.client import Client
+from chatbot383.features import Features, Database
+from chatbot383.loadtest import percentile
+from chatbot383.logsetup import setup_logging
+
+_logger = logging.getLogger(__name__)
+
+
+class ReplayClient(Client):
+    '''`Client` fed from a capture that records what the bot sends.'''
+    def __init__(self, inbound_queue, name, clock, sent,
+                 nickname='chatbot383'):
+        super().__init__(inbound_queue=inbound_queue, name=name)
+        self._clock = clock
+        self._sent = sent
+        # Normally set up by connect()
+        self.connection.handlers = {}
+        self.connection.real_server_name = ''
+        self.connection.real_nickname = nickname
+        self.connection.server_address = ('replay', name)
+        self.connection.send_raw = lambda string: None
+
+    def feed(self, line):
+        self.connection._process_line(line)
+
+    def privmsg(self, target, text, action=False, trace=None):
+        self._sent.append((self._clock(), target, text, action))
+
+        if trace:
+            trace.mark('send_enqueued')
+            trace.mark_sent()
+
+    def join(self, channel):
+        pass
+
+    def part(self, channel):
+        pass
+
+
+class Replayer(object):
+    def __init__(self, capture_path, config, realtime=False, speed=1.0,
+                 seed=383):
+        self._capture_path = capture_path
+        self._config = config
+        self._realtime = realtime
+        self._speed = speed
+        self._seed = seed
+        self._capture_time = 0
+
+    def _clock(self):
+        return self._capture_time
+
+    def run(self):
+        temp_dir = tempfile.mkdtemp(prefix='chatbot383-replay-')
+
+        try:
+            return self._run(temp_dir)
+        finally:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    def _run(self, temp_dir):
+        inbound_queue = queue.Queue()
+        clients = {}
+        sent = []
+
+        for name in ('main', 'group'):
+            clients[name] = ReplayClient(
+                inbound_queue, name, self._clock, sent,
+                nickname=self._config.get('username', 'chatbot383'))
+
+        bot = Bot(self._config.get('channels', ()),
+                  clients['main'], clients['group'], inbound_queue,
+                  ignored_users=self._config.get('ignored_users'),
+                  silent_channels=self._config.get('silent_channels'),
+                  clock=self._clock)
+        database_path = os.path.join(temp_dir, 'replay.db')
+
+        # Work on a copy so the replay starts from the same state every time
+        if self._config.get('database') and \
+                os.path.exists(self._config['database']):
+            shutil.copyfile(self._config['database'], database_path)
+
+        database = Database(database_path)
+        Features(bot, self._config.get('help_text', 'Replay.'), database,
+                 self._config,
+                 alert_channels=self._config.get('alert_channels'))
+
+        features.seed(self._seed)
+        roar.seed(self._seed)
+
+        line_count = 0
+        item_durations = []
+        first_timestamp = None
+        start_time = time.perf_counter()
+
+        for captured in read_capture(self._capture_path):
+            if first_timestamp is None:
+                first_timestamp = captured.timestamp
+
+            self._capture_time = captured.timestamp
+
+            if self._realtime:
+                delay = (captured.timestamp - first_timestamp) / self._speed \
+                    - (time.perf_counter() - start_time)
+
+                if delay > 0:
+                    time.sleep(delay)
+
+            client = clients.get(captured.client_name, clients['main'])
+            client.feed(captured.line)
+            line_count += 1
+
+            while True:
+                try:
+                    item = inbound_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+                item_start = time.perf_counter()
+                bot._process_message(item, item['client'])
+                item_durations.append(time.perf_counter() - item_start)
+
+        duration = time.perf_counter() - start_time
+
+        return {
+            'lines': line_count,
+            'items': len(item_durations),
+            'duration': duration,
+            'lines_per_second': line_count / duration if duration else None,
+            'item_p50': percentile(item_durations, 0.5),
+            'item_p99': percentile(item_durations, 0.99),
+            'item_max': max(item_durations) if item_durations else None,
+            'sent_lines': len(sent),
+            'sent_digest': self.digest_output(sent),
+        }, sent
+
+    @classmethod
+    def digest_output(cls, sent):
+        digest = hashlib.sha256()
+
+        for timestamp, target, text, action in sent:
+            digest.update('{}\t{}\t{}\n'.format(target, text, action)
+                          .encode('utf-8'))
+
+        return digest.hexdigest()
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description=__doc__)
+    arg_parser.add_argument('capture_file')
+    arg_parser.add_argument('--config', help='Bot config JSON file')
+    arg_parser.add_argument('--realtime', action='store_true',
+                            help='Keep the captured timing between lines')
+    arg_parser.add_argument('--speed', type=float, default=1.0,
+                            help='Speed multiplier for --realtime')
+    arg_parser.add_argument('--seed', type=int, default=383)
+    arg_parser.add_argument('--output', help='Write the sent lines to a file')
+    arg_parser.add_argument('--debug', action='store_true')
+    args = arg_parser.parse_args()
+
+    setup_logging(logging.DEBUG if args.debug else logging.WARNING)
+
+    config = {}
+
+    if args.config:
+        with open(args.config) as file:
+            config = json.load(file)
+
+    multiprocessing.set_start_method('spawn')
+
+    replayer = Replayer(args.capture_file, config, realtime=args.realtime,
+                        speed=args.speed, seed=args.seed)
+    summary, sent = replayer.run()
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            for timestamp, target, text, action in sent:
+                file.write('{:.3f}\t{}\t{}{}\n'.format(
+                    timestamp, target, '/me ' if action else '', text))
+
+    print(json.dumps(summary, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,11 @@
+import collections
 import random
+import threading
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 CHAINS = {
     None: ('S',),
@@ -11,6 +18,9 @@ CHAINS = {
     'k': ('k', '!', '!'),
     '!': (None, '!'),
 }
+MIN_LENGTH = 8
+MAX_LENGTH = 30
+POOL_BATCH_SIZE = 2000
 
 
 def make_chain():
@@ -31,11 +41,166 @@ def make_chain():
     return ''.join(chars)
 
 
-def gen_roar():
-    while True:
+def is_good_length(text):
+    return MIN_LENGTH < len(text) < MAX_LENGTH
+
+
+class RunLengthChain(object):
+    '''Markov chain of `CHAINS` rewritten as runs of repeated states.
+
+    Staying in a state is a geometric number of repeats, so a walk needs
+    one step per distinct state instead of one step per character.
+    '''
+    def __init__(self, chains, rng=None):
+        self._rng = rng or numpy.random.default_rng()
+        self._states = [None] + sorted(state for state in chains if state)
+        self._state_index = dict(
+            (state, index) for index, state in enumerate(self._states))
+        self._code_points = numpy.array(
+            [0] + [ord(state) for state in self._states[1:]],
+            dtype=numpy.uint32)
+        self._stay_probability = numpy.zeros(len(self._states))
+        self._exits = []
+
+        for index, state in enumerate(self._states):
+            choices = chains[state]
+            exit_counts = collections.Counter(
+                choice for choice in choices if choice != state or not state)
+
+            if state:
+                self._stay_probability[index] = \
+                    choices.count(state) / len(choices)
+
+            exit_total = sum(exit_counts.values())
+            self._exits.append((
+                numpy.array([self._state_index[choice] if choice else -1
+                             for choice in exit_counts]),
+                numpy.array([count / exit_total
+                             for count in exit_counts.values()])
+            ))
+
+    def generate(self, count, max_steps=100):
+        if count <= 0:
+            # numpy.stack needs at least one step
+            return []
+
+        current = numpy.zeros(count, dtype=numpy.int64)
+        state_steps = []
+        run_steps = []
+
+        for dummy in range(max_steps):
+            active = current >= 0
+
+            if not active.any():
+                break
+
+            runs = numpy.zeros(count, dtype=numpy.int64)
+            next_states = numpy.full(count, -1, dtype=numpy.int64)
+
+            for index in numpy.unique(current[active]):
+                members = numpy.flatnonzero(current == index)
+
+                if index:
+                    runs[members] = self._rng.geometric(
+                        1 - self._stay_probability[index], members.size)
+
+                exit_states, exit_probabilities = self._exits[index]
+                next_states[members] = self._rng.choice(
+                    exit_states, members.size, p=exit_probabilities)
+
+            state_steps.append(numpy.where(active, current, 0))
+            run_steps.append(runs)
+            current = next_states
+        else:
+            # Unterminated walks are thrown away by the length check
+            run_steps[-1][current >= 0] = MAX_LENGTH
+
+        states = numpy.stack(state_steps, axis=1)
+        runs = numpy.stack(run_steps, axis=1)
+        lengths = runs.sum(axis=1)
+        good = (lengths > MIN_LENGTH) & (lengths < MAX_LENGTH)
+
+        code_points = numpy.repeat(
+            self._code_points[states[good]].ravel(), runs[good].ravel())
+        text = code_points.tobytes().decode('utf-32-le')
+        offsets = numpy.concatenate(([0], numpy.cumsum(lengths[good])))
+
+        return [text[start:end]
+                for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def gen_roars(count):
+    '''Generate up to `count` roars of acceptable length.'''
+    if numpy:
+        return _get_run_length_chain().generate(count)
+
+    roars = []
+
+    for dummy in range(count):
         text = make_chain()
-        if 8 < len(text) < 30:
-            return text
+
+        if is_good_length(text):
+            roars.append(text)
+
+    return roars
+
+
+_run_length_chain = None
+
+
+def _get_run_length_chain():
+    global _run_length_chain
+
+    if not _run_length_chain:
+        _run_length_chain = RunLengthChain(CHAINS)
+
+    return _run_length_chain
+
+
+class RoarPool(object):
+    def __init__(self, batch_size=POOL_BATCH_SIZE):
+        self._batch_size = batch_size
+        self._roars = collections.deque()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._roars)
+
+    def get(self):
+        while True:
+            try:
+                return self._roars.popleft()
+            except IndexError:
+                self.refill()
+
+    def clear(self):
+        with self._lock:
+            self._roars.clear()
+
+    def refill(self):
+        with self._lock:
+            if not self._roars:
+                self._roars.extend(gen_roars(self._batch_size))
+
+
+_pool = RoarPool()
+
+
+def gen_roar():
+    return _pool.get()
+
+
+def seed(value):
+    '''Make the generated roars repeatable, e.g. for replaying a capture.'''
+    global _run_length_chain
+
+    random.seed(value)
+
+    if numpy:
+        _run_length_chain = RunLengthChain(
+            CHAINS, numpy.random.default_rng(value))
+
+    _pool.clear()
 
 
 if __name__ == '__main__':
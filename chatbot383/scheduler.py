@@ -0,0 +1,401 @@
+'''Timers for the bot's dispatch loop, kept in a hierarchical timing wheel.
+
+Time is counted in ticks. Each level of the wheel has `WHEEL_SIZE` slots
+and each slot of a level spans a whole turn of the level below, so adding
+and cancelling a timer is O(1) however many there are. When the lower
+level comes round, the due slot of the level above is spread back down.
+
+The dispatch loop asks for `get_timeout()` and waits for inbound items no
+longer than that, so timers fire within about one tick of their deadline.
+A timer added from another thread that is due before the loop would wake
+calls `wakeup` so the loop does not sleep through it.
+'''
+import collections
+import logging
+import math
+import random
+import threading
+import time
+
+from chatbot383 import metrics
+
+_logger = logging.getLogger(__name__)
+_job_duration = metrics.histogram(
+    'chatbot383_scheduled_job_seconds', 'Time spent running a scheduled job',
+    ('job',))
+_job_skips = metrics.counter(
+    'chatbot383_scheduled_job_skipped_total',
+    'Scheduled job runs skipped because the previous run was still going',
+    ('job',))
+_job_errors = metrics.counter(
+    'chatbot383_scheduled_job_errors_total', 'Scheduled job runs that raised',
+    ('job',))
+
+TICK = 0.01
+WHEEL_BITS = 6
+WHEEL_SIZE = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SIZE - 1
+WHEEL_LEVELS = 4
+MAX_TIMEOUT = 1.0
+
+JobStats = collections.namedtuple(
+    'JobStats', ['runs', 'skips', 'errors', 'total_seconds', 'max_seconds'])
+
+
+class Timer(object):
+    '''Handle for a call scheduled with `Scheduler.call_later`.'''
+    def __init__(self, scheduler, tick, deadline, func, args):
+        self._scheduler = scheduler
+        self._tick = tick
+        self._deadline = deadline
+        self._func = func
+        self._args = args
+        self._cancelled = False
+        self._pending = True
+
+    @property
+    def tick(self):
+        return self._tick
+
+    @property
+    def deadline(self):
+        return self._deadline
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        self._cancelled = True
+        self._scheduler._cancel(self)
+
+    def run(self):
+        self._func(*self._args)
+
+
+class PeriodicJob(object):
+    '''A job run every `interval` seconds plus up to `jitter` seconds.
+
+    The next run is timed from when the previous one started, but a job
+    that falls behind is not run back to back to catch up. A `threaded` job
+    runs in its own thread and a run is skipped while the previous one is
+    still going.
+    '''
+    def __init__(self, scheduler, name, interval, func, jitter=0,
+                 threaded=False, rng=None):
+        self._scheduler = scheduler
+        self._name = name
+        self._interval = interval
+        self._func = func
+        self._jitter = jitter
+        self._threaded = threaded
+        self._rng = rng or random.Random()
+        self._timer = None
+        self._running = False
+        self._cancelled = False
+        self._runs = 0
+        self._skips = 0
+        self._errors = 0
+        self._total_seconds = 0
+        self._max_seconds = 0
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def stats(self):
+        return JobStats(self._runs, self._skips, self._errors,
+                        self._total_seconds, self._max_seconds)
+
+    @property
+    def cancelled(self):
+        return self._cancelled
+
+    def cancel(self):
+        self._cancelled = True
+
+        if self._timer:
+            self._timer.cancel()
+
+        self._scheduler._remove_job(self)
+
+    def _schedule(self, delay):
+        if not self._cancelled:
+            self._timer = self._scheduler.call_later(delay, self._on_timer)
+
+    def _get_delay(self):
+        if self._jitter:
+            return self._interval + self._rng.uniform(0, self._jitter)
+
+        return self._interval
+
+    def _on_timer(self):
+        start_time = self._scheduler.clock()
+        next_time = start_time + self._get_delay()
+
+        if self._running:
+            self._skips += 1
+            _job_skips.inc(self._name)
+            _logger.warning('Job %s is still running. Skipping', self._name)
+        elif self._threaded:
+            self._running = True
+            thread = threading.Thread(target=self._run, name=self._name)
+            thread.daemon = True
+            thread.start()
+        else:
+            self._run()
+
+        delay = next_time - self._scheduler.clock()
+
+        if delay < 0:
+            # Fell behind; wait a full interval rather than catch up
+            delay = self._get_delay()
+
+        self._schedule(delay)
+
+    def _run(self):
+        self._running = True
+        start_time = time.perf_counter()
+
+        try:
+            self._func()
+        except Exception:
+            self._errors += 1
+            _job_errors.inc(self._name)
+            _logger.exception('Job %s failed', self._name)
+        finally:
+            duration = time.perf_counter() - start_time
+            self._runs += 1
+            self._total_seconds += duration
+            self._max_seconds = max(self._max_seconds, duration)
+            _job_duration.observe(duration, self._name)
+            self._running = False
+
+
+class Scheduler(object):
+    '''Run timers and periodic jobs from the thread calling `run_pending`.
+
+    `call_later` may be called from other threads.
+    '''
+    def __init__(self, clock=time.monotonic, tick=TICK):
+        self._clock = clock
+        self._tick = tick
+        self._levels = [[[] for dummy in range(WHEEL_SIZE)]
+                        for dummy in range(WHEEL_LEVELS)]
+        # Every tick before this one has been run
+        self._current_tick = self._get_tick(clock())
+        self._count = 0
+        self._jobs = []
+        self._lock = threading.RLock()
+        self._wakeup = None
+        # When the dispatch loop will next check the timers by itself
+        self._wake_time = None
+
+    @property
+    def clock(self):
+        return self._clock
+
+    @property
+    def jobs(self):
+        return tuple(self._jobs)
+
+    @property
+    def wakeup(self):
+        return self._wakeup
+
+    @wakeup.setter
+    def wakeup(self, func):
+        '''Set a function that interrupts the dispatch loop's wait.'''
+        self._wakeup = func
+
+    def __len__(self):
+        return self._count
+
+    def _get_tick(self, time_value):
+        return int(time_value / self._tick)
+
+    def _get_tick_time(self, tick):
+        '''Return the earliest time that `_get_tick` puts in the tick.'''
+        time_value = tick * self._tick
+
+        # Rounding can put tick * TICK just inside the tick before
+        while self._get_tick(time_value) < tick:
+            time_value = math.nextafter(time_value, math.inf)
+
+        return time_value
+
+    def call_later(self, delay, func, *args):
+        '''Call `func` with `args` after `delay` seconds.'''
+        deadline = self._clock() + delay
+        # Rounded up so a timer never runs early
+        tick = -int(-deadline // self._tick)
+
+        with self._lock:
+            timer = Timer(self, tick, deadline, func, args)
+            self._insert(timer)
+            self._count += 1
+            wake_time = self._wake_time
+            needs_wakeup = wake_time is not None and deadline < wake_time
+
+            if needs_wakeup:
+                self._wake_time = None
+
+        # Outside the lock; the wakeup takes the inbound queue's lock
+        if needs_wakeup and self._wakeup:
+            self._wakeup()
+
+        return timer
+
+    def every(self, interval, func, name=None, jitter=0, initial_delay=None,
+              threaded=False):
+        '''Run `func` every `interval` seconds and return its `PeriodicJob`.
+
+        The first run is after `initial_delay`, or one interval.
+        '''
+        job = PeriodicJob(self, name or func.__name__, interval, func,
+                          jitter=jitter, threaded=threaded)
+
+        with self._lock:
+            self._jobs.append(job)
+
+        job._schedule(interval if initial_delay is None else initial_delay)
+
+        return job
+
+    def _remove_job(self, job):
+        with self._lock:
+            if job in self._jobs:
+                self._jobs.remove(job)
+
+    def _insert(self, timer):
+        tick = max(timer.tick, self._current_tick)
+
+        for level in range(WHEEL_LEVELS):
+            shift = level * WHEEL_BITS
+            offset = (tick >> shift) - (self._current_tick >> shift)
+
+            if offset < WHEEL_SIZE:
+                break
+        else:
+            # Too far ahead; parked in the farthest slot and placed again
+            # when that slot is spread down
+            tick = self._current_tick + (WHEEL_MASK << shift)
+
+        self._levels[level][(tick >> shift) & WHEEL_MASK].append(timer)
+
+    def _cancel(self, timer):
+        # The timer is left in its slot and dropped when the slot comes up
+        with self._lock:
+            if timer._pending:
+                timer._pending = False
+                self._count -= 1
+
+    def _cascade(self, tick):
+        for level in range(WHEEL_LEVELS - 1, 0, -1):
+            shift = level * WHEEL_BITS
+
+            if tick & ((1 << shift) - 1):
+                continue
+
+            slot = self._levels[level][(tick >> shift) & WHEEL_MASK]
+            timers = list(slot)
+            del slot[:]
+
+            for timer in timers:
+                if not timer.cancelled:
+                    self._insert(timer)
+
+    def _pop_due(self, target_tick):
+        '''Advance the wheel to `target_tick` and return the due timers.'''
+        due = []
+        due_count = 0
+
+        with self._lock:
+            if not self._count:
+                self._current_tick = target_tick + 1
+                return due
+
+            while self._current_tick <= target_tick:
+                self._cascade(self._current_tick)
+                slot = self._levels[0][self._current_tick & WHEEL_MASK]
+
+                for timer in slot:
+                    if not timer.cancelled:
+                        timer._pending = False
+                        due.append(timer)
+
+                self._count -= len(due) - due_count
+                due_count = len(due)
+                del slot[:]
+
+                self._current_tick += 1
+
+        due.sort(key=lambda timer: timer.deadline)
+
+        return due
+
+    def run_pending(self):
+        '''Run the timers that are due. Returns how many ran.'''
+        due = self._pop_due(self._get_tick(self._clock()))
+
+        for timer in due:
+            if not timer.cancelled:
+                timer.run()
+
+        return len(due)
+
+    def get_next_deadline(self):
+        '''Return a time no later than the next deadline, or None.
+
+        It is exact for timers in the lowest level; for the others it is
+        when they are spread down. A higher level can be spread down before
+        the first timer in the lowest level is due, so every level is
+        checked.
+        '''
+        with self._lock:
+            if not self._count:
+                return None
+
+            deadline_tick = None
+
+            for level, slots in enumerate(self._levels):
+                shift = level * WHEEL_BITS
+                base = self._current_tick >> shift
+
+                for offset in range(WHEEL_SIZE):
+                    if slots[(base + offset) & WHEEL_MASK]:
+                        tick = (base + offset) << shift
+
+                        if deadline_tick is None or tick < deadline_tick:
+                            deadline_tick = tick
+
+                        break
+
+        if deadline_tick is None:
+            return None
+
+        return self._get_tick_time(deadline_tick)
+
+    def get_timeout(self, maximum=MAX_TIMEOUT):
+        '''Return how long the dispatch loop may wait for inbound items.
+
+        Timers added later that are due sooner call `wakeup`.
+        '''
+        # Held across both so a timer added in between is either seen here
+        # or compared with the wake time
+        with self._lock:
+            deadline = self.get_next_deadline()
+            time_now = self._clock()
+
+            if deadline is None:
+                timeout = maximum
+            else:
+                timeout = min(maximum, max(0, deadline - time_now))
+
+            self._wake_time = time_now + timeout
+
+        return timeout
+
+    def get_job_stats(self):
+        return dict((job.name, job.stats) for job in self._jobs)
@@ -0,0 +1,154 @@
+'''Save in-memory state so a restart picks up where it left off.
+
+A snapshot is a small header followed by zlib compressed JSON. It is written
+to a temporary file that is then renamed over the old one, so a crash while
+writing leaves the previous snapshot in place.
+'''
+import json
+import logging
+import os
+import struct
+import tempfile
+import threading
+import time
+import zlib
+
+from chatbot383 import metrics
+
+_logger = logging.getLogger(__name__)
+_snapshot_bytes = metrics.gauge(
+    'chatbot383_snapshot_bytes', 'Size of the last state snapshot written')
+_snapshot_duration = metrics.histogram(
+    'chatbot383_snapshot_write_seconds', 'Time spent writing a state snapshot')
+
+MAGIC = b'C383SNAP'
+VERSION = 1
+# Magic, format version and the time the snapshot was taken
+_header = struct.Struct('>8sBd')
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def encode_snapshot(state, saved_time):
+    data = json.dumps(state, separators=(',', ':'), ensure_ascii=False)
+    return _header.pack(MAGIC, VERSION, saved_time) + \
+        zlib.compress(data.encode('utf-8'))
+
+
+def decode_snapshot(data):
+    '''Return the saved time and the state.'''
+    if len(data) < _header.size:
+        raise SnapshotError('Snapshot is truncated')
+
+    magic, version, saved_time = _header.unpack_from(data)
+
+    if magic != MAGIC:
+        raise SnapshotError('Not a snapshot file')
+
+    if version != VERSION:
+        raise SnapshotError('Unsupported snapshot version {}'.format(version))
+
+    try:
+        state = json.loads(
+            zlib.decompress(data[_header.size:]).decode('utf-8'))
+    except (zlib.error, ValueError) as error:
+        raise SnapshotError('Snapshot is corrupt') from error
+
+    return saved_time, state
+
+
+def write_snapshot(path, state, saved_time=None):
+    '''Write the snapshot atomically and return its size.'''
+    data = encode_snapshot(state, saved_time or time.time())
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.snapshot-', dir=directory)
+
+    try:
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+            file.flush()
+            os.fsync(file.fileno())
+
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+    return len(data)
+
+
+def read_snapshot(path, max_age=None, clock=time.time):
+    '''Return the saved state, or None if it is missing, stale or corrupt.'''
+    try:
+        with open(path, 'rb') as file:
+            saved_time, state = decode_snapshot(file.read())
+    except FileNotFoundError:
+        return None
+    except (OSError, SnapshotError):
+        _logger.exception('Could not read snapshot %s', path)
+        return None
+
+    age = clock() - saved_time
+
+    if max_age is not None and age > max_age:
+        _logger.info('Ignoring snapshot %s that is %d seconds old', path, age)
+        return None
+
+    _logger.info('Loaded snapshot %s from %d seconds ago', path, age)
+
+    return state
+
+
+class SnapshotWriter(object):
+    '''Write snapshots in a background thread.
+
+    The state handed over must not be changed afterwards. If the thread is
+    still busy, only the latest state waiting is written.
+    '''
+    def __init__(self, path):
+        self._path = path
+        self._pending = None
+        self._condition = threading.Condition()
+        self._write_lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, state):
+        with self._condition:
+            self._pending = state
+            self._condition.notify()
+
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run,
+                                            name='SnapshotWriter')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def write(self, state):
+        '''Write the state now, in this thread.'''
+        with self._condition:
+            self._pending = None
+
+        self._write(state)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while self._pending is None:
+                    self._condition.wait()
+
+                state = self._pending
+                self._pending = None
+
+            self._write(state)
+
+    def _write(self, state):
+        try:
+            with self._write_lock, _snapshot_duration.time():
+                size = write_snapshot(self._path, state)
+        except (OSError, TypeError, ValueError):
+            _logger.exception('Could not write snapshot %s', self._path)
+        else:
+            _snapshot_bytes.set(size)
+            _logger.debug('Wrote snapshot %s (%d bytes)', self._path, size)
@@ -0,0 +1,187 @@
+'''Time the startup phases and module imports.
+
+Run ``python -m chatbot383 config.json --startup-report`` to print how long
+each phase and the slowest imports took, once the bot is back in chat.
+Times are from when this module was imported, which is the first thing
+``__main__`` does.
+'''
+import contextlib
+import functools
+import importlib.abc
+import logging
+import sys
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+_start_time = time.perf_counter()
+
+REPORT_MODULE_COUNT = 15
+
+
+class ImportTimer(importlib.abc.MetaPathFinder):
+    '''Measure the time spent running each imported module.
+
+    Like ``python -X importtime``, the self time of a module excludes the
+    modules it imported.
+    '''
+    def __init__(self):
+        self._self_times = {}
+        self._stack = []
+        self._local = threading.local()
+
+    def install(self):
+        sys.meta_path.insert(0, self)
+
+    def uninstall(self):
+        if self in sys.meta_path:
+            sys.meta_path.remove(self)
+
+    def find_spec(self, fullname, path, target=None):
+        if getattr(self._local, 'finding', False):
+            return None
+
+        self._local.finding = True
+
+        try:
+            for finder in sys.meta_path:
+                if finder is self or not hasattr(finder, 'find_spec'):
+                    continue
+
+                spec = finder.find_spec(fullname, path, target)
+
+                if spec is not None:
+                    break
+            else:
+                return None
+        finally:
+            self._local.finding = False
+
+        self._wrap_loader(spec.loader)
+
+        return spec
+
+    def _wrap_loader(self, loader):
+        # The loader object is kept so isinstance() checks on it still work.
+        # Classes, such as the builtin importer, are shared and not timed.
+        if loader is None or isinstance(loader, type):
+            return
+
+        exec_module = getattr(loader, 'exec_module', None)
+
+        if exec_module is None or getattr(exec_module, 'timed', False):
+            return
+
+        timed_exec_module = functools.partial(self._exec_module, exec_module)
+        timed_exec_module.timed = True
+
+        try:
+            loader.exec_module = timed_exec_module
+        except AttributeError:
+            pass
+
+    def _exec_module(self, exec_module, module):
+        with self.time_module(module.__name__):
+            exec_module(module)
+
+    @contextlib.contextmanager
+    def time_module(self, name):
+        # Only the main thread is timed so warm-up threads do not interleave
+        if threading.current_thread() is not threading.main_thread():
+            yield
+            return
+
+        self._stack.append(0)
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start_time
+            child_duration = self._stack.pop()
+            self._self_times[name] = duration - child_duration
+
+            if self._stack:
+                self._stack[-1] += duration
+
+    def get_slowest(self, count=REPORT_MODULE_COUNT):
+        return sorted(self._self_times.items(), key=lambda item: item[1],
+                      reverse=True)[:count]
+
+
+class StartupReport(object):
+    def __init__(self):
+        self._phases = []
+        self._marks = []
+        self._expected_marks = set()
+        self._import_timer = None
+        self._enabled = False
+        self._done = False
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self._enabled
+
+    def enable(self, time_imports=True):
+        self._enabled = True
+
+        if time_imports:
+            self._import_timer = ImportTimer()
+            self._import_timer.install()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            self._phases.append((name, time.perf_counter() - start_time))
+
+    def expect(self, *names):
+        '''Print the report once all these marks have been reached.'''
+        self._expected_marks.update(names)
+
+    def mark(self, name):
+        '''Note that a milestone, such as joining chat, was reached.'''
+        with self._lock:
+            if self._done or name in dict(self._marks):
+                return
+
+            self._marks.append((name, time.perf_counter() - _start_time))
+            _logger.debug('Startup mark %s', name)
+
+            if not self._enabled or \
+                    not self._expected_marks <= set(dict(self._marks)):
+                return
+
+            self._done = True
+
+        if self._import_timer:
+            self._import_timer.uninstall()
+
+        print(self.format(), file=sys.stderr)
+
+    def format(self):
+        lines = ['Startup report', 'Phases:']
+
+        for name, duration in self._phases:
+            lines.append('  {:<24} {:8.3f} s'.format(name, duration))
+
+        lines.append('Milestones (since start):')
+
+        for name, elapsed in self._marks:
+            lines.append('  {:<24} {:8.3f} s'.format(name, elapsed))
+
+        if self._import_timer:
+            lines.append('Slowest imports (self time):')
+
+            for name, duration in self._import_timer.get_slowest():
+                lines.append('  {:<44} {:8.3f} s'.format(name, duration))
+
+        return '\n'.join(lines)
+
+
+REPORT = StartupReport()
@@ -0,0 +1,306 @@
+'''Run the bot as several worker processes, each with a shard of channels.
+
+Each worker has its own connections, `Bot` and `Features`. The database is
+shared through SQLite's WAL mode. Lines for a channel owned by another
+worker, such as alerts, are forwarded to it through the supervisor.
+'''
+import functools
+import json
+import logging
+import multiprocessing
+import multiprocessing.connection
+import os
+import signal
+import threading
+import time
+import zlib
+
+from chatbot383.health import Backoff
+from chatbot383.logsetup import setup_logging
+
+_logger = logging.getLogger(__name__)
+
+STABLE_UPTIME = 60
+RESTART_MAX_INTERVAL = 60
+
+# Keys naming something that only one process can own
+PER_WORKER_FILENAME_KEYS = ('metrics_filename', 'capture_filename',
+                            'snapshot_filename', 'control_socket')
+
+
+def shard_index(channel, worker_count):
+    return zlib.crc32(channel.lower().encode('utf-8')) % worker_count
+
+
+class ShardBus(object):
+    '''Route lines to the worker owning their channel.
+
+    Each worker talks to the supervisor over its own pipe and the supervisor
+    passes lines on, so a crashed worker cannot leave a shared queue locked.
+    '''
+    def __init__(self, connection, index, worker_count):
+        self._connection = connection
+        self._index = index
+        self._worker_count = worker_count
+        self._send_lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['_send_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._send_lock = threading.Lock()
+
+    @property
+    def worker_count(self):
+        return self._worker_count
+
+    @property
+    def index(self):
+        return self._index
+
+    def owns(self, channel):
+        return shard_index(channel, self._worker_count) == self._index
+
+    def forward(self, channel, text, **kwargs):
+        self._send(dict(kwargs, channel=channel, text=text))
+
+    def forward_call(self, channel, name, args):
+        '''Run the bot's shard call `name` on the worker owning `channel`.'''
+        self._send({'channel': channel, 'call': name, 'args': list(args)})
+
+    def _send(self, item):
+        try:
+            with self._send_lock:
+                self._connection.send(item)
+        except OSError:
+            _logger.exception('Could not forward %s', item)
+
+    def start(self, bot):
+        thread = threading.Thread(target=self._run, args=(bot,),
+                                  name='ShardBus')
+        thread.daemon = True
+        thread.start()
+
+    def _run(self, bot):
+        while True:
+            try:
+                item = self._connection.recv()
+            except (EOFError, OSError):
+                _logger.warning('Lost connection to the supervisor')
+                return
+
+            _logger.debug('Forwarded item %s', item)
+            # Handled on the dispatch thread, which owns the clients' queues
+            bot.scheduler.call_later(0, bot.handle_forwarded_item, item)
+
+
+def get_worker_config(config, shard_bus):
+    config = dict(config)
+    index = shard_bus.index
+    config['channels'] = [channel for channel in config['channels']
+                          if shard_bus.owns(channel)]
+
+    for key in PER_WORKER_FILENAME_KEYS:
+        if config.get(key):
+            config[key] = '{}.{}'.format(config[key], index)
+
+    if config.get('metrics_address'):
+        host, port = config['metrics_address'].rsplit(':', 1)
+        config['metrics_address'] = '{}:{}'.format(host, int(port) + index)
+
+    if index != 0:
+        # Timed announcements to other channels only need to happen once
+        config.pop('token_notify_channels', None)
+
+    return config
+
+
+def load_worker_config(filename, shard_bus):
+    with open(filename, 'r') as file:
+        return get_worker_config(json.load(file), shard_bus)
+
+
+def run_worker(config, shard_bus, log_level, config_filename=None):
+    from chatbot383.app import App
+
+    setup_logging(
+        log_level, json_format=config.get('log_json'),
+        sample_rates=config.get('log_sample_rates'),
+        rate_limits=config.get('log_rate_limits'),
+        log_format='%(asctime)s - worker {} - %(levelname)s - %(message)s'
+        .format(shard_bus.index))
+
+    worker_config = get_worker_config(config, shard_bus)
+    _logger.info('Worker %s has %s channels', shard_bus.index,
+                 len(worker_config['channels']))
+
+    config_loader = None
+
+    if config_filename:
+        config_loader = functools.partial(
+            load_worker_config, config_filename, shard_bus)
+
+    app = App(worker_config, shard_bus=shard_bus, config_loader=config_loader)
+    app.run()
+
+
+class Supervisor(object):
+    def __init__(self, config, worker_count, log_level=logging.INFO,
+                 config_filename=None):
+        self._config = config
+        self._config_filename = config_filename
+        self._worker_count = worker_count
+        self._log_level = log_level
+        self._processes = [None] * worker_count
+        self._connections = [None] * worker_count
+        # Replaced connections, closed by the routing thread once it is no
+        # longer waiting on them
+        self._stale_connections = []
+        self._connections_lock = threading.Lock()
+        self._start_times = [None] * worker_count
+        self._restart_times = [0] * worker_count
+        self._backoffs = [Backoff(maximum=RESTART_MAX_INTERVAL)
+                          for dummy in range(worker_count)]
+        self._running = False
+
+    def _start_worker(self, index):
+        connection, worker_connection = multiprocessing.Pipe()
+        shard_bus = ShardBus(worker_connection, index, self._worker_count)
+        process = multiprocessing.Process(
+            target=run_worker,
+            args=(self._config, shard_bus, self._log_level,
+                  self._config_filename),
+            name='chatbot383-worker-{}'.format(index))
+        process.start()
+        worker_connection.close()
+
+        with self._connections_lock:
+            old_connection = self._connections[index]
+            self._connections[index] = connection
+
+            if old_connection:
+                self._stale_connections.append(old_connection)
+
+        self._processes[index] = process
+        self._start_times[index] = time.monotonic()
+        _logger.info('Started worker %s (pid %s)', index, process.pid)
+
+    def _check_workers(self):
+        time_now = time.monotonic()
+
+        for index, process in enumerate(self._processes):
+            if process and process.is_alive():
+                if time_now - self._start_times[index] > STABLE_UPTIME:
+                    self._backoffs[index].reset()
+                continue
+
+            if process:
+                _logger.warning('Worker %s exited with code %s',
+                                index, process.exitcode)
+                self._processes[index] = None
+                self._restart_times[index] = \
+                    time_now + self._backoffs[index].next_delay()
+
+            if time_now >= self._restart_times[index]:
+                self._start_worker(index)
+
+    def _route(self):
+        while self._running:
+            with self._connections_lock:
+                connections = [connection for connection in self._connections
+                               if connection]
+                stale_connections = self._stale_connections
+                self._stale_connections = []
+
+            for connection in stale_connections:
+                connection.close()
+
+            try:
+                ready = multiprocessing.connection.wait(connections, 1)
+            except (OSError, ValueError):
+                _logger.exception('Could not wait for workers')
+                time.sleep(0.1)
+                continue
+
+            for connection in ready:
+                try:
+                    item = connection.recv()
+                except (EOFError, OSError):
+                    # Worker is gone; the connection is replaced on restart
+                    time.sleep(0.1)
+                    continue
+
+                self._deliver(item)
+
+    def _deliver(self, item):
+        index = shard_index(item['channel'], self._worker_count)
+
+        with self._connections_lock:
+            connection = self._connections[index]
+
+        try:
+            connection.send(item)
+        except (AttributeError, OSError):
+            _logger.warning('Worker %s is down. Dropping %s', index, item)
+
+    def _forward_signal(self, signal_number, frame):
+        for process in self._processes:
+            if process and process.is_alive():
+                os.kill(process.pid, signal_number)
+
+    def _reload_signal(self, signal_number, frame):
+        # Workers started from now on get the new config too
+        try:
+            with open(self._config_filename, 'r') as file:
+                self._config = json.load(file)
+        except (OSError, ValueError):
+            _logger.exception('Could not reload config')
+            return
+
+        self._forward_signal(signal_number, frame)
+
+    def _stop_signal(self, signal_number, frame):
+        self._running = False
+
+    def run(self):
+        self._running = True
+
+        for signal_name in ('SIGUSR1', 'SIGUSR2'):
+            if hasattr(signal, signal_name):
+                signal.signal(getattr(signal, signal_name),
+                              self._forward_signal)
+
+        if self._config_filename and hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._reload_signal)
+
+        signal.signal(signal.SIGTERM, self._stop_signal)
+
+        self._check_workers()
+
+        router_thread = threading.Thread(target=self._route, name='ShardRouter')
+        router_thread.daemon = True
+        router_thread.start()
+
+        try:
+            while self._running:
+                time.sleep(1)
+                self._check_workers()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self._running = False
+            self.stop()
+
+    def stop(self):
+        _logger.info('Stopping workers')
+
+        for process in self._processes:
+            if process and process.is_alive():
+                process.terminate()
+
+        for process in self._processes:
+            if process:
+                process.join(10)
@@ -0,0 +1,115 @@
+import logging
+import threading
+import time
+
+from chatbot383 import metrics
+
+_logger = logging.getLogger(__name__)
+_stage_duration = metrics.histogram(
+    'chatbot383_message_stage_seconds',
+    'Latency of each stage between receiving a line and replying',
+    ('stage',),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5,
+             1.0, 2.5, 5.0, 10.0)
+)
+_outcomes = metrics.counter(
+    'chatbot383_message_outcomes_total',
+    'Traced messages by how they finished: sent, dropped or no_reply',
+    ('outcome',)
+)
+
+# Stage name, start mark, end mark
+STAGES = (
+    ('queue_wait', 'received', 'dequeued'),
+    ('dispatch', 'dequeued', 'handler_start'),
+    ('handler', 'handler_start', 'handler_end'),
+    ('outbound_wait', 'send_enqueued', 'sent'),
+    ('reply', 'received', 'sent'),
+    ('total', 'received', 'handler_end'),
+)
+
+
+class MessageTrace(object):
+    '''Timestamps of one inbound message on its way through the bot.
+
+    Marks use `time.perf_counter()`. The server timestamp from the
+    `tmi-sent-ts` tag is wall clock time and is compared against the
+    wall clock time of receipt.
+    '''
+    __slots__ = ('marks', 'server_timestamp', 'wall_received', 'label',
+                 'outcome')
+
+    def __init__(self, received=None, server_timestamp=None, label=None):
+        self.marks = {'received': received or time.perf_counter()}
+        self.server_timestamp = server_timestamp
+        self.wall_received = time.time()
+        self.label = label
+        self.outcome = None
+
+    def mark(self, name):
+        # Only the first occurrence counts, e.g. the first of several replies
+        if name not in self.marks:
+            self.marks[name] = time.perf_counter()
+
+    def mark_sent(self):
+        self.mark('sent')
+        self.finish('sent')
+
+    def mark_dropped(self):
+        '''Finish the trace of a reply the client threw away.'''
+        self.mark('dropped')
+        self.finish('dropped')
+
+    def finish(self, outcome='no_reply'):
+        if self.outcome is None:
+            self.outcome = outcome
+            TRACER.finish(self)
+
+    def get_breakdown(self):
+        breakdown = {}
+
+        if self.server_timestamp:
+            breakdown['network'] = self.wall_received - self.server_timestamp
+
+        for stage, start_mark, end_mark in STAGES:
+            start = self.marks.get(start_mark)
+            end = self.marks.get(end_mark)
+
+            if start is not None and end is not None:
+                breakdown[stage] = end - start
+
+        return breakdown
+
+
+class Tracer(object):
+    def __init__(self, slow_threshold=2.0):
+        self.slow_threshold = slow_threshold
+        self._local = threading.local()
+
+    @property
+    def current_trace(self):
+        '''Trace of the message being handled on the current thread.'''
+        return getattr(self._local, 'trace', None)
+
+    @current_trace.setter
+    def current_trace(self, trace):
+        self._local.trace = trace
+
+    def finish(self, trace):
+        breakdown = trace.get_breakdown()
+
+        for stage, duration in breakdown.items():
+            _stage_duration.observe(max(0, duration), stage)
+
+        _outcomes.inc(trace.outcome)
+
+        slowest = max(breakdown.get('reply', 0), breakdown.get('total', 0))
+
+        if self.slow_threshold and slowest > self.slow_threshold:
+            _logger.warning(
+                'Slow message %s (%s): %s', trace.label, trace.outcome,
+                ', '.join('{}={:.4f}'.format(stage, duration)
+                          for stage, duration in sorted(breakdown.items())))
+
+
+TRACER = Tracer()
@@ -0,0 +1,41 @@
+import threading
+import time
+import unittest
+
+from chatbot383.bot import Bot
+from chatbot383.inboundqueue import FairInboundQueue
+
+
+class StubClient(object):
+    def __init__(self, inbound_queue):
+        self.inbound_queue = inbound_queue
+        self.inbound_filter = None
+        self.membership_tracker = None
+
+
+class TestBotRun(unittest.TestCase):
+    def test_call_later_from_other_thread_wakes_loop(self):
+        inbound_queue = FairInboundQueue()
+        client = StubClient(inbound_queue)
+        bot = Bot([], client, client, inbound_queue)
+
+        thread = threading.Thread(target=bot.run, name='TestDispatch')
+        thread.daemon = True
+        thread.start()
+
+        # Let the loop settle into its longest wait
+        time.sleep(0.2)
+
+        for dummy in range(5):
+            fired = threading.Event()
+            start_time = time.monotonic()
+            bot.scheduler.call_later(0, fired.set)
+
+            self.assertTrue(fired.wait(2))
+            self.assertLess(time.monotonic() - start_time, 0.1)
+
+            time.sleep(0.1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+from chatbot383.inboundqueue import FairInboundQueue
+
+
+class TestFairInboundQueue(unittest.TestCase):
+    def test_control_items_capped_keeping_welcome(self):
+        inbound_queue = FairInboundQueue(max_control_items=10)
+        inbound_queue.put({'event_type': 'welcome'})
+
+        for index in range(100):
+            inbound_queue.put({'event_type': 'whisper', 'index': index})
+
+        self.assertEqual(10, inbound_queue.qsize())
+
+        items = inbound_queue.get_batch(100, timeout=0)
+
+        self.assertEqual('welcome', items[0]['event_type'])
+        self.assertEqual(list(range(91, 100)),
+                         [item['index'] for item in items[1:]])
+
+    def test_channel_items_capped(self):
+        inbound_queue = FairInboundQueue(max_channel_items=5)
+
+        for index in range(20):
+            inbound_queue.put({'channel': '#a', 'index': index})
+
+        items = inbound_queue.get_batch(100, timeout=0)
+
+        self.assertEqual(list(range(15, 20)),
+                         [item['index'] for item in items])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+import io
+import json
+import logging
+import unittest
+
+from chatbot383.logsetup import setup_logging
+
+
+class TestBackgroundLogging(unittest.TestCase):
+    def setUp(self):
+        self.root_logger = logging.getLogger()
+        self.old_handlers = list(self.root_logger.handlers)
+        self.old_level = self.root_logger.level
+
+    def tearDown(self):
+        for handler in tuple(self.root_logger.handlers):
+            self.root_logger.removeHandler(handler)
+
+        for handler in self.old_handlers:
+            self.root_logger.addHandler(handler)
+
+        self.root_logger.setLevel(self.old_level)
+
+    def test_arguments_formatted_when_logged(self):
+        stream = io.StringIO()
+        listener = setup_logging(stream=stream, log_format='%(message)s')
+        state = {'count': 1}
+
+        logging.getLogger('test').info('State %s', state)
+        state['count'] = 2
+        listener.stop()
+
+        self.assertEqual("State {'count': 1}\n", stream.getvalue())
+
+    def test_json_exception(self):
+        stream = io.StringIO()
+        listener = setup_logging(stream=stream, json_format=True)
+
+        try:
+            raise ValueError('bad value')
+        except ValueError:
+            logging.getLogger('test').exception('Failed %d', 1)
+
+        listener.stop()
+        doc = json.loads(stream.getvalue())
+
+        self.assertEqual('Failed 1', doc['message'])
+        self.assertIn('ValueError: bad value', doc['exception'])
+
+
+if __name__ == '__main__':
+    unittest.main()
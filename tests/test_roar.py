@@ -0,0 +1,19 @@
+import unittest
+
+from chatbot383 import roar
+
+
+class TestGenRoars(unittest.TestCase):
+    def test_no_roars(self):
+        self.assertEqual([], roar.gen_roars(0))
+        self.assertEqual([], roar.gen_roars(-1))
+
+    def test_roars_good_length(self):
+        roars = roar.gen_roars(20)
+
+        self.assertTrue(roars)
+        self.assertTrue(all(roar.is_good_length(text) for text in roars))
+
+
+if __name__ == '__main__':
+    unittest.main()
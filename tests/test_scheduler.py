@@ -0,0 +1,86 @@
+import random
+import unittest
+
+from chatbot383.scheduler import Scheduler, TICK
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.time = 0.0
+
+    def __call__(self):
+        return self.time
+
+
+class TestScheduler(unittest.TestCase):
+    def assertOnTime(self, deadline, time_value):
+        # Never early, and late by at most a tick plus rounding
+        self.assertGreaterEqual(time_value, deadline - 1e-9)
+        self.assertLessEqual(time_value, deadline + TICK + 1e-9)
+
+    def run_until_idle(self, scheduler, clock):
+        while len(scheduler):
+            clock.time = max(clock.time, scheduler.get_next_deadline())
+            scheduler.run_pending()
+
+    def test_higher_level_timer_not_late(self):
+        # The 1.00 s timer starts in level 1 and must be spread down before
+        # the later level 0 timer is due
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        fired = []
+
+        scheduler.call_later(1.0, lambda: fired.append(('first', clock.time)))
+        clock.time = 0.5
+        scheduler.run_pending()
+        scheduler.call_later(0.6, lambda: fired.append(('second', clock.time)))
+
+        self.assertLessEqual(scheduler.get_next_deadline(), 1.0)
+
+        self.run_until_idle(scheduler, clock)
+
+        self.assertEqual(['first', 'second'], [name for name, dummy in fired])
+        self.assertOnTime(1.0, fired[0][1])
+        self.assertOnTime(1.1, fired[1][1])
+
+    def test_random_timers_within_one_tick(self):
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        rng = random.Random(383)
+        lateness = []
+
+        def callback(deadline):
+            lateness.append(clock.time - deadline)
+
+        for dummy in range(2000):
+            if rng.random() < 0.5:
+                delay = rng.uniform(0, 120)
+                scheduler.call_later(delay, callback, clock.time + delay)
+
+            deadline = scheduler.get_next_deadline()
+            step = clock.time + rng.uniform(0, 2)
+            clock.time = step if deadline is None else min(deadline, step)
+            scheduler.run_pending()
+
+        self.run_until_idle(scheduler, clock)
+
+        self.assertTrue(lateness)
+        self.assertGreaterEqual(min(lateness), 0)
+        self.assertLessEqual(max(lateness), TICK + 1e-9)
+
+    def test_cancelled_timer_not_run(self):
+        clock = FakeClock()
+        scheduler = Scheduler(clock=clock)
+        fired = []
+
+        timer = scheduler.call_later(2.0, fired.append, 'cancelled')
+        scheduler.call_later(3.0, fired.append, 'kept')
+        timer.cancel()
+
+        self.run_until_idle(scheduler, clock)
+
+        self.assertEqual(['kept'], fired)
+
+
+if __name__ == '__main__':
+    unittest.main()
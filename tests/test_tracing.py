@@ -0,0 +1,34 @@
+import unittest
+
+from chatbot383.client import Client, MAX_CHANNEL_PENDING
+from chatbot383.tracing import MessageTrace
+
+
+class TestDroppedReplies(unittest.TestCase):
+    def test_pending_cap_finishes_trace(self):
+        client = Client()
+        traces = [MessageTrace(label=str(index))
+                  for index in range(MAX_CHANNEL_PENDING + 2)]
+
+        for trace in traces:
+            client.privmsg('#a', 'hello', trace=trace)
+            client._fill_pending()
+
+        self.assertEqual(['dropped', 'dropped'],
+                         [trace.outcome for trace in traces[:2]])
+        self.assertEqual([None] * MAX_CHANNEL_PENDING,
+                         [trace.outcome for trace in traces[2:]])
+
+    def test_not_connected_finishes_trace(self):
+        client = Client()
+        trace = MessageTrace(label='not connected')
+
+        client.privmsg('#a', 'hello', trace=trace)
+        client._process_outbound_messages()
+
+        self.assertEqual('dropped', trace.outcome)
+        self.assertIn('dropped', trace.marks)
+
+
+if __name__ == '__main__':
+    unittest.main()